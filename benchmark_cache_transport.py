@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import multiprocessing as mp
+import sys, time, json, random
+
+from rxnav_cache_transport import create_cache_transport, CACHE_TRANSPORTS
+
+'''
+Script: benchmark_cache_transport.py
+
+Purpose:
+    Micro-benchmark of the worker to Cache Writer transports (--cache_transport of build_rxnorm_metadata.py).
+
+    A number of sender processes (the workers) each send batches of (url, JSON text) results, in
+    the same form as the workers send them, to one receiver (the Cache Writer, here the main process).
+    The JSON text is a synthetic 'allrelated' result -- concept groups per TTY with concept properties --
+    of about the size of the real results.
+
+Usage:
+    python benchmark_cache_transport.py [--senders 4] [--batches 500] [--batch_size 64] [--concepts 30]
+                                        [--transports manager,queue,pipe,shm]
+'''
+
+ALLRELATED_TTYS = ['IN', 'PIN', 'MIN', 'BN', 'SCDC', 'SCDF', 'SCDG', 'SCD', 'SBDC', 'SBDF', 'SBDG', 'SBD',
+                   'DF', 'DFG', 'GPCK', 'BPCK']
+
+def synthetic_allrelated(rxcui, concept_count, rng):
+    ''' JSON text shaped like an 'allrelated' REST API result, with concept_count concepts '''
+    concept_groups = [{'tty': tty, 'conceptProperties': []} for tty in ALLRELATED_TTYS]
+    for idx in range(concept_count):
+        group = rng.choice(concept_groups)
+        related_rxcui = str(rng.randint(1000, 2000000))
+        name = ' '.join(rng.choice(['acetaminophen', 'oxycodone', 'hydrochloride', 'MG', '325', '5', 'Oral',
+                                    'Tablet', 'Extended', 'Release', 'Injectable', 'Solution', 'ML'])
+                        for word_idx in range(rng.randint(3, 9)))
+        group['conceptProperties'].append({'rxcui': related_rxcui, 'name': name, 'synonym': '',
+                                           'tty': group['tty'], 'language': 'ENG', 'suppress': 'N',
+                                           'umlscui': ''})
+    return json.dumps({'allRelatedGroup': {'rxcui': str(rxcui), 'conceptGroup': concept_groups}})
+# end synthetic_allrelated
+
+def sender_task(transport, sender_number, batch_count, batch_size, payloads):
+    for batch_idx in range(batch_count):
+        batch = []
+        for idx in range(batch_size):
+            rxcui = (sender_number * batch_count + batch_idx) * batch_size + idx
+            batch.append(('https://rxnav.nlm.nih.gov/REST/rxcui/%d/allrelated.json' % rxcui,
+                          payloads[rxcui % len(payloads)]))
+        transport.put(batch)
+    transport.put('done')
+# end sender_task
+
+def benchmark_transport(cache_transport, opts, payloads):
+    transport = create_cache_transport(cache_transport)
+    senders = [mp.Process(target=sender_task, args=(transport, idx, opts.batches, opts.batch_size, payloads))
+               for idx in range(opts.senders)]
+    start_t = time.time()
+    for sender in senders:
+        sender.start()
+    message_count, entry_count, byte_count, done_count = 0, 0, 0, 0
+    while done_count < opts.senders:
+        m = transport.get()
+        if isinstance(m, list):
+            message_count += 1
+            entry_count += len(m)
+            byte_count += sum(len(url) + len(json_text) for url, json_text in m)
+        elif m == 'done':
+            done_count += 1
+    elapsed_t = time.time() - start_t
+    for sender in senders:
+        sender.join()
+    transport.close()
+    if entry_count != opts.senders * opts.batches * opts.batch_size:
+        raise ValueError('Transport [%s] delivered %d of %d entries'
+                         % (cache_transport, entry_count, opts.senders * opts.batches * opts.batch_size))
+    print('%-8s %8.2f sec %10.0f messages/sec %10.0f entries/sec %8.1f MB/sec'
+          % (cache_transport, elapsed_t, message_count / elapsed_t, entry_count / elapsed_t,
+             byte_count / 1024.0 / 1024.0 / elapsed_t))
+    sys.stdout.flush()
+# end benchmark_transport
+
+def main():
+    def parse_args():
+        from optparse import OptionParser
+        opt = OptionParser()
+        opt.add_option('--senders', action='store', type=int, default=4)
+        opt.add_option('--batches', action='store', type=int, default=500) # per sender
+        opt.add_option('--batch_size', action='store', type=int, default=64) # results per message
+        opt.add_option('--concepts', action='store', type=int, default=30) # concepts per allrelated result
+        opt.add_option('--transports', action='store', default=','.join(CACHE_TRANSPORTS))
+        opt.add_option('--seed', action='store', type=int, default=1)
+        opts, args = opt.parse_args()
+        return opts, args
+    # end parse_args
+
+    opts, args = parse_args()
+    rng = random.Random(opts.seed)
+    payloads = [synthetic_allrelated(idx, rng.randint(opts.concepts // 2, opts.concepts * 3 // 2), rng)
+                for idx in range(1000)]
+    print('%d senders x %d batches x %d results, mean result size %.1f KB'
+          % (opts.senders, opts.batches, opts.batch_size, sum(len(x) for x in payloads) / 1024.0 / len(payloads)))
+    for cache_transport in opts.transports.split(','):
+        benchmark_transport(cache_transport, opts, payloads)
+# end main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys, io, os, gc, time, json, platform, subprocess, contextlib
+
+from utility_functions import utility_functions
+from rxnav_rest_api_mp import rxnav_rest_api_mp
+from rxnav_cache_store import CACHE_BACKENDS
+from rxcui_attribute_table import rxcui_attribute_table
+from rxnorm_code_maps import rxnorm_code_maps
+from modifier_metadata_builder import modifier_metadata_builder
+from va_metadata_builder import va_metadata_builder
+from ingredient_metadata_builder import ingredient_metadata_builder
+from metadata_writer import metadata_writer
+from ndc_api import ndc_api, NDC_ZIP_FILENAME
+from build_rxnorm_metadata import pcori_meds_first_level_metadata_builder, post_process, \
+    ingredient_rxcui_set_from_attributes, drug_rxcui_set_from_attributes
+from generate_synthetic_cache import synthetic_rxnorm, write_cache, write_ndc_zip
+
+try:
+    import resource # peak RSS, not on Windows
+except ImportError:
+    resource = None
+
+'''
+Script: benchmark_metadata_build.py
+
+Purpose:
+    End-to-end benchmark of the metadata build (the Metadata Writer of build_rxnorm_metadata.py, as
+    with --from_cache_only), which times each stage separately and measures its memory:
+
+        cache_index_load             rxnav_rest_api_mp, loading the cache index
+        status_lists                 ACTIVE, RETIRED, NEVER ACTIVE and NON-RXNORM status lists
+        attribute_extraction         rxcui_attribute_table
+        rxnorm_code_maps             ingredient and drug sets, rxnorm_code_maps
+        modifier_metadata_builder    modifier rows, \\<prefix>\\MEDICATION row
+        va_metadata_builder          VA class rows
+        ingredient_metadata_builder  by-ingredient rows
+        post_process                 (VA subset) names
+        metadata_writer              writing the metadata file
+
+    Each stage reports its wall and CPU seconds, the RSS after it and its change, and the peak RSS
+    of the process so far; with --tracemalloc, also the peak of the Python allocations within the
+    stage (slower).  The report is written as JSON (--report), with the git commit of the source,
+    so that the reports of two commits can be compared: --compare <earlier report> prints the
+    change of each stage and exits with status 1 when a stage is slower, or grows the memory
+    more, than --regression_threshold (default 0.10, 10%) -- and by at least --min_seconds (default
+    0.5) or --min_mb (default 10): the noise of short stages is larger than the threshold.
+
+    The cache is --cache, with ndc_names_from_fda.zip in its directory, the directory the build
+    runs in.  When it does not exist, a synthetic one of --synthetic_scale times today's RxNorm
+    code counts is generated first (see generate_synthetic_cache.py), and kept for the next runs;
+    the same --synthetic_scale and --seed give the same cache on every commit.  The builders'
+    output goes to benchmark_metadata_build.log in that directory.
+
+Usage:
+    python benchmark_metadata_build.py [--cache ./benchmark/rxcui.cache] [--cache_backend file]
+                                       [--synthetic_scale 0.1] [--seed 1] [--allrelated_lru_size 100000]
+                                       [--include_tty] [--format_workers 0] [--tracemalloc]
+                                       [--report benchmark_metadata_build.json] [--keep_output]
+                                       [--compare <earlier report>] [--regression_threshold 0.10]
+                                       [--min_seconds 0.5] [--min_mb 10]
+'''
+
+def current_rss_mb():
+    ''' resident set size of the process, None where /proc is not available '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, OSError, ValueError):
+        return None
+# end current_rss_mb
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1048576.0 if sys.platform == 'darwin' else maxrss / 1024.0 # bytes on macOS, else KB
+# end peak_rss_mb
+
+def git_commit():
+    ''' (commit, modified) of the source tree, (None, None) outside a git checkout '''
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=source_dir,
+                                         stderr=subprocess.STDOUT).decode('utf-8').strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=source_dir,
+                                         stderr=subprocess.STDOUT).decode('utf-8').strip()
+        return commit, len(status) > 0
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+# end git_commit
+
+class stage_timer():
+    ''' measures the stages of the build, one after the other '''
+
+    def __init__(self, use_tracemalloc=False):
+        self.stages = []
+        self.tracemalloc = None
+        if use_tracemalloc:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+            tracemalloc.start()
+    # end constructor
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ''' with timer.stage(name) as result: ... result['count'] = <items built> '''
+        gc.collect() # garbage of the previous stage is not collected during this one
+        result = {'name': name, 'count': None}
+        rss_before = current_rss_mb()
+        if self.tracemalloc is not None:
+            if hasattr(self.tracemalloc, 'reset_peak'): # python 3.9
+                self.tracemalloc.reset_peak()
+            else:
+                self.tracemalloc.clear_traces()
+            traced_before = self.tracemalloc.get_traced_memory()[0]
+        start_t, start_cpu = time.time(), time.process_time()
+        yield result
+        result['wall_seconds'] = round(time.time() - start_t, 3)
+        result['cpu_seconds'] = round(time.process_time() - start_cpu, 3)
+        rss_after = current_rss_mb()
+        result['rss_mb'] = None if rss_after is None else round(rss_after, 1)
+        result['rss_delta_mb'] = None if rss_after is None else round(rss_after - rss_before, 1)
+        peak = peak_rss_mb()
+        result['peak_rss_mb'] = None if peak is None else round(peak, 1)
+        if self.tracemalloc is not None:
+            result['python_peak_mb'] = round((self.tracemalloc.get_traced_memory()[1] - traced_before) / 1048576.0, 1)
+        self.stages.append(result)
+        print('%-28s %8.2f sec %8.2f cpu %s %s%s'
+              % (name, result['wall_seconds'], result['cpu_seconds'],
+                 'rss %8.1f MB (%+8.1f)' % (rss_after, rss_after - rss_before) if rss_after is not None else '',
+                 'peak %8.1f MB' % peak if peak is not None else '',
+                 ' python peak %8.1f MB' % result['python_peak_mb'] if self.tracemalloc is not None else ''),
+              file=sys.__stdout__)
+        sys.__stdout__.flush()
+    # end stage
+
+# end class stage_timer
+
+def prepare_cache(opts):
+    ''' generates a synthetic cache (and NDC names file) when --cache does not exist '''
+    if os.path.exists(opts.cache):
+        return None
+    cache_dir = os.path.dirname(os.path.abspath(opts.cache))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    start_t = time.time()
+    model = synthetic_rxnorm(opts.synthetic_scale, opts.seed)
+    logfile = io.open(os.path.join(cache_dir, 'generate_synthetic_cache.log'), 'w', encoding='utf-8')
+    entry_count = write_cache(model, opts.cache, opts.cache_backend, logfile)
+    logfile.close()
+    write_ndc_zip(model, os.path.join(cache_dir, NDC_ZIP_FILENAME))
+    print('Generated synthetic cache [%s] (scale %g, seed %d): %d results in %.1f seconds'
+          % (opts.cache, opts.synthetic_scale, opts.seed, entry_count, time.time() - start_t))
+    sys.stdout.flush()
+    return {'scale': opts.synthetic_scale, 'seed': opts.seed}
+# end prepare_cache
+
+def run_metadata_build(opts, timer, logfile, output_fn):
+    ''' the steps of metadata_writer_task (build_rxnorm_metadata.py), one stage each; returns counts '''
+    counts = {}
+    path_prefix, prefix_level = 'i2b2_RXNORM_NDC', 1
+    with timer.stage('cache_index_load') as result:
+        rxnav = rxnav_rest_api_mp(opts.cache, utility_functions(), logfile, None,
+                                  readonly_access_to_cache=True,
+                                  forward_result_to_cache_writer=False,
+                                  fail_if_not_in_cache=True,
+                                  cache_backend=opts.cache_backend,
+                                  allrelated_lru_size=opts.allrelated_lru_size)
+    with timer.stage('status_lists') as result:
+        rxcui_set, rxcuis_status_d = \
+            rxnav.get_historical_rxcuis(target_status_values=["ACTIVE", "RETIRED", "NEVER%20ACTIVE"], verbose=True)
+        nonrxnorm_rxcui_set, nonrxnorm_status_d = \
+            rxnav.get_historical_rxcuis(target_status_values=["NON-RXNORM"], verbose=True)
+        result['count'] = counts['rxcuis'] = len(rxcui_set)
+        counts['nonrxnorm_rxcuis'] = len(nonrxnorm_rxcui_set)
+    with timer.stage('attribute_extraction') as result:
+        attribute_table = rxcui_attribute_table(rxnav, rxcui_set, logfile)
+        result['count'] = len(rxcui_set)
+    with timer.stage('rxnorm_code_maps') as result:
+        ingredient_rxcui_set = ingredient_rxcui_set_from_attributes(attribute_table)
+        drug_rxcui_set = drug_rxcui_set_from_attributes(attribute_table)
+        rxnorm_coding = rxnorm_code_maps(rxnav, ingredient_rxcui_set, drug_rxcui_set, attribute_table=attribute_table)
+        counts['ingredients'], counts['drugs'] = len(ingredient_rxcui_set), len(drug_rxcui_set)
+        result['count'] = len(ingredient_rxcui_set) + len(drug_rxcui_set)
+    with timer.stage('modifier_metadata_builder') as result:
+        modifier_rows = modifier_metadata_builder().build(path_prefix, prefix_level, 'interop_MED_MODIFIERS.txt')
+        va_meds_row = pcori_meds_first_level_metadata_builder().build(path_prefix, prefix_level)
+        result['count'] = len(modifier_rows) + len(va_meds_row)
+    with timer.stage('va_metadata_builder') as result:
+        va_builder = va_metadata_builder(rxnav, rxnorm_coding)
+        va_metadata_rows = va_builder.build(path_prefix, prefix_level + 1)
+        result['count'] = counts['va_rows'] = len(va_metadata_rows)
+    with timer.stage('ingredient_metadata_builder') as result:
+        ingred_builder = ingredient_metadata_builder(rxnorm_coding, rxnav)
+        ingred_metadata_rows = ingred_builder.build(path_prefix, prefix_level)
+        result['count'] = counts['ingredient_rows'] = len(ingred_metadata_rows)
+    with timer.stage('post_process') as result:
+        post_process(va_metadata_rows, ingred_metadata_rows)
+        result['count'] = len(va_metadata_rows) + len(ingred_metadata_rows)
+    with timer.stage('metadata_writer') as result:
+        writer = metadata_writer(output_fn, append=False, include_dates=True, include_tty=opts.include_tty,
+                                 strftime_format='%Y%m%d', format_workers=opts.format_workers)
+        writer.write_metadata_rows(modifier_rows)
+        writer.write_metadata_rows(va_meds_row)
+        writer.write_sorted_metadata_rows(va_builder.get_metadata_rows())
+        writer.write_sorted_metadata_rows(ingred_builder.get_metadata_rows())
+        writer.close()
+    with io.open(output_fn, 'r', encoding='utf-8') as f: # the writer adds the NDC rows of the drugs
+        counts['output_rows'] = sum(1 for line in f) - 1 # header line
+    counts['output_bytes'] = os.path.getsize(output_fn)
+    timer.stages[-1]['count'] = counts['output_rows']
+    return counts
+# end run_metadata_build
+
+def compare_reports(previous, current, opts):
+    ''' prints the change of each stage, returns the number of regressions '''
+    def change(before, after):
+        return (after - before) / before if before else 0.0
+
+    def memory_metric(stage):
+        return 'python_peak_mb' if stage.get('python_peak_mb') is not None else 'rss_delta_mb'
+
+    previous_stages = {x['name']: x for x in previous['stages']}
+    print('Compared with [%s] (commit %s):' % (opts.compare, previous.get('git_commit')))
+    print('%-28s %10s %10s %8s   %10s %10s %8s' % ('stage', 'sec before', 'sec after', 'change',
+                                                   'MB before', 'MB after', 'change'))
+    regression_count = 0
+    for stage in current['stages'] + [{'name': 'total', 'wall_seconds': current['total_wall_seconds'],
+                                       'peak_rss_mb': current['peak_rss_mb']}]:
+        if stage['name'] == 'total':
+            before = {'wall_seconds': previous['total_wall_seconds'], 'peak_rss_mb': previous['peak_rss_mb']}
+            metric = 'peak_rss_mb'
+        elif stage['name'] in previous_stages:
+            before = previous_stages[stage['name']]
+            metric = memory_metric(stage)
+        else:
+            print('%-28s (not in the earlier report)' % stage['name'])
+            continue
+        flags = []
+        time_change = change(before['wall_seconds'], stage['wall_seconds'])
+        if stage['wall_seconds'] - before['wall_seconds'] >= opts.min_seconds \
+                and time_change > opts.regression_threshold:
+            flags.append('time')
+        mb_before, mb_after = before.get(metric), stage.get(metric)
+        if mb_before is None or mb_after is None:
+            mb_text = '%10s %10s %8s' % ('-', '-', '')
+        else:
+            mb_change = change(mb_before, mb_after) if mb_before > 0 else 0.0
+            if mb_after > mb_before and mb_after - mb_before >= opts.min_mb \
+                    and (mb_before <= 0 or mb_change > opts.regression_threshold):
+                flags.append('memory')
+            mb_text = '%10.1f %10.1f %+7.1f%%' % (mb_before, mb_after, 100.0 * mb_change)
+        print('%-28s %10.2f %10.2f %+7.1f%%   %s%s'
+              % (stage['name'], before['wall_seconds'], stage['wall_seconds'], 100.0 * time_change, mb_text,
+                 ('   REGRESSION (%s)' % ', '.join(flags)) if flags else ''))
+        regression_count += 1 if flags else 0
+    previous_counts, counts = previous.get('counts', {}), current['counts']
+    differing = sorted(x for x in set(previous_counts) | set(counts) if previous_counts.get(x) != counts.get(x))
+    if differing: # another cache, or the build changed its output
+        print('NOTE: the counts differ from the earlier report: %s'
+              % ', '.join('%s %s ==> %s' % (x, previous_counts.get(x), counts.get(x)) for x in differing))
+    return regression_count
+# end compare_reports
+
+def main():
+    def parse_args():
+        from optparse import OptionParser
+        opt = OptionParser()
+        opt.add_option('--cache', action='store', default='./benchmark/rxcui.cache')
+        opt.add_option('--cache_backend', action='store', type='choice', choices=CACHE_BACKENDS, default='file')
+        opt.add_option('--synthetic_scale', action='store', type=float, default=0.1) # when --cache does not exist
+        opt.add_option('--seed', action='store', type=int, default=1)
+        opt.add_option('--allrelated_lru_size', action='store', type=int, default=100000)
+        opt.add_option('--include_tty', action='store_true')
+        opt.add_option('--format_workers', action='store', type=int, default=0)
+        opt.add_option('--tracemalloc', action='store_true') # peak of the Python allocations of each stage
+        opt.add_option('--report', action='store', default='benchmark_metadata_build.json')
+        opt.add_option('--keep_output', action='store_true') # keep the metadata file, next to the cache
+        opt.add_option('--compare', action='store') # earlier report
+        opt.add_option('--regression_threshold', action='store', type=float, default=0.10) # fraction
+        opt.add_option('--min_seconds', action='store', type=float, default=0.5)
+        opt.add_option('--min_mb', action='store', type=float, default=10)
+        opts, args = opt.parse_args()
+        return opts, args
+    # end parse_args
+
+    opts, args = parse_args()
+    opts.report = os.path.abspath(opts.report)
+    opts.cache = os.path.abspath(opts.cache)
+    previous = None
+    if opts.compare:
+        with io.open(opts.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+    synthetic = prepare_cache(opts)
+    os.chdir(os.path.dirname(opts.cache)) # ndc_names_from_fda.zip is read from the current directory
+    if not os.path.exists(NDC_ZIP_FILENAME):
+        print('%s not found next to the cache [%s]' % (NDC_ZIP_FILENAME, opts.cache))
+        sys.exit(1)
+    ndc_api() # builds the NDC name index, if needed, before the stages are measured
+    output_fn = 'benchmark_metadata_build.txt'
+    logfile = io.open('benchmark_metadata_build.log', 'w', encoding='utf-8')
+    timer = stage_timer(opts.tracemalloc)
+    commit, modified = git_commit()
+    print('Benchmarking the metadata build from [%s], commit %s%s'
+          % (opts.cache, commit, ' (modified)' if modified else ''))
+    sys.stdout.flush()
+    start_t = time.time()
+    with contextlib.redirect_stdout(logfile): # the builders' progress output
+        counts = run_metadata_build(opts, timer, logfile, output_fn)
+    total_wall_seconds = time.time() - start_t
+    logfile.close()
+    if not opts.keep_output:
+        os.remove(output_fn)
+    report = {'git_commit': commit,
+              'git_modified': modified,
+              'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python_version': platform.python_version(),
+              'platform': platform.platform(),
+              'cache': opts.cache,
+              'cache_backend': opts.cache_backend,
+              'cache_bytes': os.path.getsize(opts.cache),
+              'synthetic': synthetic, # None ==> existing cache
+              'options': {'allrelated_lru_size': opts.allrelated_lru_size, 'include_tty': bool(opts.include_tty),
+                          'format_workers': opts.format_workers, 'tracemalloc': bool(opts.tracemalloc)},
+              'counts': counts,
+              'stages': timer.stages,
+              'total_wall_seconds': round(total_wall_seconds, 3),
+              'total_cpu_seconds': round(sum(x['cpu_seconds'] for x in timer.stages), 3),
+              'peak_rss_mb': timer.stages[-1]['peak_rss_mb']}
+    with io.open(opts.report, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(report, indent=2, sort_keys=True))
+    print('%-28s %8.2f sec, peak RSS %s MB, %d output rows -- report [%s]'
+          % ('total', total_wall_seconds, report['peak_rss_mb'], counts['output_rows'], opts.report))
+    if previous is not None and compare_reports(previous, report, opts) > 0:
+        sys.exit(1)
+# end main
+
+if __name__ == '__main__':
+    main()
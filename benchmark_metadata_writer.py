@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys, os, time, random, tempfile, filecmp
+
+from metadata_writer import metadata_writer
+
+'''
+Script: benchmark_metadata_writer.py
+
+Purpose:
+    Micro-benchmark of the metadata_writer row serializer.  Writes synthetic rows, shaped like the
+    by-ingredient rows (mostly NDC rows under drugs), with the per-row serializer metadata_writer used
+    before its row formatter was compiled (legacy_write_sorted_metadata_rows, below) and with the
+    current one, reports rows/sec of each, and checks that the files are identical.
+    With --format_workers, also with the rows formatted by that many processes (see metadata_writer).
+
+Usage:
+    python benchmark_metadata_writer.py [--rows 1000000] [--include_tty] [--csv_fields_file <file>]
+                                        [--format_workers 4]
+'''
+
+def legacy_write_sorted_metadata_rows(writer, path_rows):
+    ''' the metadata_writer row loop before the row formatter was compiled, for comparison '''
+    def clean_str(s):
+        return make_utf8('"' + s.strip().replace('"', r'\"') + '"')
+
+    def make_utf8(s):
+        return unicode(s) if sys.version_info[0] < 3 else s
+
+    fieldnames, fieldname_set, date_str = writer.fieldnames, writer.fieldname_set, writer.date_str
+    field = {fieldname: '' for fieldname in fieldnames}
+    for path, row in path_rows:
+        field['C_FULLNAME'] = clean_str(path)
+        field['C_HLEVEL'] = str(row['c_hlevel'])
+        field['C_NAME'] = clean_str(row['c_name'])
+        if 'C_NAME_ORIG' in fieldname_set: field['C_NAME_ORIG'] = clean_str(row['c_name'])
+        c_basecode = row['c_basecode']
+        field['C_BASECODE'] = clean_str(c_basecode) if c_basecode else ''
+        colon_pos = c_basecode.find(':')
+        if 'PCORI_BASECODE' in fieldname_set:
+            field['PCORI_BASECODE'] = '' if colon_pos < 0 else clean_str(c_basecode[colon_pos + 1:])
+        if 'PCORI_NDC' in fieldname_set:
+            field['PCORI_NDC'] = '' if (not c_basecode.startswith('NDC:')) else clean_str(c_basecode[colon_pos + 1:])
+        if 'PCORI_CUI' in fieldname_set:
+            if c_basecode.startswith('RXNORM:'):
+                field['PCORI_CUI'] = clean_str(c_basecode[colon_pos + 1:])
+            elif c_basecode.startswith('NDC:'):
+                c_fullname_elements = row['c_fullname'].split('\\')
+                field['PCORI_CUI'] = '' if len(c_fullname_elements) < 2 else clean_str(c_fullname_elements[-2])
+        field['C_DIMCODE'] = clean_str(row.get('c_dimcode', path))
+        field['C_TOOLTIP'] = clean_str(row.get('c_tooltip', path[1:-1]))
+        field['C_SYNONYM_CD'] = clean_str('N')
+        if 'C_TOTALNUM' in fieldname_set: field['C_TOTALNUM'] = '0'
+        if 'FACT_COUNT' in fieldname_set: field['FACT_COUNT'] = '0'
+        field['C_VISUALATTRIBUTES'] = clean_str(row.get('c_visualattributes',
+                                                        ('FA ' if row['children'] > 0 else 'LA ')))
+        field['C_FACTTABLECOLUMN'] = clean_str(row.get('c_facttablecolumn', 'concept_cd'))
+        field['C_TABLENAME'] = clean_str(row.get('c_tablename', 'concept_dimension'))
+        field['C_OPERATOR'] = clean_str(row.get('c_operator', 'LIKE'))
+        field['C_COLUMNNAME'] = clean_str(row.get('c_columnname', 'concept_path'))
+        field['C_COLUMNDATATYPE'] = clean_str(row.get('c_columnndatatype', 'T'))
+        field['M_APPLIED_PATH'] = clean_str(row.get('m_applied_path', '@'))
+        field['SOURCESYSTEM_CD'] = clean_str(row.get('sourcesystem_cd', 'rxnav.nlm.nih.gov'))
+        for datefield in ['UPDATE_DATE', 'DOWNLOAD_DATE', 'IMPORT_DATE']:
+            if datefield in fieldname_set: field[datefield] = clean_str(date_str)
+        c_metadataxml = row.get('c_metadataxml', '')
+        field['C_METADATAXML'] = clean_str(c_metadataxml) if c_metadataxml else ''
+        if 'TTY' in fieldname_set: field['TTY'] = clean_str(row.get('tty', ''))
+        print(make_utf8('|'.join(field[x] for x in fieldnames)), file=writer.fout)
+# end legacy_write_sorted_metadata_rows
+
+def synthetic_rows(row_count, seed):
+    ''' (path, row) pairs in path order, a drug row followed by its NDC rows '''
+    rng = random.Random(seed)
+    rows = []
+    prefix = '\\i2b2_RXNORM_NDC\\INGREDIENT\\A\\'
+    drug_rxcui = 100000
+    while len(rows) < row_count:
+        drug_rxcui += rng.randint(1, 50)
+        drug_path = prefix + '161\\' + str(drug_rxcui) + '\\'
+        ndcs = sorted('%011d' % rng.randint(1, 99999999999) for idx in range(rng.randint(1, 12)))
+        drug_name = 'acetaminophen %d MG Oral Tablet [Tylenol "Extra"]' % rng.randint(1, 1000)
+        rows.append((drug_path, {'c_fullname': drug_path, 'c_hlevel': 5, 'c_name': drug_name,
+                                 'c_basecode': 'RXNORM:%d' % drug_rxcui, 'c_tooltip': 'Orderable Drug (RxNAV tty:SBD)',
+                                 'children': len(ndcs), 'tty': 'SBD', 'rxcui': drug_rxcui}))
+        for ndc in ndcs:
+            ndc_path = drug_path + ndc + '\\'
+            rows.append((ndc_path, {'c_fullname': ndc_path, 'c_hlevel': 6, 'c_name': '(%s) %s' % (ndc, drug_name),
+                                    'c_basecode': 'NDC:%s' % ndc,
+                                    'c_tooltip': 'Package for Orderable Drug RXNORM:%d' % drug_rxcui,
+                                    'children': 0, 'tty': 'NDC', 'rxcui': None}))
+    return sorted(rows[:row_count], key=lambda x: x[0]) # path order, as the builders give them
+# end synthetic_rows
+
+def time_writer(write_fn, rows, opts, format_workers=0):
+    fd, fn = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    writer = metadata_writer(fn, include_dates=True, include_tty=opts.include_tty,
+                             csv_fields_file=opts.csv_fields_file, csv_fields_file_delim=opts.csv_fields_file_delim,
+                             strftime_format='%Y%m%d', # same date string in all files
+                             format_workers=format_workers)
+    start_t = time.time()
+    write_fn(writer, rows)
+    writer.close()
+    return time.time() - start_t, fn
+# end time_writer
+
+def main():
+    def parse_args():
+        from optparse import OptionParser
+        opt = OptionParser()
+        opt.add_option('--rows', action='store', type=int, default=1000000)
+        opt.add_option('--include_tty', action='store_true')
+        opt.add_option('--csv_fields_file', action='store')
+        opt.add_option('--csv_fields_file_delim', action='store', default='|')
+        opt.add_option('--format_workers', action='store', type=int, default=0)
+        opt.add_option('--seed', action='store', type=int, default=1)
+        opts, args = opt.parse_args()
+        return opts, args
+    # end parse_args
+
+    opts, args = parse_args()
+    rows = synthetic_rows(opts.rows, opts.seed)
+    results = []
+    variants = [('before', legacy_write_sorted_metadata_rows, 0),
+                ('after', lambda writer, rows: writer.write_sorted_metadata_rows(rows), 0)]
+    if opts.format_workers > 1:
+        variants.append(('parallel', lambda writer, rows: writer.write_sorted_metadata_rows(rows), opts.format_workers))
+    for name, write_fn, format_workers in variants:
+        elapsed_t, fn = time_writer(write_fn, rows, opts, format_workers)
+        results.append(fn)
+        print('%-8s %8.2f sec %12.0f rows/sec %8.1f MB' % (name, elapsed_t, len(rows) / elapsed_t,
+                                                          os.path.getsize(fn) / 1048576.0))
+        sys.stdout.flush()
+    identical = all(filecmp.cmp(results[0], fn, shallow=False) for fn in results[1:])
+    print('Output files identical: %s' % identical)
+    for fn in results:
+        os.remove(fn)
+    if not identical:
+        sys.exit(1)
+# end main
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,18 @@
 
 from __future__ import print_function
 import multiprocessing as mp
-import sys, io, math, time
+import sys, io, os, time, json, queue
 
 # Classes specific to this project, in separate python scripts in the same folder as this script.
 from utility_functions import utility_functions
-from rxnav_rest_api_mp import rxnav_rest_api_mp
+from rxnav_rest_api_mp import rxnav_rest_api_mp, rest_api_request_error, RXNAV_REST_API_BASE_URL
+from rxnav_cache_store import open_cache_store, prepare_cache_store, CACHE_BACKENDS
+from rxnav_cache_transport import create_cache_transport, CACHE_TRANSPORTS
+from rxnav_checkpoint import rxnav_checkpoint, code_set_hash
+from rxnav_incremental import determine_refresh_rxcuis
+from rxnav_telemetry import write_telemetry_files, log_telemetry_summary
+from rxnav_rate_limiter import shared_rate_limiter
+from metadata_writer import is_metadata_file_of
 
 '''
 Module: build_rxnorm_metadata.py
@@ -44,6 +51,14 @@ Architecture:
     For example, using 4 simultaneously executing processes, we can obtain about 16 pieces of
     information per second instead of 4.
 
+    Each worker additionally keeps up to --max_in_flight requests outstanding at once, by
+    prefetching the requests for its next batch of codes (rxnav_async_fetch.py), so the
+    rate is no longer limited to one request per worker per round-trip.
+
+    Each completed phase is recorded in a checkpoint manifest next to the cache
+    (rxnav_checkpoint.py).  A rerun skips the phases already done for the same codes, and
+    when the whole cache is complete, goes straight to building the i2b2 metadata.
+
 Processing algorithm:
 
     Manager process:
@@ -57,19 +72,19 @@ Processing algorithm:
 
       Write these codes to the cache file.
 
-      Take the remaining set of approximately 350,000 and create four equal segments
-      of codes (around 90,000 per segment).  Assign each segment to a worker.
+      Take the codes of the remaining set of approximately 350,000 whose results are not
+      already in the cache, and put them on a work queue in batches (--dispatch_batch_size).
 
-      Create (--workers <count>) worker processes, passing the associated code segment to each.     
+      Create (--workers <count>) worker processes, which take batches from the work queue.
       Create 1 Cache Writer process to handle the write requests to the cache file.
       Wait for processes to terminate.
       Stop Cache Writer
 
       Done.
 
-    RxCUI Worker process: (any of a set of workers), passed a segment of the RxCUI codes
+    RxCUI Worker process: (any of a set of workers), passed the work queue
 
-      For each RxCUI code in given segment of RxCUI codes:
+      For each batch of RxCUI codes taken from the work queue, until no batches remain:
           Request the 'allrelated' information from the NLM's REST API.
           Request the 'historicalrxcui' information form the NLM's REST API.
           Send the result to the Cache writer process queue.          
@@ -138,22 +153,65 @@ class BasicTree:
 
 # --------------------- multiprocessing process definitions ==> workers and cache writer ---------------
 
+def get_rxnav_options(opts, rate_limiter=None):
+    ''' keyword arguments for the rxnav_rest_api_mp objects of the processes which make REST API requests '''
+    return {'rate_limiter': rate_limiter, # shared by all processes, see rxnav_rate_limiter
+            'max_in_flight': opts.max_in_flight,
+            'http_pool_size': opts.http_pool_size,
+            'http_idle_timeout': opts.http_idle_timeout,
+            'cache_backend': opts.cache_backend,
+            'cache_batch_size': opts.cache_batch_size,
+            'cache_batch_latency': opts.cache_batch_latency,
+            'telemetry_interval': opts.telemetry_interval,
+            'retry_limit': opts.retry_limit,
+            'retry_max_backoff': opts.retry_max_backoff,
+            'rest_api_base_url': opts.rest_api_base_url}
+# end get_rxnav_options
+
+def failed_requests_filename(log_filename):
+    return os.path.splitext(log_filename)[0] + '.failed_requests.json'
+
+def retry_deferred_requests(rxnav, deferred_urls, log_filename, logfile):
+    '''
+    Request the URLs put aside when their requests failed (deferred_urls) again, at the end of the process's
+    work.  Those which fail again are written next to its log, for the manager (read_failed_requests).
+    '''
+    failed_requests = rxnav.retry_deferred_requests(deferred_urls)
+    if len(deferred_urls) > 0:
+        print('[%s] Requested %d deferred URLs again, %d failed again'
+              % (get_timestamp_string(), len(deferred_urls), len(failed_requests)), file=logfile)
+        logfile.flush()
+    with io.open(failed_requests_filename(log_filename), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(failed_requests))
+# end retry_deferred_requests
+
+def read_failed_requests(log_filename):
+    ''' [(url, reason)] of the requests of a worker (or phase 3) which failed permanently '''
+    if not os.path.exists(failed_requests_filename(log_filename)):
+        return []
+    with io.open(failed_requests_filename(log_filename), 'r', encoding='utf-8') as f:
+        return [tuple(x) for x in json.load(f)]
+# end read_failed_requests
+
 # -------------------         Worker task           ----------------------------
 
-# Worker -- process a segment of RxCUI codes, find their 'allrelated' definitions
+# Worker -- process batches of RxCUI codes taken from the work queue, find their 'allrelated' definitions
 #           cause the information to be written to the cache file.
+#           Whichever worker is free takes the next batch, so all workers finish at about the same time.
 
-def worker_task_rxcuis(mp_queue, worker_number, cache_filename, barrier, rxcui_code_list, log_filename, utility_fns):
+def worker_task_rxcuis(mp_queue, worker_number, cache_filename, barrier, work_queue, log_filename, utility_fns,
+                       rxnav_options):
     ''' RxCUI Worker -- determine 'allrelated' and 'rxcuihistory' for RxCUI codes, send results to Cache Writer '''
 
     logfile = io.open(log_filename, 'w', encoding='utf-8')
-    print('[%s] Worker %d -- processing %d RxCUI codes from [%s] to [%s]'
-          % (get_timestamp_string(), worker_number, len(rxcui_code_list), rxcui_code_list[0], rxcui_code_list[-1]),
+    print('[%s] Worker %d -- processing batches of RxCUI codes from the work queue'
+          % (get_timestamp_string(), worker_number),
           file=logfile)
     logfile.flush()
     rxnav = rxnav_rest_api_mp(cache_filename, utility_fns, logfile, mp_queue,
                               readonly_access_to_cache=True,
-                              forward_result_to_cache_writer=True)
+                              forward_result_to_cache_writer=True,
+                              **rxnav_options)
 
     # At this point, we have initialized with the REST API, which means that the
     # initial contents of the cache file have been read.
@@ -164,20 +222,34 @@ def worker_task_rxcuis(mp_queue, worker_number, cache_filename, barrier, rxcui_c
     print('[%s] Passing the barrier' % get_timestamp_string(), file=logfile);
     logfile.flush()
 
-    for idx, rxcui in enumerate(rxcui_code_list):
-        rxnav.get_allrelated(rxcui)
-        # NOTE: the request caused the result to be queued to the Cache Writer
-        # ==> nothing more needs to be done.
-        rxnav.get_historical_rxcui(rxcui)
-        # As with 'allrelated', the act of making this call sends data to the Cache Writer
-        if idx % 1000 == 0:
-            print('[%s] Processed %d/%d RxCUIs, last was [%s]'
-                  % (get_timestamp_string(), (idx + 1), len(rxcui_code_list), rxcui_code_list[idx]),
-                  file=logfile)
-            logfile.flush()
+    rxcui_count = 0
+    deferred_urls = [] # failed requests, requested again at the end so the rest of the batches keep going
+    for rxcui_batch, refresh in iter(work_queue.get, None): # None ==> no more work
+        batch_urls = [rxnav.allrelated_url(x) for x in rxcui_batch] \
+                     + [rxnav.historical_rxcui_url(x) for x in rxcui_batch]
+        if refresh: # incremental build, cached results are out of date
+            rxnav.refresh_from_rest_api(batch_urls)
+        # request the whole batch concurrently, get_allrelated etc then find it
+        rxnav.prefetch_rxnav_data(batch_urls)
+        for rxcui in rxcui_batch:
+            for get_fn in [rxnav.get_allrelated, rxnav.get_historical_rxcui]:
+                try:
+                    get_fn(rxcui)
+                    # NOTE: the request caused the result to be queued to the Cache Writer
+                    # ==> nothing more needs to be done.
+                except rest_api_request_error as e:
+                    deferred_urls.append(e.request_url)
+        rxcui_count += len(rxcui_batch)
+        print('[%s] Processed %d RxCUIs, last batch was [%s] to [%s]'
+              % (get_timestamp_string(), rxcui_count, rxcui_batch[0], rxcui_batch[-1]),
+              file=logfile)
+        logfile.flush()
     # end processing rxcui_codes
+    retry_deferred_requests(rxnav, deferred_urls, log_filename, logfile)
+    rxnav.flush_cache_writer_batch() # send the last results to the Cache Writer
+    rxnav.send_telemetry()
 
-    print('[%s] Finished processing %d RxCUI codes ... terminating.' % (get_timestamp_string(), len(rxcui_code_list)),
+    print('[%s] Finished processing %d RxCUI codes ... terminating.' % (get_timestamp_string(), rxcui_count),
           file=logfile)
     logfile.flush()
     logfile.close()
@@ -185,17 +257,19 @@ def worker_task_rxcuis(mp_queue, worker_number, cache_filename, barrier, rxcui_c
 # end worker_task_rxcuis
 
 
-def worker_task_ndcs(mp_queue, worker_number, cache_filename, barrier, drug_rxcui_list, log_filename, utility_fns):
+def worker_task_ndcs(mp_queue, worker_number, cache_filename, barrier, work_queue, log_filename, utility_fns,
+                     rxnav_options):
     ''' NDC Worker -- determine NDC codes for drug RxCUI codes, results to Cache Writer '''
 
     logfile = io.open(log_filename, 'w', encoding='utf-8')
-    print('[%s] Worker %d -- processing %d RxCUI codes from [%s] to [%s]'
-          % (get_timestamp_string(), worker_number, len(drug_rxcui_list), drug_rxcui_list[0], drug_rxcui_list[-1]),
+    print('[%s] Worker %d -- processing batches of drug RxCUI codes from the work queue'
+          % (get_timestamp_string(), worker_number),
           file=logfile)
     logfile.flush()
     rxnav = rxnav_rest_api_mp(cache_filename, utility_fns, logfile, mp_queue,
                               readonly_access_to_cache=True,
-                              forward_result_to_cache_writer=True)
+                              forward_result_to_cache_writer=True,
+                              **rxnav_options)
 
     # At this point, we have initialized with the REST API, which means that the
     # initial contents of the cache file have been read.
@@ -206,20 +280,32 @@ def worker_task_ndcs(mp_queue, worker_number, cache_filename, barrier, drug_rxcu
     print('[%s] Passing barrier 2' % get_timestamp_string(), file=logfile);
     logfile.flush()
 
-    for idx, rxcui in enumerate(drug_rxcui_list):
-        rxnav.get_ndc_codes_for_drug(rxcui)
-        # NOTE: the request caused the result to be queued to the Cache Writer
-        # ==> nothing more needs to be done.
-        # As with 'allrelated', the act of making this call sends data to the Cache Writer
-        if idx % 1000 == 0:
-            print('[%s] Processed %d/%d drug RxCUIs, last was [%s]'
-                  % (get_timestamp_string(), (idx + 1), len(drug_rxcui_list), drug_rxcui_list[idx]),
-                  file=logfile)
-            logfile.flush()
+    drug_rxcui_count = 0
+    deferred_urls = [] # failed requests, requested again at the end so the rest of the batches keep going
+    for drug_rxcui_batch, refresh in iter(work_queue.get, None): # None ==> no more work
+        batch_urls = [rxnav.allhistoricalndcs_url(x) for x in drug_rxcui_batch]
+        if refresh: # incremental build, cached results are out of date
+            rxnav.refresh_from_rest_api(batch_urls)
+        rxnav.prefetch_rxnav_data(batch_urls) # whole batch at once
+        for rxcui in drug_rxcui_batch:
+            try:
+                rxnav.get_ndc_codes_for_drug(rxcui)
+                # NOTE: the request caused the result to be queued to the Cache Writer
+                # ==> nothing more needs to be done.
+            except rest_api_request_error as e:
+                deferred_urls.append(e.request_url)
+        drug_rxcui_count += len(drug_rxcui_batch)
+        print('[%s] Processed %d drug RxCUIs, last batch was [%s] to [%s]'
+              % (get_timestamp_string(), drug_rxcui_count, drug_rxcui_batch[0], drug_rxcui_batch[-1]),
+              file=logfile)
+        logfile.flush()
     # end processing rxcui_codes
+    retry_deferred_requests(rxnav, deferred_urls, log_filename, logfile)
+    rxnav.flush_cache_writer_batch() # send the last results to the Cache Writer
+    rxnav.send_telemetry()
 
     print('[%s] Finished processing %d drug RxCUI codes ... terminating.' % (
-    get_timestamp_string(), len(drug_rxcui_list)),
+    get_timestamp_string(), drug_rxcui_count),
           file=logfile)
     logfile.flush()
     logfile.close()
@@ -230,31 +316,87 @@ def worker_task_ndcs(mp_queue, worker_number, cache_filename, barrier, drug_rxcu
 # ------------------            Cache Writer            ----------------------------
 
 
-def cache_writer_task(mp_queue, cache_filename, log_filename, utility_fns):
-    ''' Cache Writer -- waits for cache messages on mp_queue, writes to cache file. '''
+def cache_writer_task(mp_queue, cache_filename, log_filename, utility_fns, rxnav_options, fsync_interval=0,
+                      telemetry_filename_prefix='./'):
+    '''
+    Cache Writer -- waits for cache messages on mp_queue, writes to cache file.
+    Each message is a batch of (request_url, json_result) results, written with one write.
+    fsync_interval > 0 ==> force the cache to disk at most every fsync_interval seconds.
+    Telemetry messages (request counts of each process) are summed into the telemetry files
+    (<telemetry_filename_prefix>telemetry.json/.prom) every telemetry_interval seconds, see rxnav_telemetry,
+    also while no messages arrive (the wait for a message ends in time for the next snapshot).
+    '''
 
     logfile = io.open(log_filename, 'w', encoding='utf-8')
     print('[%s] Starting Cache Writer' % get_timestamp_string(), file=logfile);
     logfile.flush()
     rxnav = rxnav_rest_api_mp(cache_filename, utility_fns, logfile, mp_queue,
                               readonly_access_to_cache=False,
-                              forward_result_to_cache_writer=False)
+                              forward_result_to_cache_writer=False,
+                              **rxnav_options)
+
+    def log_batch_statistics(): # throughput of the batches since the last report
+        elapsed_t = max(time.time() - report_start_t, 1e-6)
+        print('[%s] Wrote %d cache entries in %d batches -- last %d batches: %.1f entries/batch, %.1f KB/batch, '
+              '%.2f ms write/batch, %.1f entries/sec, %.1f KB/sec'
+              % (get_timestamp_string(), count, batch_count, report[0], report[1] / float(report[0]),
+                 report[2] / 1024.0 / report[0], report[3] * 1000.0 / report[0], report[1] / elapsed_t,
+                 report[2] / 1024.0 / elapsed_t), file=logfile)
+        logfile.flush()
 
-    count = 0
+    count = 0 # cache entries written
+    batch_count = 0
+    report = [0, 0, 0, 0.0] # batches, entries, bytes, write seconds since last report
+    report_start_t = last_fsync_t = last_telemetry_t = start_t = time.time()
+    telemetry_interval = rxnav_options.get('telemetry_interval', 0)
+    telemetry_snapshots = {} # source => latest snapshot of its request counts
     while True:
-        m = mp_queue.get()
-        if isinstance(m, list):  # message from Worker -- [request_url, json_result]
-            request_url, json_result_string = m
-            rxnav.write_cache_entry(request_url, json_result_string)
-            count += 1
-            if count % 1000 == 0:
-                print('Processed %d messages' % count, file=logfile);
-                logfile.flush()
+        try:
+            if telemetry_interval > 0:
+                m = mp_queue.get(timeout=max(last_telemetry_t + telemetry_interval - time.time(), 0.01))
+            else:
+                m = mp_queue.get()
+        except queue.Empty: # no message by the next telemetry snapshot
+            m = None
+        if isinstance(m, list):  # message from Worker -- [(request_url, json_result), ...]
+            write_start_t = time.time()
+            bytes_written = rxnav.write_cache_entries(m)
+            if fsync_interval > 0 and (time.time() - last_fsync_t) >= fsync_interval:
+                rxnav.flush_cache(fsync=True)
+                last_fsync_t = time.time()
+            count += len(m)
+            batch_count += 1
+            report = [report[0] + 1, report[1] + len(m), report[2] + bytes_written,
+                      report[3] + (time.time() - write_start_t)]
+            if report[1] >= 1000:
+                rxnav.flush_cache()
+                log_batch_statistics()
+                report, report_start_t = [0, 0, 0, 0.0], time.time()
+        elif isinstance(m, tuple) and m[0] == 'checkpoint': # manager -- phase done, record it once written
+            phase, input_hash, counts = m[1:]
+            rxnav.flush_cache(fsync=True) # everything sent before the checkpoint message is in the cache
+            counts['cache_entries'] = len(rxnav.rxnav_cache) # unique urls, as len() of the cache reopened
+            rxnav_checkpoint(cache_filename, rxnav_options['cache_backend']).mark_phase_complete(phase, input_hash,
+                                                                                                 counts)
+            print('[%s] Checkpoint: %s complete %s' % (get_timestamp_string(), phase, str(counts)), file=logfile)
+            logfile.flush()
+        elif isinstance(m, tuple) and m[0] == 'telemetry': # request counts of a worker (or manager, phase 0, 3)
+            source, snapshot = m[1:]
+            telemetry_snapshots[source] = snapshot # counts are cumulative, the latest replaces the earlier
         elif m == 'kill':  # manager is saying to stop, all workers have completed
             break
+        if telemetry_interval > 0 and (time.time() - last_telemetry_t) >= telemetry_interval:
+            write_telemetry_files(telemetry_filename_prefix, telemetry_snapshots, start_t)
+            last_telemetry_t = time.time()
     # end processing mp_queue
+    if report[0] > 0:
+        log_batch_statistics()
+    if telemetry_interval > 0:
+        write_telemetry_files(telemetry_filename_prefix, telemetry_snapshots, start_t)
+    rxnav.close_cache() # flush cache file, write compacted cache index
 
-    print('[%s] Processed %d cache messages' % (get_timestamp_string(), count), file=logfile)
+    print('[%s] Wrote %d cache entries in %d batches' % (get_timestamp_string(), count, batch_count),
+          file=logfile)
     print('[%s] Received kill message from manager process ... terminating.'
           % (get_timestamp_string(),), file=logfile)
     logfile.flush()
@@ -264,27 +406,37 @@ def cache_writer_task(mp_queue, cache_filename, log_filename, utility_fns):
 
 # Phase 0 task -- per RxCUI status values ==> ACTIVE/RETIRED/etc
 
+PHASE0_STATUS_VALUES = ["ACTIVE", "RETIRED", "NEVER%20ACTIVE", "NON-RXNORM"]
+
 def phase0_task(mp_queue,
                 log_filename,
                 cache_filename,
-                utility_fns):
+                utility_fns,
+                rxnav_options):
 
     logfile = io.open(log_filename, 'w', encoding='utf-8')
     print('[%s] Starting' % get_timestamp_string(), file=logfile);
     logfile.flush()
     rxnav = rxnav_rest_api_mp(cache_filename, utility_fns, logfile, mp_queue,
                               readonly_access_to_cache=True,
-                              forward_result_to_cache_writer=True)
-    rxnav.get_historical_rxcuis(target_status_values=["ACTIVE", "RETIRED", "NEVER%20ACTIVE","NON-RXNORM"], verbose=True)
+                              forward_result_to_cache_writer=True,
+                              **rxnav_options)
+    rxnav.get_historical_rxcuis(target_status_values=PHASE0_STATUS_VALUES, verbose=True)
+    rxnav.flush_cache_writer_batch() # send the last results to the Cache Writer
+    rxnav.send_telemetry()
 
 # end phase0_task
 
 # Phase 3 task -- VA Drug Class information
 
+VA_ROOT_CLASSID = 'VA000' # root of the VA class hierarchy
+
 def phase3_task(mp_queue,
                 log_filename,
                 cache_filename,
-                utility_fns):
+                utility_fns,
+                rxnav_options,
+                refresh=False): # refresh ==> incremental build, request the VA classes again
 
     def get_next_id():
         ''' Use the outer function next_id[0] integer value for the "next id", and then update it '''
@@ -324,7 +476,12 @@ def phase3_task(mp_queue,
         for va_classid in va_classids:
             node = va_node_d[va_classid]
             if node.data['children'] == 0:  # leaf VA classid code
-                rxnav.get_generic_drugs_for_VA_class(va_classid)
+                if refresh:
+                    rxnav.refresh_from_rest_api([rxnav.va_class_members_url(va_classid)])
+                try:
+                    rxnav.get_generic_drugs_for_VA_class(va_classid)
+                except rest_api_request_error as e:
+                    deferred_urls.append(e.request_url) # requested again at the end
         # end for va_classid loop
         return scd_rxcuis_for_va_classid_d
     # end cache_generic_drugs_for_VA_classes
@@ -335,10 +492,13 @@ def phase3_task(mp_queue,
     logfile.flush()
     rxnav = rxnav_rest_api_mp(cache_filename, utility_fns, logfile, mp_queue,
                               readonly_access_to_cache=True,
-                              forward_result_to_cache_writer=True)
+                              forward_result_to_cache_writer=True,
+                              **rxnav_options)
     # get VA drug classes
     print('Determine VA drug class hierarchy', file=logfile)
-    VA_classId = 'VA000'  # Aug 6, 2018 change, per Lee Peters, root code for VA classes
+    VA_classId = VA_ROOT_CLASSID  # Aug 6, 2018 change, per Lee Peters, root code for VA classes
+    if refresh:
+        rxnav.refresh_from_rest_api([rxnav.class_tree_url(VA_classId)])
     d = rxnav.get_class_tree(VA_classId)  # obtain VA hierarchy tree from NLM, VA hierarchy root 'VA000'
     # Determine VA classid set
     next_id = [1]
@@ -348,104 +508,143 @@ def phase3_task(mp_queue,
     va_node_d = {}
     build_va_folders(t, d['rxclassTree'])
     # Find generic drugs for VA class information and load into cache
+    deferred_urls = []
     cache_generic_drugs_for_VA_classes(rxnav, va_classid_set, va_node_d)
+    retry_deferred_requests(rxnav, deferred_urls, log_filename, logfile)
+    rxnav.flush_cache_writer_batch() # send the last results to the Cache Writer
+    rxnav.send_telemetry()
 
 # end phase3_task
 
 # -------------------- Part 1.  Building Cache file using REST API and Multiprocessing ------------
 
+def cache_is_complete(opts, logfile):
+    ''' All cache building phases are complete (checkpoint manifest), and the cache is unchanged since then '''
+    if opts.ignore_checkpoints or opts.incremental or not os.path.exists(opts.cache):
+        return False
+    checkpoint = rxnav_checkpoint(opts.cache, opts.cache_backend)
+    if checkpoint.get_phase('phase3') is None:
+        return False # not all phases complete, no need to look at the cache
+    cache_store = open_cache_store(opts.cache, logfile, opts.cache_backend)
+    cache_entries = len(cache_store)
+    cache_store.close()
+    return checkpoint.is_cache_complete(cache_entries)
+# end cache_is_complete
+
 def build_cache_file_using_multiprocessing(opts):
 
     # Local methods.
     # Implicitly depend on variables defined at the outer layer
     #  -- opts, logfile, rxnav, mp_queue, utility_fns
 
-    # PHASE 1 -- determine 'allrelated' and 'historicalrxcui' values
-    def phase1__get_allrelated_plus_historicalrxcui(rxcui_list):
+    # Dispatcher for PHASE 1 and PHASE 2 -- codes whose results are not yet in the cache, and codes whose
+    # cached results are out of date (refresh_codes, incremental build), are put on a work queue in small
+    # batches, the workers take the next batch whenever they are free.
+    def dispatch_to_workers(worker_task, code_list, urls_for_code, description, worker_log_name, barrier_name,
+                            refresh_codes=frozenset()):
+
+        refreshed_codes = [x for x in code_list if x in refresh_codes]
+        missing_codes = [x for x in code_list
+                         if x not in refresh_codes and not all((url in rxnav.rxnav_cache) for url in urls_for_code(x))]
+        remaining_codes = missing_codes + refreshed_codes
+        batch_size = opts.dispatch_batch_size
+        print('[%s] %s: %d of %d codes already in cache, dispatching %d codes (%d not in cache, %d refreshed)'
+              ' in batches of %d'
+              % (get_timestamp_string(), description, len(code_list) - len(remaining_codes), len(code_list),
+                 len(remaining_codes), len(missing_codes), len(refreshed_codes), batch_size), file=logfile)
+        logfile.flush()
+        if len(remaining_codes) == 0:
+            return 0, [] # Done, nothing to request
+
+        work_queue = mp.Queue()
+        for codes, refresh in [(missing_codes, False), (refreshed_codes, True)]:
+            for idx in range(0, len(codes), batch_size):
+                work_queue.put((codes[idx:(idx + batch_size)], refresh))
 
-        # Start workers to process RxCUI code segments
+        # Start workers to process the batches of codes
         # Wait for all to reach barrier ==> they have read initial contents of cache fle
         worker_process_count = opts.workers  # defaults to 4
+        for idx in range(worker_process_count):
+            work_queue.put(None) # one "no more work" marker for each worker
         print('[%s] Creating %d worker processes'
               % (get_timestamp_string(), worker_process_count), file=logfile)
         logfile.flush()
         barrier = mp.Barrier(worker_process_count + 1)  # workers and manager wait at barrier
-        rxcui_segsize = math.ceil(len(rxcui_list) / float(worker_process_count))  # RxCUIs per worker
         worker_processes = []
         for idx in range(worker_process_count):
             worker_number = idx + 1
-            worker_process = mp.Process(target=worker_task_rxcuis,
+            remove_failed_requests(opts.log_dir + (worker_log_name % worker_number)) # of an earlier run
+            worker_process = mp.Process(target=worker_task,
                                         args=(mp_queue,
                                               worker_number,
                                               opts.cache,
                                               barrier,
-                                              rxcui_list[(rxcui_segsize * idx):(rxcui_segsize * (idx + 1))],
-                                              opts.log_dir + ('rxcui_worker_%d.log' % worker_number),
-                                              utility_fns))
+                                              work_queue,
+                                              opts.log_dir + (worker_log_name % worker_number),
+                                              utility_fns,
+                                              rxnav_options))
             worker_process.start()
             worker_processes.append(worker_process)
         # end worker process creation loop
 
         # wait for workers to initialize, wait at same barrier that workers wait at.
         # At this point, all have read initial state of cache.  Go ahead and start adding to cache.
-        print('[%s] Waiting at barrier 1' % get_timestamp_string(), file=logfile);
+        print('[%s] Waiting at %s' % (get_timestamp_string(), barrier_name), file=logfile);
         logfile.flush()
         barrier.wait()
-        print('[%s] Passing barrier 1' % get_timestamp_string(), file=logfile);
+        print('[%s] Passing %s' % (get_timestamp_string(), barrier_name), file=logfile);
         logfile.flush()
 
         # wait for workers to finish
         for worker in worker_processes:
             worker.join()  # wait for termination
-        # workers have completed phase 1
+        failed_requests = []
+        for idx in range(worker_process_count):
+            failed_requests += read_failed_requests(opts.log_dir + (worker_log_name % (idx + 1)))
+        log_failed_requests(description, failed_requests)
+        return len(remaining_codes), failed_requests  # Done
+
+    # end dispatch_to_workers
+
+    def remove_failed_requests(log_filename):
+        if os.path.exists(failed_requests_filename(log_filename)):
+            os.remove(failed_requests_filename(log_filename))
+
+    def log_failed_requests(description, failed_requests):
+        ''' summary of the requests which failed permanently, they are not in the cache '''
+        if len(failed_requests) == 0:
+            return
+        print('[%s] %s: %d requests failed permanently, the phase is not recorded as complete'
+              ' (a rerun requests them again):' % (get_timestamp_string(), description, len(failed_requests)),
+              file=logfile)
+        for request_url, reason in failed_requests:
+            print('    %s -- %s' % (reason, request_url), file=logfile)
+        logfile.flush()
+        failed_urls = set(request_url for request_url, reason in all_failed_requests)
+        all_failed_requests.extend(x for x in failed_requests if x[0] not in failed_urls) # e.g. again in phase 2
+    # end log_failed_requests
 
+    # PHASE 1 -- determine 'allrelated' and 'historicalrxcui' values
+    def phase1__get_allrelated_plus_historicalrxcui(rxcui_list, refresh_rxcuis):
+        dispatched_count, failed_requests = dispatch_to_workers(worker_task_rxcuis, rxcui_list,
+                            lambda x: [rxnav.allrelated_url(x), rxnav.historical_rxcui_url(x)],
+                            'Phase 1', 'rxcui_worker_%d.log', 'barrier 1', refresh_rxcuis)
+        # workers have completed phase 1
         print('[%s] Done with Phase 1' % get_timestamp_string(), file=logfile);
         logfile.flush()
-        return  # Done
+        return dispatched_count, len(failed_requests)  # Done
 
     # end phase1
 
     # PHASE 2 -- determine NDC codes for drugs
-    def phase2__get_ndc_for_drugs(drug_rxcui_list):
-
-        # Start workers to determine NDC codes associated with RxCUI drug codes
-        worker_process_count = opts.workers  # defaults to 4
-        print('[%s] Creating %d NDC worker processes'
-              % (get_timestamp_string(), worker_process_count), file=logfile)
-        logfile.flush()
-        barrier = mp.Barrier(worker_process_count + 1)  # workers and manager wait at barrier
-        ndc_segsize = math.ceil(len(drug_rxcui_list) / float(worker_process_count))  # drug RxCUI count per worker
-        worker_processes = []
-        for idx in range(worker_process_count):
-            worker_number = idx + 1
-            worker_process = mp.Process(target=worker_task_ndcs,
-                                        args=(mp_queue,
-                                              worker_number,
-                                              opts.cache,
-                                              barrier,
-                                              drug_rxcui_list[(ndc_segsize * idx):(ndc_segsize * (idx + 1))],
-                                              opts.log_dir + ('ndc_worker_%d.log' % worker_number),
-                                              utility_fns))
-            worker_process.start()
-            worker_processes.append(worker_process)
-        # end worker process creation loop
-
-        # wait for workers to initialize, wait at same barrier that workers wait at.
-        # At this point, all have read initial state of cache.  Go ahead and start adding to cache.
-        print('[%s] Waiting at barrier 2' % get_timestamp_string(), file=logfile);
-        logfile.flush()
-        barrier.wait()
-        print('[%s] Passing barrier 2' % get_timestamp_string(), file=logfile);
-        logfile.flush()
-
-        # wait for workers to finish
-        for worker in worker_processes:
-            worker.join()  # wait for termination
+    def phase2__get_ndc_for_drugs(drug_rxcui_list, refresh_rxcuis):
+        dispatched_count, failed_requests = dispatch_to_workers(worker_task_ndcs, drug_rxcui_list,
+                            lambda x: [rxnav.allhistoricalndcs_url(x)],
+                            'Phase 2', 'ndc_worker_%d.log', 'barrier 2', refresh_rxcuis)
         # workers have completed phase 2
-
         print('[%s] Done with Phase 2' % get_timestamp_string(), file=logfile);
         logfile.flush()
-        return  # Done
+        return dispatched_count, len(failed_requests)  # Done
 
     # end phase2
 
@@ -455,44 +654,76 @@ def build_cache_file_using_multiprocessing(opts):
                                     args=(mp_queue,
                                           opts.log_dir + 'phase0.log',
                                           opts.cache,
-                                          utility_fns,))
+                                          utility_fns,
+                                          rxnav_options))
         worker_process.start()
         worker_process.join()  # wait for termination
 
     # end phase0
 
     # PHASE3 -- anything else needed in cache for i2b2 metadata
-    def phase3():
+    def phase3(refresh):
+        remove_failed_requests(opts.log_dir + 'phase3.log') # of an earlier run
         worker_process = mp.Process(target=phase3_task,
                                     args=(mp_queue,
                                           opts.log_dir + 'phase3.log',
                                           opts.cache,
-                                          utility_fns,))
+                                          utility_fns,
+                                          rxnav_options,
+                                          refresh))
         worker_process.start()
         worker_process.join()  # wait for termination
+        failed_requests = read_failed_requests(opts.log_dir + 'phase3.log')
+        log_failed_requests('Phase 3', failed_requests)
+        return len(failed_requests)
     # end phase3
 
+    def phase_is_complete(phase, input_hash): # checkpoint manifest says phase was done for the same input
+        if opts.ignore_checkpoints or len(phases_run) > 0 or not checkpoint.is_phase_complete(phase, input_hash):
+            phases_run.append(phase) # phases after this one use its results ==> they are run as well
+            return False
+        print('[%s] Skipping %s, completed %s with the same input (%s)'
+              % (get_timestamp_string(), phase, checkpoint.get_phase(phase)['completed'],
+                 str(checkpoint.get_phase(phase)['counts'])), file=logfile)
+        logfile.flush()
+        return True
+
+    # end phase_is_complete
+
+    def checkpoint_phase(phase, input_hash, counts):
+        # the Cache Writer records the checkpoint after writing everything sent before it
+        mp_queue.put(('checkpoint', phase, input_hash, counts))
+        return  # Done
+
+    # end checkpoint_phase
+
     def start_cache_writer():  # start Cache Writer
         cache_writer_process = mp.Process(target=cache_writer_task,
                                           args=(mp_queue,
                                                 opts.cache,
                                                 opts.log_dir + 'cache_writer.log',
-                                                utility_fns))
+                                                utility_fns,
+                                                rxnav_options,
+                                                opts.cache_fsync_interval,
+                                                opts.log_dir))
         cache_writer_process.start()
-        return  # Done
+        return cache_writer_process  # Done
 
     # end start_cache_writer
 
     def stop_cache_writer():  # stop Cache Writer
         mp_queue.put('kill')
+        cache_writer_process.join() # wait until the cache is completely written
+        mp_queue.close()
         return  # Done
 
     # end stop_cache_writer
 
-    def create_rxnav_object():
+    def create_rxnav_object(forward_result_to_cache_writer=False):
         rxnav = rxnav_rest_api_mp(opts.cache, utility_fns, logfile, mp_queue,
                                   readonly_access_to_cache=True,
-                                  forward_result_to_cache_writer=False)
+                                  forward_result_to_cache_writer=forward_result_to_cache_writer,
+                                  **rxnav_options)
         return rxnav  # Done
 
     # end create_rxnav_object
@@ -506,23 +737,29 @@ def build_cache_file_using_multiprocessing(opts):
     # end get_rxcuis_and_rxcuis_status_d
 
     def determine_drug_rxcui_set(rxnav, rxcuis, rxcuis_status_d):
+        ''' (drug RxCUI set, [(url, reason)] of the rxcuihistory requests which failed, RxCUIs skipped) '''
         drug_rxcui_set = set()
+        failed_requests = [] # phase 1 requests which failed permanently, requested again here and failed
         target_attributes = ['TTY']
         target_attributes_d = {nm: idx for idx, nm in enumerate(target_attributes)}
         for idx, rxcui in enumerate(rxcuis):
             if rxcuis_status_d[rxcui] == 'NON-RXNORM': continue  # not of interest, no tty, etc
             ''' It is now established that this is an RxNorm code '''
-            rxcui_attributes = rxnav.get_historical_rxcui_attributes(rxcui, target_attributes)  # tuple
+            try:
+                rxcui_attributes = rxnav.get_historical_rxcui_attributes(rxcui, target_attributes)  # tuple
+            except rest_api_request_error as e:
+                failed_requests.append((e.request_url, e.reason))
+                continue
             tty = rxcui_attributes[target_attributes_d['TTY']]
             if tty in ['SCD', 'SBD', 'GPCK', 'BPCK']:
                 drug_rxcui_set.add(rxcui)
-        return drug_rxcui_set  # Done
+        return drug_rxcui_set, failed_requests  # Done
 
     # end determine_drug_rxcui_set
 
-    def determine_rxcui_set():
+    def determine_rxcui_set(rxnav):
         # Determine historically comprehensive set of RxNorm codes from NLM (rxcuihistory api)
-        # NOTE: attributes not returned, only a set of codes
+        # NOTE: attributes not returned, only a set of codes, and the status of each
         # NOTE: skipping "NON-RXNORM" codes, which accounts for over 300,000 codes as of May 2018,
         #       which are all unrelated to the ingredient and drug RXCUI codes
         rxcui_set, rxcuis_status_d = \
@@ -542,37 +779,114 @@ def build_cache_file_using_multiprocessing(opts):
             print('[Sanity checking] Passed: No overlap of rxcuis and nonrxnorm_rxcuis, as expected.',
                   file=logfile)
         logfile.flush()
-        return rxcui_set  # Done
+        return rxcui_set, rxcuis_status_d  # Done
 
     # end determine_rxcui_set
 
+    def previous_status_lists_are_cached():
+        return all(rxnav.historical_status_url(x) in rxnav.rxnav_cache for x in PHASE0_STATUS_VALUES)
+
+    def determine_rxcui_set_incrementally():
+        # Incremental build -- the status lists of the previous run are in the cache, request the current
+        # status lists (sent to the Cache Writer, they replace the previous ones), compare them.
+        previous_rxcui_set, previous_rxcui_list, previous_status_d = get_rxcuis_and_rxcuis_status_d()
+        status_rxnav = create_rxnav_object(forward_result_to_cache_writer=True)
+        status_rxnav.refresh_from_rest_api([status_rxnav.historical_status_url(x) for x in PHASE0_STATUS_VALUES])
+        rxcui_set, rxcuis_status_d = determine_rxcui_set(status_rxnav)
+        status_rxnav.flush_cache_writer_batch()
+        status_rxnav.send_telemetry()
+        print('[%s] Incremental build: %d RxCUIs in the previous status lists, %d in the current ones'
+              % (get_timestamp_string(), len(previous_rxcui_set), len(rxcui_set)), file=logfile)
+        refresh_rxcuis, refresh_counts = determine_refresh_rxcuis(rxnav, previous_status_d, rxcuis_status_d,
+                                                                  opts.incremental_retired_months, logfile)
+        return rxcui_set, refresh_rxcuis, refresh_counts  # Done
+
+    # end determine_rxcui_set_incrementally
+
     # build_cache_file_using_multiprocessing:
     logfile = io.open(opts.log_dir + 'manager.log', 'w', encoding='utf-8')
     print('Starting', file=logfile);
     logfile.flush()
-    f = io.open(opts.cache, 'a+', encoding='utf-8')  # create cache file if it does not exist, else open append
-    f.close()  # the only point was to ensure the file exists
-    manager = mp.Manager()  # multiprocessing initialization
-    mp_queue = manager.Queue()  # create shared Queue, used by manager, workers, Cache Writer
+    # Create the cache if it does not exist.  For the file backend, bring the cache index up to date
+    # (e.g. cache from an earlier version, or a crash), so every process created below finds the
+    # cache contents with one read of the index instead of reading the cache file.
+    prepare_cache_store(opts.cache, logfile, opts.cache_backend)
+    # create shared queue (--cache_transport), used by manager, workers, Cache Writer
+    mp_queue = create_cache_transport(opts.cache_transport, opts.shm_buffer_mb * 1024 * 1024)
     utility_fns = utility_functions()  # needed by rxnav interface -- e.g. flatten fn
+    # REST API requests of all processes are paced together (--rate_limit), see rxnav_rate_limiter
+    rate_limiter = shared_rate_limiter(opts.rate_limit, max(1, opts.workers) * max(1, opts.max_in_flight)) \
+                   if opts.rate_limit > 0 else None
+    rxnav_options = get_rxnav_options(opts, rate_limiter) # for every rxnav object of the build
+    if opts.rest_api_base_url:
+        print('[%s] REST API requests are sent to %s (cached under the URLs of %s)'
+              % (get_timestamp_string(), opts.rest_api_base_url, RXNAV_REST_API_BASE_URL), file=logfile)
+        logfile.flush()
     rxnav = create_rxnav_object()  # Initialize with NLM's REST API interface class
-    rxcui_set = determine_rxcui_set()  # Determine all RxNORM RxCUI codes, excludes NON-RXNORM
-    rxcui_list = sorted(list(rxcui_set))  # values are distributed to workers in sorted order, easy to follow
-
-    # MAIN processing logic:
-    start_cache_writer()  # start the Cache Writer
-    phase0() # get per RxCUI status -- ACTIVE/RETIRED/etc
-    phase1__get_allrelated_plus_historicalrxcui(rxcui_list)  # get 'allrelated' and 'historicalrxcui' results
-    # Get a new rxnav object, which will re-read cache file, now with 'historicalrxcuis' and 'allrelated' elements.
-    print('[%s] Creating new rxnav object, read the updated cache file' % get_timestamp_string(), file=logfile)
-    logfile.flush()
-    rxnav = create_rxnav_object()  # generate a new rxnav object, re-reads the updated cahe file
-    rxcui_set, rxcui_list, rxcuis_status_d = get_rxcuis_and_rxcuis_status_d()
-    drug_rxcui_set = determine_drug_rxcui_set(rxnav, rxcui_list, rxcuis_status_d)
-    drug_rxcui_list = list(drug_rxcui_set)
-    phase2__get_ndc_for_drugs(drug_rxcui_list)  # get NDC codes associated with drug RxCUIs
-    phase3() # anything else needed in cache for i2b2 metadata
-    stop_cache_writer()  # stop the Cache Writer
+    checkpoint = rxnav_checkpoint(opts.cache, opts.cache_backend) # phases completed by earlier runs
+    phases_run = [] # phases run (not skipped) by this run
+    all_failed_requests = [] # [(url, reason)] of requests which failed permanently, see log_failed_requests
+    cache_writer_process = start_cache_writer()  # start the Cache Writer
+
+    try: # the Cache Writer is stopped whatever happens, it waits for the 'kill' message otherwise
+        incremental = opts.incremental and previous_status_lists_are_cached()
+        if opts.incremental and not incremental:
+            print('[%s] Incremental build: no status lists of a previous run in the cache ==> full build'
+                  % get_timestamp_string(), file=logfile)
+            logfile.flush()
+        if incremental: # Determine all RxNORM RxCUI codes, and those whose cached results are out of date
+            rxcui_set, refresh_rxcui_set, refresh_counts = determine_rxcui_set_incrementally()
+        else:
+            # Determine all RxNORM RxCUI codes, excludes NON-RXNORM
+            rxcui_set, rxcuis_status_d = determine_rxcui_set(rxnav)
+            refresh_rxcui_set = frozenset()
+        rxcui_list = sorted(list(rxcui_set))  # values are distributed to workers in sorted order, easy to follow
+        rxcui_list_hash = code_set_hash(rxcui_list) # phases 1 and 2 are determined by the RxCUI codes
+
+        # MAIN processing logic:
+        if incremental: # the current status lists were requested above, phase 0 is done
+            phases_run.append('phase0') # the phases after it are run as well
+            checkpoint_phase('phase0', code_set_hash(PHASE0_STATUS_VALUES), {'rxcuis': len(rxcui_list),
+                                                                              'incremental': refresh_counts})
+        elif not phase_is_complete('phase0', code_set_hash(PHASE0_STATUS_VALUES)):
+            phase0() # get per RxCUI status -- ACTIVE/RETIRED/etc
+            checkpoint_phase('phase0', code_set_hash(PHASE0_STATUS_VALUES), {'rxcuis': len(rxcui_list)})
+        if not phase_is_complete('phase1', rxcui_list_hash):
+            dispatched_count, failed_count = phase1__get_allrelated_plus_historicalrxcui(rxcui_list, refresh_rxcui_set)
+            # got 'allrelated' and 'historicalrxcui' results
+            if failed_count == 0: # otherwise results are missing from the cache ==> a rerun runs the phase again
+                checkpoint_phase('phase1', rxcui_list_hash, {'rxcuis': len(rxcui_list), 'dispatched': dispatched_count})
+        if not phase_is_complete('phase2', rxcui_list_hash):
+            # Get a new rxnav object, which will re-read cache file, now with 'historicalrxcuis'
+            # and 'allrelated' elements.
+            print('[%s] Creating new rxnav object, read the updated cache file' % get_timestamp_string(), file=logfile)
+            logfile.flush()
+            rxnav.send_telemetry() # counts of the rxnav object being replaced
+            rxnav = create_rxnav_object()  # generate a new rxnav object, re-reads the updated cahe file
+            rxcui_set, rxcui_list, rxcuis_status_d = get_rxcuis_and_rxcuis_status_d()
+            drug_rxcui_set, drug_failed_requests = determine_drug_rxcui_set(rxnav, rxcui_list, rxcuis_status_d)
+            log_failed_requests('Phase 2 (drug codes)', drug_failed_requests)
+            drug_rxcui_list = sorted(drug_rxcui_set) # dispatched in sorted order, easy to follow
+            dispatched_count, failed_count = \
+                phase2__get_ndc_for_drugs(drug_rxcui_list, # get NDC codes associated with drug RxCUIs
+                                          drug_rxcui_set & refresh_rxcui_set)
+            if failed_count == 0 and len(drug_failed_requests) == 0: # a skipped RxCUI may be a drug
+                checkpoint_phase('phase2', rxcui_list_hash, {'drug_rxcuis': len(drug_rxcui_list),
+                                                             'drug_rxcuis_hash': code_set_hash(drug_rxcui_list),
+                                                             'dispatched': dispatched_count})
+        if not phase_is_complete('phase3', code_set_hash([VA_ROOT_CLASSID])):
+            if phase3(incremental) == 0: # anything else needed in cache for i2b2 metadata
+                checkpoint_phase('phase3', code_set_hash([VA_ROOT_CLASSID]), {})
+        rxnav.send_telemetry()
+    finally:
+        stop_cache_writer()  # stop the Cache Writer
+    if opts.telemetry_interval > 0:
+        log_telemetry_summary(opts.log_dir, logfile) # request counts of all processes, as last written
+    if rate_limiter is not None:
+        print('[Rate limiter] %s' % str(rate_limiter.get_statistics()), file=logfile)
+    if len(all_failed_requests) > 0:
+        print('[%s] %d requests failed permanently (listed above), the cache is incomplete -- run again'
+              ' to request them' % (get_timestamp_string(), len(all_failed_requests)), file=logfile)
     print('[%s] Terminating' % get_timestamp_string(), file=logfile);
     logfile.flush()
 
@@ -665,101 +979,143 @@ class pcori_meds_first_level_metadata_builder():
 # ------------------            Cache Writer            ----------------------------
 
 
+def find_missing_cache_urls(rxnav, logfile):
+    '''
+    --from_cache_only: determine the REST API results needed for the metadata which are not in the cache,
+    all of them, instead of failing on the first one while building the metadata.
+    Follows the same steps as building the cache: status lists ==> RxCUI codes ==> 'allrelated' and
+    'rxcuihistory' results ==> drug RxCUI codes ==> NDC results, and the VA class tree ==> VA class members.
+    Returns the list of missing urls.
+    '''
+    in_cache = lambda url: url in rxnav.rxnav_cache
+    status_urls = [rxnav.historical_status_url(x) for x in ["ACTIVE", "RETIRED", "NEVER%20ACTIVE", "NON-RXNORM"]]
+    missing_urls = [x for x in status_urls if not in_cache(x)]
+    if len(missing_urls) > 0:
+        return missing_urls # without the status lists, the RxCUI codes are not known
+    rxcui_set, rxcuis_status_d = \
+        rxnav.get_historical_rxcuis(target_status_values=["ACTIVE", "RETIRED", "NEVER%20ACTIVE"])
+    for rxcui in sorted(rxcui_set):
+        missing_urls.extend(x for x in [rxnav.allrelated_url(rxcui), rxnav.historical_rxcui_url(rxcui)]
+                            if not in_cache(x))
+        if in_cache(rxnav.historical_rxcui_url(rxcui)): # can determine whether it is a drug
+            rxcui_attributes = rxnav.get_historical_rxcui_attributes(rxcui, ['TTY'])
+            if rxcui_attributes and rxcui_attributes[0] in ['SCD', 'SBD', 'GPCK', 'BPCK'] \
+                    and not in_cache(rxnav.allhistoricalndcs_url(rxcui)):
+                missing_urls.append(rxnav.allhistoricalndcs_url(rxcui))
+    print('[%s] Checked cache for the results of %d RxCUI codes' % (get_timestamp_string(), len(rxcui_set)),
+          file=logfile)
+    logfile.flush()
+
+    def va_leaf_classids(tlist): # leaf VA classes of the class tree, see va_metadata_builder
+        for x in tlist:
+            if 'rxclassTree' in x:
+                for va_classid in va_leaf_classids(x['rxclassTree']):
+                    yield va_classid
+            else:
+                yield x['rxclassMinConceptItem']['classId']
+
+    if not in_cache(rxnav.class_tree_url(VA_ROOT_CLASSID)):
+        missing_urls.append(rxnav.class_tree_url(VA_ROOT_CLASSID))
+    else:
+        d = rxnav.get_class_tree(VA_ROOT_CLASSID)
+        missing_urls.extend(rxnav.va_class_members_url(x) for x in va_leaf_classids(d['rxclassTree'])
+                            if not in_cache(rxnav.va_class_members_url(x)))
+    return missing_urls
+# end find_missing_cache_urls
+
+def report_missing_cache_urls(opts, rxnav, logfile):
+    ''' --from_cache_only: list all missing REST API results in <log_dir>missing_cache_urls.txt, then fail '''
+    missing_urls = find_missing_cache_urls(rxnav, logfile)
+    if len(missing_urls) == 0:
+        print('[%s] All REST API results needed are in the cache' % get_timestamp_string(), file=logfile)
+        logfile.flush()
+        return
+    missing_urls_filename = opts.log_dir + 'missing_cache_urls.txt'
+    with io.open(missing_urls_filename, 'w', encoding='utf-8') as f:
+        for url in missing_urls:
+            print(url, file=f)
+    message = '%d REST API results needed for the metadata are not in the cache [%s], see [%s]' \
+              % (len(missing_urls), opts.cache, missing_urls_filename)
+    print('*** %s ***' % message, file=logfile)
+    logfile.flush()
+    raise ValueError(message)
+# end report_missing_cache_urls
+
+# ------------------ Metadata Writer steps, also run by benchmark_metadata_build.py ------------------
+
+def ingredient_rxcui_set_from_attributes(attribute_table):
+    return attribute_table.get_rxcuis_with_tty(['IN', 'MIN', 'PIN'])
+
+# end ingredient_rxcui_set_from_attributes
+
+def drug_rxcui_set_from_attributes(attribute_table):
+    return attribute_table.get_rxcuis_with_tty(['SCD', 'SBD', 'GPCK', 'BPCK'])
+
+# end drug_rxcui_set_from_attributes
+
+def post_process(va_metadata_rows, ingred_metadata_rows):
+    # PostProcess VA metadata, find ingredients whose RXCUI sets differ in VA versus 'by ingredient'
+    #     ==> add '(VA subset)' to c_name of ingredient (directly modify metadata row)
+    #     NOTE: need both VA and by-ingredient metadata rows to perform this comparison ==> "post-processing"
+    #     NOTE: use sorted lists rather than processing .keys(), faster
+
+    # embedded methods
+
+    def find_positions_of_subpaths(sorted_paths, path):
+        startpos = sorted_paths.index(path) + 1
+        listsize = len(sorted_paths)
+        if startpos >= listsize or (not sorted_paths[startpos].startswith(path)):
+            startpos, endpos = (listsize, listsize)
+        else:  # we know at least one subpath exists
+            endpos = startpos
+            idx = startpos + 1  # we know [startpos] starts with path, move on
+            while idx < listsize:
+                if sorted_paths[idx].startswith(path):
+                    endpos += 1  # this element starts with path
+                    idx += 1  # move on
+                else:
+                    break  # doesnt start with path, not subpath -- done
+        return (startpos, endpos)
+    # end find_positions_of_subpaths
+
+    # post_process:
+    va_paths = sorted(va_metadata_rows.keys())  # ALL paths in VA classes folders (sorted) => VA+RXNORM+NDC codes
+    by_paths = sorted(ingred_metadata_rows.keys())  # ALL paths in ingredients (alphabetized) folders (sorted)
+    va_ingred_paths = {va_metadata_rows[x]['rxcui']: x for x in va_metadata_rows.keys()
+                       if (va_metadata_rows[x]['tty'] in ['IN'])}
+    by_ingred_paths = {ingred_metadata_rows[x]['rxcui']: x for x in ingred_metadata_rows.keys()
+                       if (ingred_metadata_rows[x]['tty'] in ['IN'])}
+    va_name_change_count = 0
+    for ingred_rxcui in sorted(va_ingred_paths.keys()):
+        va_path = va_ingred_paths[ingred_rxcui]
+        va_paths_startpos, va_paths_endpos = find_positions_of_subpaths(va_paths, va_path)
+        va_rxnorm_codes = set(
+            va_metadata_rows[x]['c_basecode'] for x in va_paths[va_paths_startpos:va_paths_endpos + 1]
+            if (va_metadata_rows[x]['c_basecode'].startswith('RXNORM:')))
+        by_path = by_ingred_paths[ingred_rxcui]
+        by_paths_startpos, by_paths_endpos = find_positions_of_subpaths(by_paths, by_path)
+        by_rxnorm_codes = set(
+            ingred_metadata_rows[x]['c_basecode'] for x in by_paths[by_paths_startpos:by_paths_endpos + 1]
+            if (ingred_metadata_rows[x]['c_basecode'].startswith('RXNORM:')))
+        if va_rxnorm_codes != by_rxnorm_codes:  # see if difference in RxCUI code sets
+            va_metadata_rows[va_path]['c_name'] += ' (VA subset)'
+            va_name_change_count += 1
+    # end for ingred_rxcui
+    print('[[NOTE: changed %d VA metadata rows to (VA subset), differences with by-ingredient RXCUI sets]]' %
+          va_name_change_count)
+
+# end post_process
+
+
 def metadata_writer_task(opts): # this is NOT a class, even though large, no __init__
     ''' Metadata Writer -- reads from NLM REST API cache and creates i2b2 metadata from that information '''
 
     from rxnorm_code_maps import rxnorm_code_maps
+    from rxcui_attribute_table import rxcui_attribute_table
     from ingredient_metadata_builder import ingredient_metadata_builder
     from modifier_metadata_builder import modifier_metadata_builder
     from va_metadata_builder import va_metadata_builder
-    from metadata_writer import metadata_writer
-
-    # Local methods.
-    # Implicitly depend on variables defined at the outer layer
-    #  -- opts
-
-    def determine_ingredient_rxcui_set(rxnav, rxcuis, rxcuis_status_d):
-        ingredient_rxcui_set = set()
-        target_attributes = ['TTY']
-        target_attributes_d = {nm: idx for idx, nm in enumerate(target_attributes)}
-        for idx, rxcui in enumerate(rxcuis):
-            if rxcuis_status_d[rxcui] == 'NON-RXNORM': continue  # not of interest, no tty, etc
-            ''' It is now established that this is an RxNorm code '''
-            rxcui_attributes = rxnav.get_historical_rxcui_attributes(rxcui, target_attributes)  # tuple
-            tty = rxcui_attributes[target_attributes_d['TTY']]
-            if tty in ['IN', 'MIN', 'PIN']:
-                ingredient_rxcui_set.add(rxcui)
-        return ingredient_rxcui_set
-
-    # end determine_ingredient_rxcui_set
-
-    def determine_drug_rxcui_set(rxnav, rxcuis, rxcuis_status_d):
-        drug_rxcui_set = set()
-        target_attributes = ['TTY']
-        target_attributes_d = {nm: idx for idx, nm in enumerate(target_attributes)}
-        for idx, rxcui in enumerate(rxcuis):
-            if rxcuis_status_d[rxcui] == 'NON-RXNORM': continue  # not of interest, no tty, etc
-            ''' It is now established that this is an RxNorm code '''
-            rxcui_attributes = rxnav.get_historical_rxcui_attributes(rxcui, target_attributes)  # tuple
-            tty = rxcui_attributes[target_attributes_d['TTY']]
-            if tty in ['SCD', 'SBD', 'GPCK', 'BPCK']:
-                drug_rxcui_set.add(rxcui)
-        return drug_rxcui_set
-
-    # end determine_drug_rxcui_set
-
-    def post_process(va_metadata_rows, ingred_metadata_rows):
-        # PostProcess VA metadata, find ingredients whose RXCUI sets differ in VA versus 'by ingredient'
-        #     ==> add '(VA subset)' to c_name of ingredient (directly modify metadata row)
-        #     NOTE: need both VA and by-ingredient metadata rows to perform this comparison ==> "post-processing"
-        #     NOTE: use sorted lists rather than processing .keys(), faster
-
-        # embedded methods
-
-        def find_positions_of_subpaths(sorted_paths, path):
-            startpos = sorted_paths.index(path) + 1
-            listsize = len(sorted_paths)
-            if startpos >= listsize or (not sorted_paths[startpos].startswith(path)):
-                startpos, endpos = (listsize, listsize)
-            else:  # we know at least one subpath exists
-                endpos = startpos
-                idx = startpos + 1  # we know [startpos] starts with path, move on
-                while idx < listsize:
-                    if sorted_paths[idx].startswith(path):
-                        endpos += 1  # this element starts with path
-                        idx += 1  # move on
-                    else:
-                        break  # doesnt start with path, not subpath -- done
-            return (startpos, endpos)
-        # end find_positions_of_subpaths
-
-        # post_process:
-        va_paths = sorted(va_metadata_rows.keys())  # ALL paths in VA classes folders (sorted) => VA+RXNORM+NDC codes
-        by_paths = sorted(ingred_metadata_rows.keys())  # ALL paths in ingredients (alphabetized) folders (sorted)
-        va_ingred_paths = {va_metadata_rows[x]['rxcui']: x for x in va_metadata_rows.keys()
-                           if (va_metadata_rows[x]['tty'] in ['IN'])}
-        by_ingred_paths = {ingred_metadata_rows[x]['rxcui']: x for x in ingred_metadata_rows.keys()
-                           if (ingred_metadata_rows[x]['tty'] in ['IN'])}
-        va_name_change_count = 0
-        for ingred_rxcui in sorted(va_ingred_paths.keys()):
-            va_path = va_ingred_paths[ingred_rxcui]
-            va_paths_startpos, va_paths_endpos = find_positions_of_subpaths(va_paths, va_path)
-            va_rxnorm_codes = set(
-                va_metadata_rows[x]['c_basecode'] for x in va_paths[va_paths_startpos:va_paths_endpos + 1]
-                if (va_metadata_rows[x]['c_basecode'].startswith('RXNORM:')))
-            by_path = by_ingred_paths[ingred_rxcui]
-            by_paths_startpos, by_paths_endpos = find_positions_of_subpaths(by_paths, by_path)
-            by_rxnorm_codes = set(
-                ingred_metadata_rows[x]['c_basecode'] for x in by_paths[by_paths_startpos:by_paths_endpos + 1]
-                if (ingred_metadata_rows[x]['c_basecode'].startswith('RXNORM:')))
-            if va_rxnorm_codes != by_rxnorm_codes:  # see if difference in RxCUI code sets
-                va_metadata_rows[va_path]['c_name'] += ' (VA subset)'
-                va_name_change_count += 1
-        # end for ingred_rxcui
-        print('[[NOTE: changed %d VA metadata rows to (VA subset), differences with by-ingredient RXCUI sets]]' %
-              va_name_change_count)
-
-    # end post_process
+    from metadata_writer import metadata_writer, write_metadata_delta
 
     # ------ metadata_writer_task <start>: ---------
     logfile = io.open(opts.log_dir + 'metadata_writer.log', 'w', encoding='utf-8')
@@ -768,7 +1124,11 @@ def metadata_writer_task(opts): # this is NOT a class, even though large, no __i
     rxnav = rxnav_rest_api_mp(opts.cache, utility_fns, logfile, None,
                               readonly_access_to_cache=True,
                               forward_result_to_cache_writer=False,
-                              fail_if_not_in_cache=True)
+                              fail_if_not_in_cache=True,
+                              cache_backend=opts.cache_backend,
+                              allrelated_lru_size=opts.allrelated_lru_size)
+    if opts.from_cache_only: # find all missing results before starting
+        report_missing_cache_urls(opts, rxnav, logfile)
 
     # Determine historically comprehensive set of RxNorm codes from NLM (rxcuihistory api)
     # NOTE: attributes not returned, only a set of codes
@@ -793,28 +1153,16 @@ def metadata_writer_task(opts): # this is NOT a class, even though large, no __i
         print('[Sanity check] Passed: No overlap of rxcuis and nonrxnorm_rxcuis, as expected.', file=logfile)
     # Obtain historical information for each RXCUI, needed to build RXNORM.csv ==>
     #    name, type, dates, establish category INGREDIENT, DRUG, OTHER
-    rxcui_count = len(rxcui_set)
-    print('Extracting attributes definitions for the %d historical RxCUI codes from the NLM' % rxcui_count,
-          file=logfile)
-    logfile.flush()
-    rxcui_d = {}
-    for idx, rxcui in enumerate(rxcui_set):  # integer rxcui value
-        if (idx + 1) % 10000 == 0:  # Track progress
-            print('[%s] Obtaining definition for rxcui %d of %d, %s%%' \
-                  % (time.strftime("%Y-%m-%d %H:%M:%S"),
-                     idx + 1, rxcui_count, str(round(((idx + 1) / rxcui_count) * 100, 3))),
-                  file=logfile)
-            logfile.flush()
-        d = rxnav.get_historical_rxcui(rxcui)
-        rxcui_d[rxcui] = d  # save NLM's definition of RxCUI, from rxcuihistory api
-    print('[Done extracting RxCUI attribute definitions, found: %d]' % len(rxcui_d), file=logfile)
+    # Each 'rxcuihistory' result is parsed once, into the attribute table used from here on.
+    print('Compiling attributes for the %d historical RxCUI codes from the NLM' % len(rxcui_set), file=logfile)
     logfile.flush()
+    attribute_table = rxcui_attribute_table(rxnav, rxcui_set, logfile)
 
     ''' Establish set of ingredient and drug codes '''
-    ingredient_rxcui_set = determine_ingredient_rxcui_set(rxnav, rxcui_set, rxcuis_status_d)
-    drug_rxcui_set = determine_drug_rxcui_set(rxnav, rxcui_set, rxcuis_status_d)
+    ingredient_rxcui_set = ingredient_rxcui_set_from_attributes(attribute_table)
+    drug_rxcui_set = drug_rxcui_set_from_attributes(attribute_table)
     ''' build maps of ingredients and drugs '''
-    rxnorm_coding = rxnorm_code_maps(rxnav, ingredient_rxcui_set, drug_rxcui_set)
+    rxnorm_coding = rxnorm_code_maps(rxnav, ingredient_rxcui_set, drug_rxcui_set, attribute_table=attribute_table)
     ingredient_to_drug_set_map = rxnorm_coding.get_ingredient_to_drug_set_map()
 
     # build metadata - information is gathered
@@ -851,14 +1199,22 @@ def metadata_writer_task(opts): # this is NOT a class, even though large, no __i
                                       include_tty=opts.include_tty,
                                       csv_fields_file=opts.csv_fields_file,
                                       csv_fields_file_delim=opts.csv_fields_file_delim,
-                                      strftime_format=opts.strftime_format)
+                                      strftime_format=opts.strftime_format,
+                                      format_workers=(opts.workers if opts.parallel_format else 0))
     if opts.add_provenance: # PROVENANCE folder
         metadata_writer.write_metadata_rows(provenance_metadata_rows)
     metadata_writer.write_metadata_rows(modifier_rows) # MODIFIER metadata
     if not opts.only_by_ingredient:
         metadata_writer.write_metadata_rows(va_meds_row)
-        metadata_writer.write_metadata_rows(va_metadata_rows)
-    metadata_writer.write_metadata_rows(ingred_metadata_rows)  # always write by-ingredient meds
+        metadata_writer.write_sorted_metadata_rows(va_metadata_builder.get_metadata_rows()) # NDC rows generated
+    metadata_writer.write_sorted_metadata_rows(ingred_metadata_builder.get_metadata_rows()) # always, by-ingredient
+    metadata_writer.close()
+    if opts.previous_output: # rows to insert, update, delete in the i2b2 table loaded from the previous output
+        delta_fn_prefix = os.path.splitext(metadata_fn)[0]
+        delta_counts = write_metadata_delta(opts.previous_output, metadata_fn, delta_fn_prefix)
+        print('[%s] Metadata delta from [%s]: %d rows to insert, %d to update, %d to delete -- %s.<kind>.txt'
+              % (get_timestamp_string(), opts.previous_output, delta_counts['insert'], delta_counts['update'],
+                 delta_counts['delete'], delta_fn_prefix), file=logfile)
 
     print('[%s] Finished writing i2b2 metadata ... terminating.'
           % (get_timestamp_string(),), file=logfile)
@@ -899,12 +1255,34 @@ def main():  # need separate main() for use of subprocess and task definitions i
         import optparse
         opt = optparse.OptionParser()
         opt.add_option('--cache', action='store', default='rxcui.cache')
+        opt.add_option('--cache_backend', action='store', type='choice', choices=CACHE_BACKENDS, default='file')
         opt.add_option('--output_dir', action='store', default='./')
         opt.add_option('--output_filename', action='store', default='rxnorm_ndc.txt')
         opt.add_option('--append', action='store_true')
+        opt.add_option('--parallel_format', action='store_true') # format the output rows with --workers processes
+        opt.add_option('--previous_output', action='store') # previous metadata file (or .rowindex) ==> delta files
         opt.add_option('--log_dir', action='store', default='./')
         opt.add_option('--rxcui_relationships_csv', action='store')
         opt.add_option('--workers', action='store', type=int, default=4)
+        opt.add_option('--dispatch_batch_size', action='store', type=int, default=250) # RxCUIs per work queue entry
+        opt.add_option('--max_in_flight', action='store', type=int, default=16) # concurrent requests per worker
+        opt.add_option('--rate_limit', action='store', type=float, default=20) # requests/sec, all processes, 0 ==> no limit
+        opt.add_option('--retry_limit', action='store', type=int, default=6) # attempts of a failing request
+        opt.add_option('--retry_max_backoff', action='store', type=float, default=60) # seconds between attempts
+        opt.add_option('--rest_api_base_url', action='store') # e.g. http://127.0.0.1:8765/REST, rxnav_local_server.py
+        opt.add_option('--http_pool_size', action='store', type=int, default=0) # 0 ==> same as --max_in_flight
+        opt.add_option('--http_idle_timeout', action='store', type=int, default=60) # seconds
+        opt.add_option('--cache_batch_size', action='store', type=int, default=64) # results per Cache Writer message
+        opt.add_option('--cache_batch_latency', action='store', type=float, default=2.0) # seconds, max wait to send
+        opt.add_option('--cache_fsync_interval', action='store', type=float, default=0) # seconds, 0 ==> never fsync
+        opt.add_option('--cache_transport', action='store', type='choice', choices=CACHE_TRANSPORTS, default='queue')
+        opt.add_option('--shm_buffer_mb', action='store', type=int, default=64) # --cache_transport shm buffer size
+        opt.add_option('--ignore_checkpoints', action='store_true') # redo phases the checkpoint manifest says are done
+        opt.add_option('--from_cache_only', action='store_true') # build metadata from the cache, no REST API requests
+        opt.add_option('--incremental', action='store_true') # refresh only codes which may have changed
+        opt.add_option('--incremental_retired_months', action='store', type=int, default=12) # see rxnav_incremental
+        opt.add_option('--telemetry_interval', action='store', type=float, default=60) # seconds, 0 ==> no telemetry
+        opt.add_option('--allrelated_lru_size', action='store', type=int, default=100000) # digested results kept
         opt.add_option('--verbose', action='store_true')
         opt.add_option('--logfile', action='store', default='-')
         opt.add_option('--only_by_ingredient', action='store_true')
@@ -921,6 +1299,9 @@ def main():  # need separate main() for use of subprocess and task definitions i
         for folder_name in [opts.output_dir, opts.log_dir]:
             if folder_name[-1] != '/': folder_name += '/'  # folder spec, so we can append filename always
         opts.output = opts.output_dir + opts.output_filename # create folder+filename
+        if opts.previous_output and is_metadata_file_of(opts.previous_output, opts.output):
+            opt.error('--previous_output [%s] is the output of this build (or its row index), which is overwritten'
+                      ' -- rename the previous output first' % opts.previous_output)
         if opts.verbose:
             print('opts are %s' % str(opts))
         return opts, args  # Done
@@ -932,10 +1313,20 @@ def main():  # need separate main() for use of subprocess and task definitions i
     logfile = io.open(opts.log_dir + 'build.log', 'w', encoding='utf-8')
     print('[%s] Step 1 ==> Creating cache of needed REST API call values' % get_timestamp_string(), file=logfile)
     logfile.flush()
-    build_cache_file_using_multiprocessing(opts) # historicalrxcui and getall related
+    if opts.from_cache_only:
+        print('[%s] --from_cache_only ==> using the cache as is, no REST API requests'
+              % get_timestamp_string(), file=logfile)
+    elif cache_is_complete(opts, logfile):
+        print('[%s] Checkpoint manifest [%s] ==> cache is complete, not rebuilding it'
+              % (get_timestamp_string(), opts.cache + '.manifest.json'), file=logfile)
+    else:
+        build_cache_file_using_multiprocessing(opts) # historicalrxcui and getall related
     print('[%s] Step 2 ==> Creating i2b2 metadata from the cached information' % get_timestamp_string(), file=logfile)
     logfile.flush()
-    build_i2b2_metadata_from_cache_file(opts)
+    if opts.from_cache_only:
+        metadata_writer_task(opts) # in this process, no multiprocessing set up
+    else:
+        build_i2b2_metadata_from_cache_file(opts)
     print('[%s] Completion.  Metadata created ... terminating.' % get_timestamp_string(), file=logfile)
     logfile.flush()
     print('Finished creating metadata.')
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys, io, os, time, json, random, zipfile
+from collections import defaultdict
+
+from rxnav_rest_api_mp import rxnav_rest_api_mp
+from rxnav_cache_store import open_cache_store, CACHE_BACKENDS
+from utility_functions import utility_functions
+from ndc_api import NDC_ZIP_FILENAME, NDC_CSV_FILENAME
+
+'''
+Script: generate_synthetic_cache.py
+
+Purpose:
+    Generate a synthetic RxNav cache, and the FDA NDC names file (ndc_names_from_fda.zip) that goes
+    with it, of --scale times today's RxNorm code counts, for measuring how the metadata build
+    (cache loading, rxnorm_code_maps, the by-ingredient and VA builders, metadata_writer) scales.
+
+    The results have the structure of NLM's, keyed by the same URLs, and relate to each other as
+    RxNorm's do:
+
+        status lists              ACTIVE, RETIRED, NEVER ACTIVE and NON-RXNORM RxCUI codes
+        rxcuihistory/concept      name, TTY, status and dates of each code; the drugs (SCD, SBD, GPCK,
+                                  BPCK) with their boss ingredients (IN or PIN) and SCD
+        allrelated                concept groups of the related active codes (IN, PIN, MIN, SCD, SBD,
+                                  GPCK, BPCK, BN, ...), empty groups for the codes not active
+        allhistoricalndcs         NDC history of each drug, about 30% with none
+        classTree, classMembers   VA class tree with the XX000 (MISCELLANEOUS AGENTS) class, active
+                                  SCD members of its leaf classes
+
+    Drug names are made from their ingredients' names as RxNorm's are (e.g. 'xylo 10 MG / benpril
+    hydrochloride 5 MG Oral Tablet', '{7 (...) / 21 (...) } Pack [Brand]'), so the name parsing of
+    rxnorm_code_maps finds the ingredients.  Ingredients are picked with a skew, a few have hundreds of
+    drugs.  The FDA names file lists about 40% of the NDC codes of the drugs, and some others.
+
+    The same --scale and --seed generate the same files.  The metadata build is run on them from the
+    output directory (with interop_MED_MODIFIERS.txt copied there, or --no_modifiers):
+
+        python generate_synthetic_cache.py --scale 2 --output_dir synthetic_2x/
+        cd synthetic_2x && python ../build_rxnorm_metadata.py --cache rxcui.cache --from_cache_only ...
+
+Usage:
+    python generate_synthetic_cache.py [--scale 1.0] [--seed 1] [--output_dir ./synthetic/]
+                                       [--cache_filename rxcui.cache] [--cache_backend file]
+'''
+
+# codes of each TTY at --scale 1, about RxNorm's (350,000 codes, and 300,000 NON-RXNORM codes)
+TTY_COUNTS = [('IN', 13000), ('PIN', 4000), ('MIN', 6000), ('SCD', 45000), ('SBD', 35000), ('GPCK', 2500),
+              ('BPCK', 3000), ('SCDC', 55000), ('SCDF', 35000), ('SCDG', 12000), ('SBDC', 35000),
+              ('SBDF', 45000), ('SBDG', 17000), ('BN', 40000), ('DF', 500), ('DFG', 100)]
+NON_RXNORM_COUNT = 300000
+
+DRUG_TTYS = ['SCD', 'SBD', 'GPCK', 'BPCK']
+ALLRELATED_TTYS = ['IN', 'PIN', 'MIN', 'SCDC', 'SCDF', 'SCDG', 'SCD', 'SBDC', 'SBDF', 'SBDG', 'SBD', 'BN', 'DF',
+                   'DFG', 'GPCK', 'BPCK'] # concept groups of an 'allrelated' result, in NLM's order
+
+# status list (URL value), rxcuihistory status
+STATUSES = [('ACTIVE', 'Active'), ('RETIRED', 'Retired'), ('NEVER%20ACTIVE', 'Never Active')]
+# fractions of the codes of each status -- most ingredients, brands and dose forms are current,
+# many drugs and drug components are retired
+STATUS_FRACTIONS = {tty: (0.85, 0.12, 0.03) for tty in ['IN', 'PIN', 'MIN', 'BN', 'DF', 'DFG']}
+DEFAULT_STATUS_FRACTIONS = (0.40, 0.50, 0.10)
+
+SYLLABLES = ['al', 'ben', 'cor', 'da', 'ex', 'fen', 'gli', 'hy', 'ka', 'lo', 'mi', 'nor', 'ox', 'pra', 'quin',
+             'ro', 'sul', 'ta', 'ur', 'va', 'xy', 'zo', 'mab', 'tine', 'pril', 'sartan', 'olol', 'azole',
+             'cillin', 'mycin', 'statin', 'done', 'pam', 'ide']
+SALTS = ['hydrochloride', 'sodium', 'sulfate', 'acetate', 'maleate', 'citrate', 'potassium', 'mesylate']
+STRENGTHS = ['0.5', '1', '2.5', '5', '10', '20', '25', '50', '100', '200', '250', '500', '1000']
+DOSE_FORMS = ['Oral Tablet', 'Oral Capsule', 'Injectable Solution', 'Oral Solution', 'Topical Cream',
+              'Extended Release Oral Tablet', 'Ophthalmic Solution', 'Transdermal System', 'Oral Suspension',
+              'Inhalant Powder']
+PACKAGES = [('TABLET', 'BOTTLE'), ('CAPSULE', 'BOTTLE'), ('mL', 'VIAL'), ('TABLET', 'BLISTER PACK'),
+            ('g', 'TUBE'), ('mL', 'BOTTLE, DROPPER'), ('PATCH', 'CARTON')]
+
+VA_TOP_CLASSES = [('AD000', 'ANTIDOTES,DETERRENTS AND POISON CONTROL'), ('AH000', 'ANTIHISTAMINES'),
+                  ('AM000', 'ANTIMICROBIALS'), ('AN000', 'ANTINEOPLASTICS'), ('AP000', 'ANTIPARASITICS'),
+                  ('AU000', 'AUTONOMIC MEDICATIONS'), ('BL000', 'BLOOD PRODUCTS/MODIFIERS/VOLUME EXPANDERS'),
+                  ('CN000', 'CENTRAL NERVOUS SYSTEM MEDICATIONS'), ('CV000', 'CARDIOVASCULAR MEDICATIONS'),
+                  ('DE000', 'DERMATOLOGICAL AGENTS'), ('DX000', 'DIAGNOSTIC AGENTS'),
+                  ('GA000', 'GASTROINTESTINAL MEDICATIONS'), ('GU000', 'GENITOURINARY MEDICATIONS'),
+                  ('HA000', 'HERBS/ALTERNATIVE THERAPIES'), ('HS000', 'HORMONES/SYNTHETICS/MODIFIERS'),
+                  ('IM000', 'IMMUNOLOGICAL AGENTS'), ('IN000', 'INVESTIGATIONAL AGENTS'),
+                  ('IR000', 'IRRIGATION/DIALYSIS SOLUTIONS'), ('MS000', 'MUSCULOSKELETAL MEDICATIONS'),
+                  ('NT000', 'NASAL AND THROAT AGENTS,TOPICAL'), ('OP000', 'OPHTHALMIC AGENTS'),
+                  ('OR000', 'DENTAL AND ORAL AGENTS,TOPICAL'), ('OT000', 'OTIC AGENTS'),
+                  ('PH000', 'PHARMACEUTICAL AIDS/REAGENTS'), ('RE000', 'RECTAL,LOCAL'),
+                  ('RS000', 'RESPIRATORY TRACT MEDICATIONS'),
+                  ('TN000', 'THERAPEUTIC NUTRIENTS/MINERALS/ELECTROLYTES'), ('VT000', 'VITAMINS'),
+                  ('XA000', 'PROSTHETICS/SUPPLIES/DEVICES'), ('XX000', 'MISCELLANEOUS AGENTS')]
+VA_ROOT_CLASSID = 'VA000'
+
+CACHE_WRITE_BATCH_SIZE = 5000 # results per write_batch
+
+class synthetic_rxnorm():
+
+    def __init__(self, scale, seed):
+        self.rng = rng = random.Random(seed)
+        self.counts = [(tty, max(1, int(round(count * scale)))) for tty, count in TTY_COUNTS]
+        non_rxnorm_count = int(round(NON_RXNORM_COUNT * scale))
+        total = sum(count for tty, count in self.counts) + non_rxnorm_count
+        codes = rng.sample(range(1, 8 * total), total) # distinct RxCUI codes, spread out as RxNorm's
+        self.codes_by_tty, pos = {}, 0
+        for tty, count in self.counts:
+            self.codes_by_tty[tty] = codes[pos:pos + count]
+            pos += count
+        self.non_rxnorm_codes = sorted(codes[pos:])
+        self.tty, self.status, self.name = {}, {}, {}
+        self.dates = {} # rxcui => (startDate, endDate), MMYYYY
+        for tty, count in self.counts:
+            for rxcui in self.codes_by_tty[tty]:
+                self.tty[rxcui] = tty
+                fractions = STATUS_FRACTIONS.get(tty, DEFAULT_STATUS_FRACTIONS)
+                draw, status_idx = rng.random(), 0
+                while draw > fractions[status_idx] and status_idx < len(STATUSES) - 1:
+                    draw -= fractions[status_idx]
+                    status_idx += 1
+                self.status[rxcui] = status_idx
+                start_year = rng.randint(2005, 2018)
+                self.dates[rxcui] = ('%02d%d' % (rng.randint(1, 12), start_year),
+                                     '%02d%d' % (rng.randint(1, 12), rng.randint(start_year + 1, 2024))
+                                     if STATUSES[status_idx][1] == 'Retired' else '')
+        self.ingredients_of = {} # rxcui => IN codes of the ingredients (MIN, drugs, other TTYs)
+        self.boss_of = {} # drug rxcui => boss ingredient codes (IN or PIN)
+        self.scd_of = {} # SBD => its SCD, BPCK => its GPCK
+        self.brand_of = {} # SBD, BPCK => its BN
+        self.dose_form_of = {}
+        self.pin_base = {} # PIN => its IN
+        self.related = defaultdict(list) # IN, PIN, MIN, SCD, GPCK, BN => codes which have it as part
+        self.generate_ingredients()
+        self.generate_drugs()
+        self.generate_other_codes()
+        self.ndcs_of = {} # drug rxcui => NDC codes
+        self.generate_ndcs()
+        self.va_tree, self.va_members = self.generate_va_classes()
+    # end constructor
+
+    def skewed_choice(self, codes):
+        ''' a few codes are chosen often, as the common ingredients are in many drugs '''
+        return codes[int(len(codes) * self.rng.random() ** 2)]
+
+    def new_name(self, names_used, syllable_counts):
+        while True:
+            name = ''.join(self.rng.choice(SYLLABLES) for idx in range(self.rng.choice(syllable_counts)))
+            if name not in names_used:
+                names_used.add(name)
+                return name
+    # end new_name
+
+    def generate_ingredients(self):
+        rng, names_used = self.rng, set()
+        ingredients = self.codes_by_tty['IN']
+        for rxcui in ingredients:
+            self.name[rxcui] = self.new_name(names_used, [2, 3, 3, 4, 4])
+        for rxcui in self.codes_by_tty['PIN']: # a salt of an ingredient
+            base = rng.choice(ingredients)
+            self.pin_base[rxcui] = base
+            self.name[rxcui] = '%s %s' % (self.name[base], rng.choice(SALTS))
+            self.related[base].append(rxcui)
+        for rxcui in self.codes_by_tty['MIN']: # e.g. 'acetaminophen / oxycodone'
+            part_count, parts = min(rng.choice([2, 2, 2, 3]), len(ingredients)), set()
+            while len(parts) < part_count:
+                parts.add(self.skewed_choice(ingredients))
+            parts = sorted(parts, key=lambda x: self.name[x])
+            self.ingredients_of[rxcui] = parts
+            self.name[rxcui] = ' / '.join(self.name[x] for x in parts)
+            for ingredient in parts:
+                self.related[ingredient].append(rxcui)
+        for rxcui in self.codes_by_tty['BN']:
+            self.name[rxcui] = self.new_name(names_used, [2, 3, 4, 4]).capitalize()
+    # end generate_ingredients
+
+    def generate_drugs(self):
+        rng = self.rng
+        ingredients, multi_ingredients = self.codes_by_tty['IN'], self.codes_by_tty['MIN']
+        pins_of = defaultdict(list)
+        for pin, base in self.pin_base.items():
+            pins_of[base].append(pin)
+        for rxcui in self.codes_by_tty['SCD']:
+            if rng.random() < 0.15:
+                multi_ingredient = self.skewed_choice(multi_ingredients)
+                parts = self.ingredients_of[multi_ingredient]
+                self.related[multi_ingredient].append(rxcui)
+            else:
+                parts = [self.skewed_choice(ingredients)]
+            boss = [rng.choice(pins_of[x]) if pins_of[x] and rng.random() < 0.3 else x for x in parts]
+            self.dose_form_of[rxcui] = rng.choice(DOSE_FORMS)
+            self.name[rxcui] = '%s %s' % (' / '.join('%s %s MG' % (self.name[x], rng.choice(STRENGTHS)) for x in boss),
+                                          self.dose_form_of[rxcui])
+            self.ingredients_of[rxcui] = parts
+            self.boss_of[rxcui] = boss
+            for ingredient in set(parts + boss):
+                self.related[ingredient].append(rxcui)
+        generic_drugs, brands = self.codes_by_tty['SCD'], self.codes_by_tty['BN']
+        for rxcui in self.codes_by_tty['SBD']:
+            scd, brand = self.skewed_choice(generic_drugs), rng.choice(brands)
+            self.scd_of[rxcui], self.brand_of[rxcui] = scd, brand
+            self.name[rxcui] = '%s [%s]' % (self.name[scd], self.name[brand])
+            self.ingredients_of[rxcui], self.boss_of[rxcui] = self.ingredients_of[scd], self.boss_of[scd]
+            self.dose_form_of[rxcui] = self.dose_form_of[scd]
+            for code in set(self.ingredients_of[scd] + self.boss_of[scd] + [scd, brand]):
+                self.related[code].append(rxcui)
+        for rxcui in self.codes_by_tty['GPCK']: # e.g. '{7 (...) / 21 (...) } Pack'
+            scds = rng.sample(generic_drugs, rng.choice([2, 2, 3]))
+            self.name[rxcui] = '{%s } Pack' % ' / '.join('%d (%s)' % (rng.choice([7, 14, 21, 28]), self.name[x])
+                                                          for x in scds)
+            self.ingredients_of[rxcui] = sorted(set(x for scd in scds for x in self.ingredients_of[scd]))
+            self.boss_of[rxcui] = sorted(set(x for scd in scds for x in self.boss_of[scd]))
+            self.dose_form_of[rxcui] = 'Pack'
+            for code in set(self.ingredients_of[rxcui] + self.boss_of[rxcui] + scds):
+                self.related[code].append(rxcui)
+        for rxcui in self.codes_by_tty['BPCK']:
+            gpck, brand = rng.choice(self.codes_by_tty['GPCK']), rng.choice(brands)
+            self.scd_of[rxcui], self.brand_of[rxcui] = gpck, brand
+            self.name[rxcui] = '%s [%s]' % (self.name[gpck], self.name[brand])
+            self.ingredients_of[rxcui], self.boss_of[rxcui] = self.ingredients_of[gpck], self.boss_of[gpck]
+            self.dose_form_of[rxcui] = 'Pack'
+            for code in set(self.ingredients_of[gpck] + self.boss_of[gpck] + [gpck, brand]):
+                self.related[code].append(rxcui)
+        for tty in DRUG_TTYS: # some drugs never active have no boss ingredients, found by name (or not at all)
+            for rxcui in self.codes_by_tty[tty]:
+                if STATUSES[self.status[rxcui]][1] == 'Never Active' and rng.random() < 0.5:
+                    self.boss_of[rxcui] = []
+    # end generate_drugs
+
+    def generate_other_codes(self):
+        ''' components, forms and groups of the drugs (SCDC, SCDF, ...) and dose forms, named after an ingredient '''
+        rng, ingredients, brands = self.rng, self.codes_by_tty['IN'], self.codes_by_tty['BN']
+        for rxcui in self.codes_by_tty['DF']:
+            self.name[rxcui] = rng.choice(DOSE_FORMS)
+        for rxcui in self.codes_by_tty['DFG']:
+            self.name[rxcui] = rng.choice(DOSE_FORMS).split(' ')[0] + ' Product'
+        for tty, name_format in [('SCDC', '%s %s MG'), ('SCDF', '%s %s'), ('SCDG', '%s %s Product'),
+                                 ('SBDC', '%s %s MG [%s]'), ('SBDF', '%s %s [%s]'), ('SBDG', '%s %s Product [%s]')]:
+            for rxcui in self.codes_by_tty[tty]:
+                ingredient = self.skewed_choice(ingredients)
+                detail = rng.choice(STRENGTHS) if tty.endswith('C') else rng.choice(DOSE_FORMS).split(' ')[0]
+                self.name[rxcui] = name_format % ((self.name[ingredient], detail) if tty.startswith('SCD')
+                                                  else (self.name[ingredient], detail, self.name[rng.choice(brands)]))
+                self.ingredients_of[rxcui] = [ingredient]
+                self.related[ingredient].append(rxcui)
+    # end generate_other_codes
+
+    def generate_ndcs(self):
+        rng = self.rng
+        drugs = [rxcui for tty in DRUG_TTYS for rxcui in self.codes_by_tty[tty]]
+        ndc_counts = [0 if rng.random() < 0.3 else int(rng.expovariate(1 / 6.0)) + 1 for rxcui in drugs]
+        ndc_codes = rng.sample(range(10 ** 8, 10 ** 11), sum(ndc_counts) + sum(ndc_counts) // 30)
+        pos = 0
+        for rxcui, ndc_count in zip(drugs, ndc_counts):
+            self.ndcs_of[rxcui] = ['%011d' % x for x in ndc_codes[pos:pos + ndc_count]]
+            pos += ndc_count
+        self.unused_ndcs = ['%011d' % x for x in ndc_codes[pos:]] # in the FDA names only
+    # end generate_ndcs
+
+    def generate_va_classes(self):
+        ''' VA class tree (rxclassTree list of the root) and the active SCD members of each leaf class '''
+        rng = self.rng
+        def class_node(class_id, class_name, children=None):
+            node = {'rxclassMinConceptItem': {'classId': class_id, 'className': class_name, 'classType': 'VA'}}
+            if children:
+                node['rxclassTree'] = children
+            return node
+        leaves, top_nodes = [], []
+        for top_class_id, top_class_name in VA_TOP_CLASSES:
+            if top_class_id == 'XX000': # leaf, the build looks for it
+                leaves.append(top_class_id)
+                top_nodes.append(class_node(top_class_id, top_class_name))
+                continue
+            children = []
+            for class_idx in range(1, rng.randint(2, 9) + 1):
+                class_id = '%s%d00' % (top_class_id[:2], class_idx)
+                sub_classes = []
+                if rng.random() < 0.4:
+                    for sub_idx in range(1, rng.randint(2, 6) + 1):
+                        sub_class_id = '%s%d%02d' % (top_class_id[:2], class_idx, sub_idx)
+                        sub_classes.append(class_node(sub_class_id, '%s CLASS %s' % (top_class_name, sub_class_id)))
+                        leaves.append(sub_class_id)
+                else:
+                    leaves.append(class_id)
+                children.append(class_node(class_id, '%s CLASS %s' % (top_class_name, class_id), sub_classes))
+            top_nodes.append(class_node(top_class_id, top_class_name, children))
+        members = {class_id: [] for class_id in leaves}
+        for rxcui in self.codes_by_tty['SCD']:
+            if STATUSES[self.status[rxcui]][1] == 'Active' and rng.random() < 0.8:
+                members[self.skewed_choice(leaves)].append(rxcui)
+        return [class_node(VA_ROOT_CLASSID, 'VA CLASSES', top_nodes)], members
+    # end generate_va_classes
+
+    def concept_properties(self, rxcui):
+        return {'rxcui': str(rxcui), 'name': self.name[rxcui], 'synonym': '', 'tty': self.tty[rxcui],
+                'language': 'ENG', 'suppress': 'N', 'umlscui': ''}
+
+    def is_active(self, rxcui):
+        return STATUSES[self.status[rxcui]][1] == 'Active'
+
+    def allrelated(self, rxcui):
+        groups = {tty: [] for tty in ALLRELATED_TTYS}
+        if self.is_active(rxcui): # NLM's result for codes not active has empty concept groups
+            tty = self.tty[rxcui]
+            related = [rxcui] + self.related.get(rxcui, []) + self.ingredients_of.get(rxcui, []) \
+                      + self.boss_of.get(rxcui, [])
+            if tty == 'PIN':
+                related.append(self.pin_base[rxcui])
+            if rxcui in self.scd_of:
+                related.extend([self.scd_of[rxcui], self.brand_of[rxcui]])
+            for code in sorted(set(related)):
+                if self.is_active(code):
+                    groups[self.tty[code]].append(code)
+        concept_groups = [{'tty': tty, 'conceptProperties': [self.concept_properties(x) for x in groups[tty]]}
+                          if groups[tty] else {'tty': tty} for tty in ALLRELATED_TTYS]
+        return {'allRelatedGroup': {'rxcui': str(rxcui) if self.is_active(rxcui) else '',
+                                    'conceptGroup': concept_groups}}
+    # end allrelated
+
+    def rxcuihistory_concept(self, rxcui):
+        tty, status = self.tty[rxcui], STATUSES[self.status[rxcui]][1]
+        start_date, end_date = self.dates[rxcui]
+        scd = self.scd_of.get(rxcui) if tty == 'SBD' else rxcui if tty == 'SCD' else None
+        concept = {'status': status, 'rxcui': str(rxcui), 'tty': tty, 'str': self.name[rxcui], 'sab': 'RXNORM',
+                   'doseform': self.dose_form_of.get(rxcui, ''), 'doseformRxcui': '', 'mid': '0',
+                   'branded': '1' if tty in ['SBD', 'BPCK', 'SBDC', 'SBDF', 'SBDG', 'BN'] else '0',
+                   'qf': '', 'qd': '', 'startDate': start_date, 'endDate': end_date,
+                   'isCurrent': '1' if status == 'Active' else '0', 'currentRxcui': '', 'packAlias': '',
+                   'scdName': self.name[scd] if scd else '', 'scdRxcui': str(scd) if scd else ''}
+        d = {'rxcuiHistoryConcept': {'rxcuiConcept': concept}}
+        if tty in DRUG_TTYS:
+            d['rxcuiHistoryConcept']['bossConcept'] = \
+                [{'baseRxcui': str(self.pin_base.get(x, x)), 'baseName': self.name[self.pin_base.get(x, x)],
+                  'bossRxcui': str(x), 'bossName': self.name[x], 'actIngredRxcui': '', 'actIngredName': '',
+                  'moietyRxcui': '', 'moietyName': '', 'numeratorValue': '', 'numeratorUnit': 'MG',
+                  'denominatorValue': '', 'denominatorUnit': ''} for x in self.boss_of[rxcui]]
+        return d
+    # end rxcuihistory_concept
+
+    def allhistoricalndcs(self, rxcui):
+        ndcs = self.ndcs_of[rxcui]
+        if not ndcs:
+            return {}
+        start_date = self.dates[rxcui][0]
+        ndc_times = [{'ndc': [ndc], 'startDate': start_date[2:] + start_date[:2],
+                      'endDate': self.dates[rxcui][1][2:] + self.dates[rxcui][1][:2] or '202409'} for ndc in ndcs]
+        return {'historicalNdcConcept': {'historicalNdcTime': [{'status': 'direct', 'rxcui': str(rxcui),
+                                                                'ndcTime': ndc_times}]}}
+    # end allhistoricalndcs
+
+    def va_class_members(self, class_id):
+        members = self.va_members[class_id]
+        if not members:
+            return {}
+        return {'drugMemberGroup': {'drugMember': [{'minConcept': {'rxcui': str(x), 'name': self.name[x], 'tty': 'SCD'},
+                                                    'rela': 'has_VAClass', 'relaSource': 'VA'} for x in members]}}
+    # end va_class_members
+
+    def cache_entries(self, rxnav):
+        ''' (url, JSON text) of all results, in the order the cache build requests them '''
+        dumps = lambda d: json.dumps(d, separators=(',', ':')) # compact, as NLM's responses
+        for status_value, status in STATUSES:
+            yield rxnav.historical_status_url(status_value), \
+                  dumps({'rxcuiList': {'rxcuis': [str(x) for x in sorted(self.status)
+                                                  if STATUSES[self.status[x]][0] == status_value]}})
+        yield rxnav.historical_status_url('NON-RXNORM'), \
+              dumps({'rxcuiList': {'rxcuis': [str(x) for x in self.non_rxnorm_codes]}})
+        rxcuis = sorted(self.status)
+        for rxcui in rxcuis: # phase 1
+            yield rxnav.allrelated_url(rxcui), dumps(self.allrelated(rxcui))
+            yield rxnav.historical_rxcui_url(rxcui), dumps(self.rxcuihistory_concept(rxcui))
+        for rxcui in rxcuis: # phase 2
+            if self.tty[rxcui] in DRUG_TTYS:
+                yield rxnav.allhistoricalndcs_url(rxcui), dumps(self.allhistoricalndcs(rxcui))
+        yield rxnav.class_tree_url(VA_ROOT_CLASSID), dumps({'rxclassTree': self.va_tree}) # phase 3
+        for class_id in sorted(self.va_members):
+            yield rxnav.va_class_members_url(class_id), dumps(self.va_class_members(class_id))
+    # end cache_entries
+
+    def fda_ndc_names(self):
+        ''' (NDC code, FDA name) in code order, about 40% of the drugs' NDC codes and the unused ones '''
+        rng, names = self.rng, []
+        for rxcui in sorted(self.ndcs_of):
+            for ndc in self.ndcs_of[rxcui]:
+                if rng.random() < 0.4:
+                    names.append((ndc, rxcui))
+        names.extend((ndc, None) for ndc in self.unused_ndcs)
+        for ndc, rxcui in sorted(names):
+            ingredient = self.ingredients_of.get(rxcui) if rxcui is not None else None
+            unit, container = rng.choice(PACKAGES)
+            name = '%s (%s) %d %s in 1 %s (%s-%s-%s)' \
+                   % (self.name[self.brand_of[rxcui]].upper() if rxcui in self.brand_of
+                      else self.name[ingredient[0]].upper() if ingredient else 'PRODUCT',
+                      ', '.join(self.name[x] for x in ingredient) if ingredient else 'unspecified',
+                      rng.choice([1, 10, 30, 60, 90, 100, 500]), unit, container, ndc[:5], ndc[5:9], ndc[9:])
+            yield ndc, ('"%s"' % name if rng.random() < 0.2 else name) # some names are quoted in the FDA file
+    # end fda_ndc_names
+
+# end class synthetic_rxnorm
+
+def write_cache(model, cache_filename, cache_backend, logfile):
+    ''' write the results to a new cache (with its index), return the number of entries '''
+    rxnav = rxnav_rest_api_mp(None, utility_functions(), logfile, None) # URLs of the results, the cache keys
+    store = open_cache_store(cache_filename, logfile, cache_backend, writable=True)
+    batch, entry_count = [], 0
+    for cache_entry in model.cache_entries(rxnav):
+        batch.append(cache_entry)
+        if len(batch) >= CACHE_WRITE_BATCH_SIZE:
+            store.write_batch(batch)
+            entry_count += len(batch)
+            batch = []
+    if batch:
+        store.write_batch(batch)
+        entry_count += len(batch)
+    store.close()
+    return entry_count
+# end write_cache
+
+def write_ndc_zip(model, ndc_zip_filename):
+    ''' the FDA names file, NDC_CSV_FILENAME in a zip file, as read by ndc_api; returns the number of names '''
+    lines = ['NDC_CODE\tNDC_NAME']
+    lines.extend('NDC:%s\t%s' % (ndc, name) for ndc, name in model.fda_ndc_names())
+    with zipfile.ZipFile(ndc_zip_filename, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(NDC_CSV_FILENAME, ('\n'.join(lines) + '\n').encode('latin-1'))
+    return len(lines) - 1
+# end write_ndc_zip
+
+def main():
+    def parse_args():
+        from optparse import OptionParser
+        opt = OptionParser()
+        opt.add_option('--scale', action='store', type=float, default=1.0) # times today's RxNorm code counts
+        opt.add_option('--seed', action='store', type=int, default=1)
+        opt.add_option('--output_dir', action='store', default='./synthetic/')
+        opt.add_option('--cache_filename', action='store', default='rxcui.cache')
+        opt.add_option('--cache_backend', action='store', type='choice', choices=CACHE_BACKENDS, default='file')
+        opts, args = opt.parse_args()
+        return opts, args
+    # end parse_args
+
+    opts, args = parse_args()
+    if not opts.output_dir.endswith(os.sep) and not opts.output_dir.endswith('/'):
+        opts.output_dir += os.sep
+    cache_filename = opts.output_dir + opts.cache_filename
+    ndc_zip_filename = opts.output_dir + NDC_ZIP_FILENAME
+    if os.path.exists(cache_filename):
+        print('Cache [%s] exists already, remove it (and %s.*) first' % (cache_filename, cache_filename))
+        sys.exit(1)
+    if not os.path.exists(opts.output_dir):
+        os.makedirs(opts.output_dir)
+    start_t = time.time()
+    model = synthetic_rxnorm(opts.scale, opts.seed)
+    print('Generated %d RxNorm codes (scale %g, seed %d) in %.1f seconds: %s, NON-RXNORM %d'
+          % (len(model.status), opts.scale, opts.seed, time.time() - start_t,
+             ', '.join('%s %d' % (tty, count) for tty, count in model.counts), len(model.non_rxnorm_codes)))
+    sys.stdout.flush()
+    logfile = io.open(opts.output_dir + 'generate_synthetic_cache.log', 'w', encoding='utf-8')
+    entry_count = write_cache(model, cache_filename, opts.cache_backend, logfile)
+    logfile.close()
+    print('Wrote %d results to [%s], %.1f MB' % (entry_count, cache_filename, os.path.getsize(cache_filename) / 1048576.0))
+    sys.stdout.flush()
+    name_count = write_ndc_zip(model, ndc_zip_filename)
+    print('Wrote %d FDA NDC names (of %d NDC codes of the drugs) to [%s], %.1f MB'
+          % (name_count, sum(len(x) for x in model.ndcs_of.values()), ndc_zip_filename,
+             os.path.getsize(ndc_zip_filename) / 1048576.0))
+    print('Done in %.1f seconds' % (time.time() - start_t))
+# end main
+
+if __name__ == '__main__':
+    main()
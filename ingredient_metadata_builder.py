@@ -33,6 +33,7 @@ class ingredient_metadata_builder():
         self.in_to_min_map = self.rxnorm_coding.get_ingredient_to_min_set_map()
         self.metadata_rows = {}
         self.rxcui_map = {} # track name and type (eg. SCD vs GPCK,etc)
+        self.ndcs_of_drug = {} # drug rxcui => NDC codes, read once from the cache, used again by get_ndc_rows
         self.ingredient_rxcui_to_paths = {}
         self.undetermined_ingredient_rxcui_map = self.rxnorm_coding.get_undetermined_ingredient_rxcui_map() # A-Z codes
         self.undetermined_ingredient_rxcuis = self.undetermined_ingredient_rxcui_map.values()
@@ -60,7 +61,7 @@ class ingredient_metadata_builder():
         self.build_letter_metadata(ingredient_path_prefix) # 'A'..'Z', with undetermined ingredient subfolder
         self.build_ingredient_metadata(ingredient_path_prefix) # folders for each letter, and ingredients for each
         self.build_drug_level_metadata()
-        self.build_ndc_level_metadata()
+        self.build_ndc_level_metadata() # NDC counts, the NDC rows are generated by get_metadata_rows
         return self.metadata_rows # Done
     # end build
 
@@ -225,33 +226,65 @@ class ingredient_metadata_builder():
     # end build_drug_level_metadata
 
     def build_ndc_level_metadata(self):
+        # NDC rows (most of the rows) are not kept in metadata_rows, they are generated by get_ndc_rows
+        # as they are written (get_metadata_rows) -- here only the drug rows get their NDC children counts
         print('Computing NDCs for branded and generic drugs')
         drug_paths = [x for x in self.metadata_rows.keys()
                       if (self.metadata_rows[x]['tty'] in ['SBD','BPCK','SCD','GPCK']) ]
+        ndc_row_count = 0
         for drug_path in drug_paths:
-            my_parent_path, sbd_rxcui = drug_path, self.metadata_rows[drug_path]['rxcui'] # was -- = tup
-            ndcs_for_sbd_rxcui = self.rxnav.get_ndcs_for_drug(sbd_rxcui) # list of ndc codes
-            for ndc in ndcs_for_sbd_rxcui:
-                child_path = my_parent_path+ndc+'\\'
-                child_name = self.ndc_api.get_ndc_name(ndc)
-                c_basecode = 'NDC:%s' % ndc
-                c_fullname = child_path
-                if child_name == str(ndc): child_name = '(%s) %s' % (ndc, self.metadata_rows[my_parent_path]['c_name'])
-                self.metadata_rows[my_parent_path]['children'] += 1
-                self.metadata_rows[child_path] =\
-                    { 'c_fullname': c_fullname,
-                      'c_hlevel': self.metadata_rows[my_parent_path]['c_hlevel']+1,
-                      'c_name': child_name,  # descriptive name for NDC when available
-                      'c_basecode': c_basecode,
-                      'c_tooltip': 'Package for Orderable Drug %s' % self.metadata_rows[my_parent_path]['c_basecode'],
-                      'children': 0,
-                      'tty': 'NDC',
-                      'rxcui': None }
+            ndcs_for_sbd_rxcui = self.get_ndcs_of_drug(self.metadata_rows[drug_path]['rxcui']) # list of ndc codes
+            self.metadata_rows[drug_path]['children'] += len(ndcs_for_sbd_rxcui)
+            ndc_row_count += len(set(ndcs_for_sbd_rxcui))
         print('After NDCs: %d REST API requests,\nSeconds since start: %s' %
               (self.rxnav.get_request_count(),str(time.time()-self.start_t)))
         print('Cache hits: %s' % self.rxnav.get_cache_usage())
         self.show_hlevels()
+        print('NDC rows (generated when written) ==> %d' % ndc_row_count)
     # end build_ndc_level_metadata
 
+    def get_ndcs_of_drug(self, drug_rxcui):
+        ''' NDC codes of a drug, looked up in the cache (and parsed) once for the counts and the rows '''
+        if drug_rxcui not in self.ndcs_of_drug: # kept as one comma separated string, not a string per NDC
+            self.ndcs_of_drug[drug_rxcui] = ','.join(self.rxnav.get_ndcs_for_drug(drug_rxcui))
+        ndcs = self.ndcs_of_drug[drug_rxcui]
+        return ndcs.split(',') if ndcs else []
+
+    def get_ndc_rows(self, drug_path):
+        ''' (path, row) of the NDC rows of a drug, in path order '''
+        my_parent_path, sbd_rxcui = drug_path, self.metadata_rows[drug_path]['rxcui'] # was -- = tup
+        ndc_rows = {}
+        ndcs = self.get_ndcs_of_drug(sbd_rxcui) # list of ndc codes
+        for ndc, child_name in zip(ndcs, self.ndc_api.get_ndc_names(ndcs)):
+            child_path = my_parent_path+ndc+'\\'
+            c_basecode = 'NDC:%s' % ndc
+            c_fullname = child_path
+            if child_name == str(ndc): child_name = '(%s) %s' % (ndc, self.metadata_rows[my_parent_path]['c_name'])
+            ndc_rows[child_path] =\
+                { 'c_fullname': c_fullname,
+                  'c_hlevel': self.metadata_rows[my_parent_path]['c_hlevel']+1,
+                  'c_name': child_name,  # descriptive name for NDC when available
+                  'c_basecode': c_basecode,
+                  'c_tooltip': 'Package for Orderable Drug %s' % self.metadata_rows[my_parent_path]['c_basecode'],
+                  'children': 0,
+                  'tty': 'NDC',
+                  'rxcui': None }
+        for child_path in sorted(ndc_rows.keys()):
+            yield child_path, ndc_rows[child_path]
+    # end get_ndc_rows
+
+    def get_metadata_rows(self):
+        '''
+        (path, row) of all rows in path order, for metadata_writer.write_sorted_metadata_rows.
+        The NDC rows of a drug are its only descendants, so they directly follow its row -- generated
+        one drug at a time.
+        '''
+        for path in sorted(self.metadata_rows.keys()):
+            yield path, self.metadata_rows[path]
+            if self.metadata_rows[path]['tty'] in ['SBD','BPCK','SCD','GPCK']:
+                for ndc_path_row in self.get_ndc_rows(path):
+                    yield ndc_path_row
+    # end get_metadata_rows
+
 # end class ingredient_metadata_builder
 
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys, io, time
+from array import array
+
+from utility_functions import utility_functions
+from rxnav_rest_api_mp import rxnav_rest_api_mp
+from rxnav_cache_store import CACHE_BACKENDS
+from rxcui_attribute_table import rxcui_attribute_table
+from rxnorm_code_maps import rxnorm_code_maps
+
+'''
+Script: memory_report_code_maps.py
+
+Purpose:
+    Report the memory used by the rxnorm_code_maps information model built from a cache,
+    in its original layout (dictionaries of sets and tuples) and its compact layout
+    (CSR arrays, provenance bitflags, attribute columns -- rxnorm_compact_maps.py).
+
+    The cache must be complete for the metadata build (see --from_cache_only of build_rxnorm_metadata.py).
+
+Usage:
+    python memory_report_code_maps.py --cache rxcui.cache [--cache_backend file] [--log_dir ./]
+'''
+
+REPORTED_ATTRIBUTES = ['rxcui_attr', 'hist_drug_to_ingredient_attr', 'ingredient_to_drug_set',
+                       'drug_to_ingredient_set', 'ingredient_to_min_set', 'ingredient_to_drug_provenance',
+                       'drug_to_ingredient_provenance']
+
+def deep_size(obj, seen):
+    ''' bytes used by obj and everything it refers to, objects in seen are not counted again '''
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(x, seen) for x in obj)
+    elif isinstance(obj, (str, bytes, int, float, array)) or obj is None:
+        pass
+    elif hasattr(obj, '__dict__'): # compact map objects
+        size += deep_size(obj.__dict__, seen)
+    return size
+# end deep_size
+
+def layout_sizes(code_maps):
+    seen = set() # strings shared between the structures are counted once
+    return [deep_size(getattr(code_maps, x), seen) for x in REPORTED_ATTRIBUTES]
+
+def main():
+    def parse_args():
+        from optparse import OptionParser
+        opt = OptionParser()
+        opt.add_option('--cache', action='store', default='rxcui.cache')
+        opt.add_option('--cache_backend', action='store', type='choice', choices=CACHE_BACKENDS, default='file')
+        opt.add_option('--log_dir', action='store', default='./')
+        opts, args = opt.parse_args()
+        return opts, args
+    # end parse_args
+
+    opts, args = parse_args()
+    logfile = io.open(opts.log_dir + 'memory_report_code_maps.log', 'w', encoding='utf-8')
+    rxnav = rxnav_rest_api_mp(opts.cache, utility_functions(), logfile, None,
+                              readonly_access_to_cache=True,
+                              forward_result_to_cache_writer=False,
+                              fail_if_not_in_cache=True,
+                              cache_backend=opts.cache_backend,
+                              allrelated_lru_size=0)
+    rxcui_set, rxcuis_status_d = \
+        rxnav.get_historical_rxcuis(target_status_values=["ACTIVE", "RETIRED", "NEVER%20ACTIVE"])
+    attribute_table = rxcui_attribute_table(rxnav, rxcui_set, logfile)
+    ingredient_rxcui_set = attribute_table.get_rxcuis_with_tty(['IN', 'MIN', 'PIN'])
+    drug_rxcui_set = attribute_table.get_rxcuis_with_tty(['SCD', 'SBD', 'GPCK', 'BPCK'])
+    code_maps = rxnorm_code_maps(rxnav, ingredient_rxcui_set, drug_rxcui_set,
+                                 attribute_table=attribute_table, compact=False)
+    original_sizes = layout_sizes(code_maps)
+    start_t = time.time()
+    code_maps.compact()
+    compact_seconds = time.time() - start_t
+    compact_sizes = layout_sizes(code_maps)
+
+    print('')
+    print('rxnorm_code_maps memory, %d RxCUIs, %d ingredients, %d drugs (compacted in %.2f seconds)'
+          % (len(rxcui_set), len(ingredient_rxcui_set), len(drug_rxcui_set), compact_seconds))
+    print('%-32s %14s %14s %8s' % ('structure', 'original (MB)', 'compact (MB)', 'ratio'))
+    for name, original_size, compact_size in zip(REPORTED_ATTRIBUTES + ['TOTAL'],
+                                                 original_sizes + [sum(original_sizes)],
+                                                 compact_sizes + [sum(compact_sizes)]):
+        print('%-32s %14.2f %14.2f %7.1fx' % (name, original_size / 1048576.0, compact_size / 1048576.0,
+                                              original_size / float(max(compact_size, 1))))
+    logfile.close()
+# end main
+
+if __name__ == '__main__':
+    main()
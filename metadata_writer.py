@@ -1,5 +1,7 @@
 from __future__ import print_function
-import time, io, sys
+import multiprocessing as mp
+import time, io, os, sys, json, heapq, hashlib, tempfile
+from collections import deque
 
 '''
 Module: metadata_writer.py
@@ -10,12 +12,150 @@ Author:
 Purpose:
     Define metadata_writer class, which is given python metadata structures, and writes
     equivalent i2b2-format metadata to a specified text file.
+
+    The rows are written in path order, given as:
+        write_metadata_rows           -- a dictionary of path => row (sorted here)
+        write_sorted_metadata_rows    -- (path, row) pairs already in path order, e.g. from a generator,
+                                         so all rows need not be in memory at once
+        write_unsorted_metadata_rows  -- (path, row) pairs in any order, sorted in bounded memory
+                                         (external merge sort, see sorted_metadata_rows)
+
+    With format_workers > 1, the rows are formatted by that many processes: contiguous chunks of
+    FORMAT_CHUNK_ROWS rows are formatted in parallel, and written in order as each chunk's text comes
+    back -- the file is the same as when the rows are formatted in this process.
+
+    Define write_metadata_delta, which compares the metadata file of a build with the one of the
+    previous build, and writes the rows to insert, update and delete (keyed on C_FULLNAME) to
+    separate files with the same header, e.g. rxnorm_ndc.insert.txt, rxnorm_ndc.update.txt,
+    rxnorm_ndc.delete.txt -- so the i2b2 ontology table is updated instead of reloaded.
+
+    The comparison streams over the row index of each file, <metadata file>.rowindex, one line per
+    row sorted by C_FULLNAME: digest of the row (date fields excluded), file position and length of
+    the row, C_FULLNAME.  Each write_metadata_rows call writes rows in C_FULLNAME order, so a metadata
+    file is a few sorted runs of rows, the row index is a merge of the runs -- neither file is held in memory.
 '''
 
+WRITE_CHUNK_ROWS = 10000 # formatted rows written to the file at once
+FORMAT_CHUNK_ROWS = 2000 # rows per chunk formatted by a format worker process
+ROW_INDEX_SUFFIX = '.rowindex'
+DATE_FIELDNAMES = ['UPDATE_DATE', 'DOWNLOAD_DATE', 'IMPORT_DATE'] # differ each build, not compared
+
+def clean_str(s):
+    ''' clean_str: for SQL*LOADER files.  enclose whole string with double quotes (embedded double-quotes replaced by \" ) '''
+    return '"' + s.strip().replace('"', r'\"') + '"'  # CSV-safe string, safe for Oracle import
+
+def make_utf8(s):
+    ''' make_unicode: for python 2, return unicode(s) otherwise return s '''
+    return unicode(s) if sys.version_info[0] < 3 else s
+
+def compile_row_formatter(fieldnames, date_str):
+    '''
+    Return format_row(path, row), the metadata line (with newline) of a row.  The formatter of each
+    of the fieldnames is determined once, here -- constant values (C_SYNONYM_CD, dates, and the
+    defaults of C_TABLENAME, C_OPERATOR, SOURCESYSTEM_CD, etc) are quoted once, rows only override them.
+    '''
+    def constant(value):
+        return lambda path, row: value
+
+    def with_default(key, default): # default quoted once, row value (if any) quoted per row
+        quoted_default = clean_str(default)
+        return lambda path, row: clean_str(row[key]) if key in row else quoted_default
+
+    def c_basecode_field(path, row):
+        c_basecode = row['c_basecode']
+        return clean_str(c_basecode) if c_basecode else '' # leave empty string alone, dont quote it
+
+    def pcori_basecode_field(path, row): # SHRINE/HARVARD
+        c_basecode = row['c_basecode']
+        colon_pos = c_basecode.find(':')
+        return '' if colon_pos < 0 else clean_str(c_basecode[colon_pos + 1:])
+
+    def pcori_ndc_field(path, row):
+        c_basecode = row['c_basecode']
+        return '' if (not c_basecode.startswith('NDC:')) else clean_str(c_basecode[c_basecode.find(':') + 1:])
+
+    def pcori_cui_field(path, row): # SHRINE/HARVARD
+        c_basecode = row['c_basecode']
+        if c_basecode.startswith('RXNORM:'):
+            return clean_str(c_basecode[c_basecode.find(':') + 1:])
+        elif c_basecode.startswith('NDC:'):
+            # parse C_FULLNAME and look for RXNORM code in previous position
+            c_fullname_elements = row['c_fullname'].split('\\')
+            return '' if len(c_fullname_elements) < 2 else clean_str(c_fullname_elements[-2])
+        return ''
+
+    folder, leaf = clean_str('FA '), clean_str('LA ')
+    def c_visualattributes_field(path, row): # folder?
+        if 'c_visualattributes' in row:
+            return clean_str(row['c_visualattributes'])
+        return folder if row['children'] > 0 else leaf
+
+    def c_metadataxml_field(path, row):
+        c_metadataxml = row.get('c_metadataxml', '')
+        return clean_str(c_metadataxml) if c_metadataxml else ''
+
+    field_formatters = {
+        'C_FULLNAME': lambda path, row: clean_str(path),
+        'C_HLEVEL': lambda path, row: str(row['c_hlevel']),  # prefix is constant, don't concern with it
+        'C_NAME': lambda path, row: clean_str(row['c_name']),
+        'C_NAME_ORIG': lambda path, row: clean_str(row['c_name']),
+        'C_BASECODE': c_basecode_field,
+        'PCORI_BASECODE': pcori_basecode_field,
+        'PCORI_NDC': pcori_ndc_field,
+        'PCORI_CUI': pcori_cui_field,
+        # JGP 2017-07-02, works for ITCP and path-based
+        'C_DIMCODE': lambda path, row: clean_str(row['c_dimcode'] if 'c_dimcode' in row else path),
+        'C_TOOLTIP': lambda path, row: clean_str(row['c_tooltip'] if 'c_tooltip' in row else path[1:-1]),
+        'C_SYNONYM_CD': constant(clean_str('N')),
+        'C_TOTALNUM': constant('0'),
+        'FACT_COUNT': constant('0'),
+        'C_VISUALATTRIBUTES': c_visualattributes_field,
+        'C_FACTTABLECOLUMN': with_default('c_facttablecolumn', 'concept_cd'),
+        'C_TABLENAME': with_default('c_tablename', 'concept_dimension'),  # NOT the ITCP table
+        'C_OPERATOR': with_default('c_operator', 'LIKE'),  # path-based transitive-closure computation
+        'C_COLUMNNAME': with_default('c_columnname', 'concept_path'),
+        'C_COLUMNDATATYPE': with_default('c_columnndatatype', 'T'),  # text
+        'M_APPLIED_PATH': with_default('m_applied_path', '@'),
+        'SOURCESYSTEM_CD': with_default('sourcesystem_cd', 'rxnav.nlm.nih.gov'),
+        'UPDATE_DATE': constant(clean_str(date_str)),
+        'DOWNLOAD_DATE': constant(clean_str(date_str)),
+        'IMPORT_DATE': constant(clean_str(date_str)),
+        'C_METADATAXML': c_metadataxml_field,
+        'TTY': lambda path, row: clean_str(row.get('tty', '')),  # TTY
+    }
+    # Fields requested by SHRINE metadata (etc), not 'standard' but need to be in CSV (e.g. C_PATH, C_SYMBOL)
+    # ==> For now, an empty string, and will show up as such in the result. e.g. |||
+    formatters = [field_formatters.get(x, constant('')) for x in fieldnames]
+
+    def format_row(path, row):
+        return '|'.join([f(path, row) for f in formatters]) + '\n'
+    return format_row
+# end compile_row_formatter
+
+def path_order_checked(path_rows):
+    ''' the (path, row) pairs, ValueError if a path is out of order '''
+    previous_path = None
+    for path, row in path_rows:
+        if previous_path is not None and path < previous_path:
+            raise ValueError('Metadata path [%s] written after [%s], not in path order' % (path, previous_path))
+        previous_path = path
+        yield path, row
+# end path_order_checked
+
+format_worker_row_formatter = None # format_row of a format worker process, set by init_format_worker
+
+def init_format_worker(fieldnames, date_str):
+    global format_worker_row_formatter
+    format_worker_row_formatter = compile_row_formatter(fieldnames, date_str)
+
+def format_rows_chunk(path_rows):
+    ''' format worker -- the text of a chunk of rows '''
+    return ''.join([format_worker_row_formatter(path, row) for path, row in path_rows])
+
 class metadata_writer():
 # Metadata file writer class
     def __init__(self, fn, append=False, include_dates=False, include_tty=False, \
-                 csv_fields_file=None, csv_fields_file_delim=None, strftime_format=None):
+                 csv_fields_file=None, csv_fields_file_delim=None, strftime_format=None, format_workers=0):
         self.fout = open(fn,'a' if append else 'w') # create or append
         if csv_fields_file:
             with io.open(csv_fields_file, 'r', encoding='utf-8') as f:
@@ -31,76 +171,225 @@ class metadata_writer():
             if include_tty: self.fieldnames.append('TTY')
         self.fieldname_set = set(self.fieldnames)
         self.date_str = time.strftime('%Y/%m/%d %I:%M:%S %p' if not strftime_format else strftime_format)
+        self.format_row = compile_row_formatter(self.fieldnames, self.date_str)
+        self.format_workers = format_workers # > 1 ==> rows are formatted by a pool of processes
+        self.format_pool = None # created by the first write
         if not append: # created (not appending) ==> write header line
             print('|'.join(self.fieldnames),file=self.fout)
 
     def write_metadata_rows(self, metadata_paths):
-        def clean_str(s):
-            ''' clean_str: for SQL*LOADER files.  enclose whole string with double quotes (embedded double-quotes replaced by \" ) '''
-            return make_utf8('"' + s.strip().replace('"', r'\"') + '"')  # CSV-safe string, safe for Oracle import
-
-        def make_utf8(s):
-            ''' make_unicode: for python 2, return unicode(s) otherwise return s '''
-            return unicode(s) if sys.version_info[0] < 3 else s
-
-        fieldnames, fieldname_set, date_str = self.fieldnames, self.fieldname_set, self.date_str
-        field = {fieldname: '' for fieldname in fieldnames}  # dictionary of field names, '' for unrecognized
-        for path in sorted(metadata_paths.keys()):
-            field['C_FULLNAME'] = clean_str(path)
-            field['C_HLEVEL'] = str(metadata_paths[path]['c_hlevel'])  # prefix is constant, don't concern with it
-            field['C_NAME'] = clean_str(metadata_paths[path]['c_name'])
-            if 'C_NAME_ORIG' in fieldname_set: field['C_NAME_ORIG'] = clean_str(metadata_paths[path]['c_name'])
-
-            # start basecode processing
-            c_basecode = metadata_paths[path]['c_basecode']
-            field['C_BASECODE'] = clean_str(c_basecode) if c_basecode else '' # leave empty string alone, dont quote it
-            colon_pos = c_basecode.find(':')
-            if 'PCORI_BASECODE' in fieldname_set: # SHRINE/HARVARD
-                field['PCORI_BASECODE'] = '' if colon_pos < 0 else clean_str(c_basecode[colon_pos + 1:])
-            if 'PCORI_NDC' in fieldname_set:
-                field['PCORI_NDC'] = '' if (not c_basecode.startswith('NDC:')) else clean_str(c_basecode[colon_pos + 1:])
-            if 'PCORI_CUI' in fieldname_set: # SHRINE/HARVARD
-                if c_basecode.startswith('RXNORM:'):
-                    field['PCORI_CUI'] = clean_str(c_basecode[colon_pos + 1:])
-                elif c_basecode.startswith('NDC:'):
-                    # parse C_FULLNAME and look for RXNORM code in previous position
-                    c_fullname_elements = metadata_paths[path]['c_fullname'].split('\\')
-                    field['PCORI_CUI'] = '' if len(c_fullname_elements) < 2 else clean_str(c_fullname_elements[-2])
-            # end basecode processing
-
-            field['C_DIMCODE'] = clean_str(metadata_paths[path].get('c_dimcode', path)) # JGP 2017-07-02, works for ITCP and path-based
-            field['C_TOOLTIP'] = clean_str(metadata_paths[path].get('c_tooltip', path[1:-1]))
-            field['C_SYNONYM_CD'] = clean_str('N')
-            if 'C_TOTALNUM' in fieldname_set: field['C_TOTALNUM'] = '0'
-            if 'FACT_COUNT' in fieldname_set: field['FACT_COUNT'] = '0'
-            field['C_VISUALATTRIBUTES'] = clean_str(metadata_paths[path].get('c_visualattributes',
-                                                                             ('FA ' if metadata_paths[path]['children'] > 0 else 'LA '))) # folder?
-            field['C_FACTTABLECOLUMN'] = clean_str(metadata_paths[path].get('c_facttablecolumn', 'concept_cd'))
-            field['C_TABLENAME'] = clean_str(metadata_paths[path].get('c_tablename', 'concept_dimension'))  # NOT the ITCP table
-            field['C_OPERATOR'] = clean_str(metadata_paths[path].get('c_operator', 'LIKE'))  # path-based transitive-closure computation
-            field['C_COLUMNNAME'] = clean_str(metadata_paths[path].get('c_columnname', 'concept_path'))
-            field['C_COLUMNDATATYPE'] = clean_str(metadata_paths[path].get('c_columnndatatype', 'T'))  # text
-            field['M_APPLIED_PATH'] = clean_str(metadata_paths[path].get('m_applied_path', '@'))
-            field['SOURCESYSTEM_CD'] = clean_str(metadata_paths[path].get('sourcesystem_cd', 'rxnav.nlm.nih.gov'))
-            for datefield in ['UPDATE_DATE', 'DOWNLOAD_DATE', 'IMPORT_DATE']:
-                if datefield in fieldname_set: field[datefield] = clean_str(date_str)
-            c_metadataxml = metadata_paths[path].get('c_metadataxml', '')
-            field['C_METADATAXML'] = clean_str(c_metadataxml) if c_metadataxml else ''
-            if 'TTY' in fieldname_set: field['TTY'] = clean_str(metadata_paths[path].get('tty',''))  # TTY
-            # Deal with fields, requested by SHRINE metadata (etc), not 'standard' but need to be in CSV.
-            # ==> For now, initialized as an empty string in field and will show up as such in the result. e.g. |||
-            '''
-            if 'C_PATH' in fieldname_set:
-                field['C_PATH'] = clean_str(opts.pathprefix + path_sep \
-                                                         + path_sep.join(reversed(path[1:])) + path_sep)
-            if 'C_SYMBOL' in fieldname_set:
-                field['C_SYMBOL'] = clean_str(path[0])
-            '''
-            print(make_utf8('|'.join(field[x] for x in fieldnames)), file=self.fout)
+        ''' write the rows of a dictionary of path => row, in path order '''
+        self.write_sorted_metadata_rows((path, metadata_paths[path]) for path in sorted(metadata_paths.keys()))
+
+    def write_unsorted_metadata_rows(self, path_rows, max_rows_in_memory=100000):
+        ''' write (path, row) pairs given in any order, at most max_rows_in_memory rows are held at once '''
+        self.write_sorted_metadata_rows(sorted_metadata_rows(path_rows, max_rows_in_memory))
+
+    def write_sorted_metadata_rows(self, path_rows):
+        ''' write (path, row) pairs given in path order, ValueError if a path is out of order '''
+        if self.format_workers > 1:
+            return self.write_sorted_metadata_rows_in_parallel(path_rows)
+        format_row, fout = self.format_row, self.fout
+        lines = []
+        for path, row in path_order_checked(path_rows):
+            lines.append(format_row(path, row))
+            if len(lines) >= WRITE_CHUNK_ROWS: # written in large chunks, not line by line
+                fout.write(make_utf8(''.join(lines)))
+                lines = []
         # end for path
+        fout.write(make_utf8(''.join(lines)))
+        return
+
+    def write_sorted_metadata_rows_in_parallel(self, path_rows):
+        '''
+        same result as write_sorted_metadata_rows, chunks of rows are formatted by the format pool.
+        The rows are read in this thread (the builders' row generators read the cache, and a SQLite
+        connection is used by its own thread only), and at most 2 chunks per format worker are pending,
+        so the rows are not all read ahead into memory.
+        '''
+        if self.format_pool is None:
+            self.format_pool = mp.Pool(self.format_workers, initializer=init_format_worker,
+                                       initargs=(self.fieldnames, self.date_str))
+        pending = deque() # results of the chunks submitted, in chunk (path) order
+        max_pending = 2 * self.format_workers
+
+        def submit(chunk):
+            if len(pending) >= max_pending: # write the oldest before reading more rows
+                self.fout.write(make_utf8(pending.popleft().get()))
+            pending.append(self.format_pool.apply_async(format_rows_chunk, (chunk,)))
+
+        chunk = []
+        for path_row in path_order_checked(path_rows):
+            chunk.append(path_row)
+            if len(chunk) >= FORMAT_CHUNK_ROWS:
+                submit(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            submit(chunk)
+        while len(pending) > 0:
+            self.fout.write(make_utf8(pending.popleft().get()))
         return
 
+
     def close(self):
+        if self.format_pool is not None:
+            self.format_pool.close()
+            self.format_pool.join()
         self.fout.close()
 
-# end class metadata_writer
\ No newline at end of file
+# end class metadata_writer
+
+def sorted_metadata_rows(path_rows, max_rows_in_memory=100000):
+    '''
+    (path, row) pairs in path order, from pairs in any order -- external merge sort: sorted runs of
+    max_rows_in_memory rows are spilled to temporary files (JSON lines), then merged.
+    '''
+    runs, rows = [], []
+    for path_row in path_rows:
+        rows.append(path_row)
+        if len(rows) >= max_rows_in_memory:
+            run_file = tempfile.TemporaryFile(mode='w+')
+            for path, row in sorted(rows, key=lambda x: x[0]):
+                run_file.write(json.dumps([path, row]) + '\n')
+            run_file.seek(0)
+            runs.append(run_file)
+            rows = []
+    rows.sort(key=lambda x: x[0])
+    if len(runs) == 0: # fits in memory
+        for path_row in rows:
+            yield path_row
+        return
+    run_rows = [(tuple(json.loads(line)) for line in run_file) for run_file in runs] + [iter(rows)]
+    for path_row in heapq.merge(*run_rows, key=lambda x: x[0]):
+        yield path_row
+    for run_file in runs:
+        run_file.close()
+# end sorted_metadata_rows
+
+def read_metadata_header(fin):
+    ''' field names of the header line, fin is a binary file positioned at the start '''
+    return fin.readline().decode('utf-8').rstrip('\n').rstrip('\r').split('|')
+
+def c_fullname_position(fieldnames):
+    ''' position of C_FULLNAME in the header's field names (--csv_fields_file may put it anywhere) '''
+    return fieldnames.index('C_FULLNAME') if 'C_FULLNAME' in fieldnames else 0
+
+def metadata_file_runs(metadata_fn, key_position):
+    ''' (start, end) file positions of the runs of rows in C_FULLNAME order, C_FULLNAME the field at key_position '''
+    runs = []
+    with open(metadata_fn, 'rb') as fin:
+        read_metadata_header(fin)
+        start = position = fin.tell()
+        previous_c_fullname = None
+        for line in iter(fin.readline, b''):
+            c_fullname = line.decode('utf-8').rstrip('\n').rstrip('\r').split('|')[key_position]
+            if previous_c_fullname is not None and c_fullname < previous_c_fullname: # next run starts here
+                runs.append((start, position))
+                start = position
+            previous_c_fullname = c_fullname
+            position += len(line)
+        if position > start:
+            runs.append((start, position))
+    return runs
+# end metadata_file_runs
+
+def metadata_run_rows(metadata_fn, start, end, key_position, compared_positions):
+    ''' (C_FULLNAME, row digest, file position, length) of the rows of one run, in C_FULLNAME order '''
+    with open(metadata_fn, 'rb') as fin:
+        fin.seek(start)
+        position = start
+        while position < end:
+            line = fin.readline()
+            fields = line.decode('utf-8').rstrip('\n').rstrip('\r').split('|')
+            compared = '|'.join(fields[idx] for idx in compared_positions if idx < len(fields))
+            yield fields[key_position], hashlib.md5(compared.encode('utf-8')).hexdigest(), position, len(line)
+            position += len(line)
+# end metadata_run_rows
+
+def write_row_index(metadata_fn, row_index_fn=None):
+    ''' Write the row index of a metadata file (default <metadata file>.rowindex), return its filename '''
+    row_index_fn = row_index_fn or (metadata_fn + ROW_INDEX_SUFFIX)
+    with open(metadata_fn, 'rb') as fin:
+        fieldnames = read_metadata_header(fin)
+    key_position = c_fullname_position(fieldnames)
+    compared_positions = [idx for idx, x in enumerate(fieldnames) if x not in DATE_FIELDNAMES]
+    runs = [metadata_run_rows(metadata_fn, start, end, key_position, compared_positions)
+            for start, end in metadata_file_runs(metadata_fn, key_position)]
+    with io.open(row_index_fn, 'w', encoding='utf-8') as fout:
+        for c_fullname, digest, position, length in heapq.merge(*runs):
+            fout.write(u'%s\t%d\t%d\t%s\n' % (digest, position, length, c_fullname))
+    return row_index_fn
+# end write_row_index
+
+def read_row_index(row_index_fn):
+    ''' (C_FULLNAME, row digest, file position, length) of each row, in C_FULLNAME order '''
+    with io.open(row_index_fn, 'r', encoding='utf-8') as fin:
+        for line in fin:
+            digest, position, length, c_fullname = line.rstrip('\n').split('\t', 3)
+            yield c_fullname, digest, int(position), int(length)
+# end read_row_index
+
+def get_row_index(metadata_fn):
+    ''' row index filename of a metadata file, written unless there is one at least as new as the file '''
+    row_index_fn = metadata_fn + ROW_INDEX_SUFFIX
+    if os.path.exists(row_index_fn) and os.path.getmtime(row_index_fn) >= os.path.getmtime(metadata_fn):
+        return row_index_fn
+    return write_row_index(metadata_fn, row_index_fn)
+# end get_row_index
+
+def is_metadata_file_of(previous_fn, current_fn):
+    ''' previous_fn is current_fn, or its row index -- the current build overwrites both '''
+    if previous_fn.endswith(ROW_INDEX_SUFFIX):
+        previous_fn = previous_fn[:-len(ROW_INDEX_SUFFIX)]
+    return os.path.realpath(previous_fn) == os.path.realpath(current_fn)
+# end is_metadata_file_of
+
+def write_metadata_delta(previous_fn, current_fn, delta_fn_prefix):
+    '''
+    Write the rows of current_fn not in previous_fn to <delta_fn_prefix>.insert.txt, the changed rows
+    to <delta_fn_prefix>.update.txt, and the rows of previous_fn not in current_fn to
+    <delta_fn_prefix>.delete.txt.  previous_fn may also be the row index of the previous metadata
+    file (<previous metadata file>.rowindex), the metadata file itself is then needed only for deleted rows.
+    Returns the number of rows in each file, {'insert': n, 'update': n, 'delete': n}.
+    previous_fn must be kept under another name than current_fn (ValueError), whose row index is rewritten.
+    '''
+    if is_metadata_file_of(previous_fn, current_fn):
+        raise ValueError('Previous metadata file [%s] is the current one [%s], keep it under another name'
+                         % (previous_fn, current_fn))
+    if previous_fn.endswith(ROW_INDEX_SUFFIX):
+        previous_row_index_fn, previous_fn = previous_fn, previous_fn[:-len(ROW_INDEX_SUFFIX)]
+    else:
+        previous_row_index_fn = get_row_index(previous_fn)
+    current_row_index_fn = write_row_index(current_fn)
+    counts = {'insert': 0, 'update': 0, 'delete': 0}
+    fins = {'current': open(current_fn, 'rb'), 'previous': None}
+    header = fins['current'].readline()
+    fouts = {kind: open('%s.%s.txt' % (delta_fn_prefix, kind), 'wb') for kind in counts}
+
+    def copy_row(kind, source, position, length):
+        if fins[source] is None:
+            fins[source] = open(previous_fn, 'rb') # only needed for deleted rows
+        fins[source].seek(position)
+        fouts[kind].write(fins[source].read(length))
+        counts[kind] += 1
+
+    for fout in fouts.values():
+        fout.write(header)
+    previous_rows, current_rows = read_row_index(previous_row_index_fn), read_row_index(current_row_index_fn)
+    previous_row, current_row = next(previous_rows, None), next(current_rows, None)
+    while previous_row is not None or current_row is not None: # merge join on C_FULLNAME
+        if previous_row is None or (current_row is not None and current_row[0] < previous_row[0]):
+            copy_row('insert', 'current', current_row[2], current_row[3])
+            current_row = next(current_rows, None)
+        elif current_row is None or previous_row[0] < current_row[0]:
+            copy_row('delete', 'previous', previous_row[2], previous_row[3])
+            previous_row = next(previous_rows, None)
+        else:
+            if previous_row[1] != current_row[1]: # row digests differ
+                copy_row('update', 'current', current_row[2], current_row[3])
+            previous_row, current_row = next(previous_rows, None), next(current_rows, None)
+    for f in list(fouts.values()) + list(fins.values()):
+        if f is not None:
+            f.close()
+    return counts
+# end write_metadata_delta
\ No newline at end of file
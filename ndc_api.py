@@ -1,4 +1,5 @@
-import zipfile
+import zipfile, os, sys, mmap, struct, bisect, tempfile
+from array import array
 
 '''
 Module: ndc_api.py
@@ -8,52 +9,132 @@ Author:
 
 Purpose:
     Define ndc_api class, whose current sole purpose is to provide the get_ndc_name method
-    for determining the name given by the FDA for an NDC code.  This is determined from a file
-    provided by the FDA.
+    (and get_ndc_names, for many codes) for determining the name given by the FDA for an NDC code.
+    This is determined from a file provided by the FDA.
+
+    The names are read from a binary index of the FDA file, ndc_names_from_fda.ndcindex, which is
+    built (once) from ndc_names_from_fda.zip when it is missing or older than the zip file, and is
+    memory-mapped by each ndc_api object -- all builders and processes share the same pages:
+
+        header      magic, count of NDC codes, size of names
+        keys        count int64, the 11-digit NDC codes as integers, sorted
+        offsets     count+1 uint32, the name of keys[i] is names[offsets[i]:offsets[i+1]]
+        names       the names, utf-8
 '''
 
-class ndc_api:
+NDC_ZIP_FILENAME = 'ndc_names_from_fda.zip'
+NDC_CSV_FILENAME = 'ndc_names_from_fda.csv'
+NDC_INDEX_FILENAME = 'ndc_names_from_fda.ndcindex'
+NDC_INDEX_MAGIC = b'NDCIDX1' + (b'L' if sys.byteorder == 'little' else b'B') # arrays are native order
+NDC_INDEX_HEADER = struct.Struct('<8sQQ')
 
-    def __init__(self):
-
-        def read_name_mapping_from_fda_file():
-            ndc_zip_filename = 'ndc_names_from_fda.zip'
-            zf = zipfile.ZipFile(ndc_zip_filename)
-            ndc_csv_filename = 'ndc_names_from_fda.csv'
-            ndc_to_name = {}
-            ndc_code_set = set()
-            fin = None
-            try:
-                fin = zf.open(ndc_csv_filename)
-            except Exception as e:
-                print('Could not open <<<%s>>> in <<<%s>>>' % (ndc_csv_filename, ndc_zip_filename))
-                print(str(e))  # error message
-                # terminate program by not passing the exception
-            first_line = True
-            while True:
-                rawline = fin.readline()
-                if not rawline: break  # EOF
-                if first_line: first_line = False; continue  # skip header, (NDC_CODE NDC_NAME)
-                line = rawline.decode('latin-1').rstrip('\n').rstrip('\r')  # decode (because of zipfile) and chomp
-                # eg: NDC:00003085722 SPRYCEL (dasatinib) 1 BOTTLE in 1 CARTON (0003-0857-22)  > 30 TABLET in 1 BOTTLE
-                fields = line.split('\t')  # tab-separated
-                ndc_code = fields[0][4:]  # skip past 'NDC:'
-                if len(ndc_code) != 11: raise ValueError('NDC code [%s] is not length 11' % ndc_code)
-                ndc_name = fields[1].strip('"')  # drop optional surrounding quotes
-                ndc_to_name[ndc_code] = (ndc_name, 'NLM:RXNORM:RESTAPI')
-                ndc_code_set.add(ndc_code)
-            fin.close()
-            # done building ndc_to_name dictionary
-            return ndc_to_name
-        # end read_name_mapping_from_fda_file
-
-        self.ndc_to_name = read_name_mapping_from_fda_file()
+def read_name_mapping_from_fda_file(ndc_zip_filename=NDC_ZIP_FILENAME):
+    ''' dictionary of NDC code => name, from the FDA file '''
+    zf = zipfile.ZipFile(ndc_zip_filename)
+    ndc_to_name = {}
+    fin = None
+    try:
+        fin = zf.open(NDC_CSV_FILENAME)
+    except Exception as e:
+        print('Could not open <<<%s>>> in <<<%s>>>' % (NDC_CSV_FILENAME, ndc_zip_filename))
+        print(str(e))  # error message
+        # terminate program by not passing the exception
+    first_line = True
+    while True:
+        rawline = fin.readline()
+        if not rawline: break  # EOF
+        if first_line: first_line = False; continue  # skip header, (NDC_CODE NDC_NAME)
+        line = rawline.decode('latin-1').rstrip('\n').rstrip('\r')  # decode (because of zipfile) and chomp
+        # eg: NDC:00003085722 SPRYCEL (dasatinib) 1 BOTTLE in 1 CARTON (0003-0857-22)  > 30 TABLET in 1 BOTTLE
+        fields = line.split('\t')  # tab-separated
+        ndc_code = fields[0][4:]  # skip past 'NDC:'
+        if len(ndc_code) != 11 or not ndc_code.isdigit():
+            raise ValueError('NDC code [%s] is not 11 digits' % ndc_code)
+        ndc_to_name[ndc_code] = fields[1].strip('"')  # drop optional surrounding quotes, last one wins
+    fin.close()
+    zf.close()
+    return ndc_to_name
+# end read_name_mapping_from_fda_file
 
+def build_ndc_name_index(ndc_zip_filename=NDC_ZIP_FILENAME, index_filename=NDC_INDEX_FILENAME):
+    ''' write the binary index of the FDA file, replaced atomically (other processes may be reading it) '''
+    ndc_to_name = read_name_mapping_from_fda_file(ndc_zip_filename)
+    keys, offsets, names = array('q'), array('I', [0]), bytearray()
+    for ndc_code in sorted(ndc_to_name):
+        keys.append(int(ndc_code))
+        names.extend(ndc_to_name[ndc_code].encode('utf-8'))
+        offsets.append(len(names))
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_filename)), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fout:
+        fout.write(NDC_INDEX_HEADER.pack(NDC_INDEX_MAGIC, len(keys), len(names)))
+        fout.write(keys.tobytes())
+        fout.write(offsets.tobytes())
+        fout.write(names)
+    os.chmod(tmp_fn, 0o644)
+    os.replace(tmp_fn, index_filename)
+# end build_ndc_name_index
+
+def ndc_name_index_is_current(ndc_zip_filename, index_filename):
+    if not os.path.exists(index_filename) or os.path.getmtime(index_filename) < os.path.getmtime(ndc_zip_filename):
+        return False
+    with open(index_filename, 'rb') as fin:
+        header = fin.read(NDC_INDEX_HEADER.size)
+    return len(header) == NDC_INDEX_HEADER.size and NDC_INDEX_HEADER.unpack(header)[0] == NDC_INDEX_MAGIC
+# end ndc_name_index_is_current
+
+class ndc_api:
+
+    def __init__(self, ndc_zip_filename=NDC_ZIP_FILENAME, index_filename=NDC_INDEX_FILENAME):
+        if not ndc_name_index_is_current(ndc_zip_filename, index_filename):
+            build_ndc_name_index(ndc_zip_filename, index_filename)
+        with open(index_filename, 'rb') as fin:
+            self.index_mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        count = NDC_INDEX_HEADER.unpack_from(self.index_mmap, 0)[1] # the magic was checked, names run to the end
+        view = memoryview(self.index_mmap)
+        keys_start = NDC_INDEX_HEADER.size
+        offsets_start = keys_start + 8 * count
+        names_start = offsets_start + 4 * (count + 1)
+        self.keys = view[keys_start:offsets_start].cast('q')
+        self.offsets = view[offsets_start:names_start].cast('I')
+        self.names_start = names_start
     # end constructor
 
+    def find(self, ndc_code):
+        ''' position of the NDC code in the index, None if not in it '''
+        if len(ndc_code) != 11 or not ndc_code.isdigit():
+            return None
+        key = int(ndc_code)
+        idx = bisect.bisect_left(self.keys, key)
+        return idx if idx < len(self.keys) and self.keys[idx] == key else None
+    # end find
+
+    def name_at(self, idx):
+        return self.index_mmap[self.names_start + self.offsets[idx]:self.names_start + self.offsets[idx + 1]].decode('utf-8')
+
     def get_ndc_name(self, ndc_code):
-        return self.ndc_to_name[ndc_code][0] if ndc_code in self.ndc_to_name else ndc_code
+        idx = self.find(ndc_code)
+        return ndc_code if idx is None else self.name_at(idx)
     # end get_ndc_name
 
-# end class ndc_api
+    def get_ndc_names(self, ndc_codes):
+        '''
+        Names of the NDC codes, in the order of ndc_codes (the code itself when it has no name, as
+        get_ndc_name).  The codes are sorted and merged with the sorted keys -- each search starts
+        where the one of the previous code ended, so the keys are passed over once.
+        '''
+        ndc_codes = list(ndc_codes)
+        names = list(ndc_codes)
+        keys, key_count, lo = self.keys, len(self.keys), 0
+        offsets, index_mmap, names_start = self.offsets, self.index_mmap, self.names_start
+        bisect_left = bisect.bisect_left
+        for key, pos in sorted((int(ndc_code), pos) for pos, ndc_code in enumerate(ndc_codes)
+                               if len(ndc_code) == 11 and ndc_code.isdigit()):
+            lo = bisect_left(keys, key, lo)
+            if lo == key_count:
+                break
+            if keys[lo] == key:
+                names[pos] = index_mmap[names_start + offsets[lo]:names_start + offsets[lo + 1]].decode('utf-8')
+        return names
+    # end get_ndc_names
 
+# end class ndc_api
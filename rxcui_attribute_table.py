@@ -0,0 +1,140 @@
+from __future__ import print_function
+import sys, time, bisect
+from array import array
+
+'''
+Module: rxcui_attribute_table.py
+
+Purpose:
+    Define rxcui_attribute_table class, the historical attributes of a set of RxCUI codes
+    (NAME, TTY, STATUS, START, END, SCDRXCUI, BOSSRXCUIS), compiled from their 'rxcuihistory'
+    results in one pass over the cache -- each result is read and parsed once.
+
+    The attributes are kept in columns, one entry per RxCUI, in RxCUI order:
+
+        rxcuis          array of RxCUI codes (sorted, searched with bisect)
+        tty, status     arrays of small integer codes, into the lists of distinct TTY and status values
+        start, end      arrays of small integer codes, into the list of distinct date strings
+        names           list of (interned) name strings
+        scd_rxcuis      array, SCD RxCUI of a branded drug, 0 if none
+        boss_offsets    array, the BOSS RxCUIs of entry i are boss_rxcuis[boss_offsets[i]:boss_offsets[i+1]]
+        boss_rxcuis     array of all BOSS RxCUIs
+
+    Used by metadata_writer_task to determine the ingredient and drug RxCUI sets, and by
+    rxnorm_code_maps for the attributes of the ingredients and drugs.
+'''
+
+class rxcui_attribute_table():
+
+    def __init__(self, rxnav, rxcuis, logfile=None):
+        self.rxcuis = array('l')
+        self.has_history = array('b') # 0 ==> no rxcuiConcept in the 'rxcuihistory' result
+        self.tty, self.status, self.start, self.end = array('b'), array('b'), array('H'), array('H')
+        self.names = []
+        self.scd_rxcuis = array('l')
+        self.boss_offsets = array('l', [0])
+        self.boss_rxcuis = array('l')
+        self.values = {'TTY': [], 'STATUS': [], 'DATE': []} # distinct values, the codes are positions in these
+        self.value_codes = {'TTY': {}, 'STATUS': {}, 'DATE': {}}
+        self.compile(rxnav, rxcuis, logfile)
+    # end constructor
+
+    def value_code(self, kind, value):
+        ''' small integer code for the value (TTY, STATUS or DATE) '''
+        code = self.value_codes[kind].get(value)
+        if code is None:
+            code = self.value_codes[kind][value] = len(self.values[kind])
+            self.values[kind].append(value)
+        return code
+    # end value_code
+
+    def compile(self, rxnav, rxcuis, logfile):
+        rxcui_count = len(rxcuis)
+        for idx, rxcui in enumerate(sorted(rxcuis)):
+            if logfile is not None and (idx + 1) % 10000 == 0:  # Track progress
+                print('[%s] Compiling attributes of rxcui %d of %d' % (time.strftime("%Y-%m-%d %H:%M:%S"),
+                                                                       idx + 1, rxcui_count), file=logfile)
+                logfile.flush()
+            d = rxnav.get_historical_rxcui(rxcui) # the only parse of the 'rxcuihistory' result
+            self.rxcuis.append(rxcui)
+            if not ('rxcuiHistoryConcept' in d and 'rxcuiConcept' in d['rxcuiHistoryConcept']):
+                self.has_history.append(0)
+                self.tty.append(self.value_code('TTY', None))
+                self.status.append(self.value_code('STATUS', None))
+                self.start.append(self.value_code('DATE', None))
+                self.end.append(self.value_code('DATE', None))
+                self.names.append(None)
+                self.scd_rxcuis.append(0)
+                self.boss_offsets.append(len(self.boss_rxcuis))
+                continue
+            # same attribute values as rxnav_rest_api_mp.get_historical_rxcui_attributes
+            d1 = d['rxcuiHistoryConcept']['rxcuiConcept']
+            self.has_history.append(1)
+            self.tty.append(self.value_code('TTY', d1['tty']))
+            self.status.append(self.value_code('STATUS', d1['status']))
+            self.start.append(self.value_code('DATE', d1['startDate']))
+            self.end.append(self.value_code('DATE', d1['endDate']))
+            self.names.append(sys.intern(d1['str']))
+            self.scd_rxcuis.append(int(d1['scdRxcui']) if (d1['scdRxcui'] and len(d1['scdRxcui']) > 0) else 0)
+            if 'bossConcept' in d['rxcuiHistoryConcept']:
+                for b in d['rxcuiHistoryConcept']['bossConcept']:
+                    if 'bossRxcui' in b and len(b['bossRxcui']) > 0:
+                        self.boss_rxcuis.append(int(b['bossRxcui']))
+            self.boss_offsets.append(len(self.boss_rxcuis))
+        if logfile is not None:
+            print('[Compiled attributes of %d RxCUIs, %d distinct TTYs, %d distinct dates, %d BOSS RxCUIs]'
+                  % (len(self.rxcuis), len(self.values['TTY']), len(self.values['DATE']), len(self.boss_rxcuis)),
+                  file=logfile)
+            logfile.flush()
+    # end compile
+
+    def find(self, rxcui):
+        ''' position of the RxCUI in the columns, None if not in the table '''
+        idx = bisect.bisect_left(self.rxcuis, rxcui)
+        return idx if idx < len(self.rxcuis) and self.rxcuis[idx] == rxcui else None
+
+    def __contains__(self, rxcui):
+        return self.find(rxcui) is not None
+
+    def __len__(self):
+        return len(self.rxcuis)
+
+    def get_attributes(self, rxcui, attributes):
+        '''
+        Same result as rxnav_rest_api_mp.get_historical_rxcui_attributes, a tuple of the requested
+        attributes, 'NAME','TTY','STATUS','START','END','SCDRXCUI','BOSSRXCUIS'.
+        None if the RxCUI has no history.
+        '''
+        idx = self.find(rxcui)
+        if idx is None:
+            raise KeyError('RxCUI %s not in the attribute table' % str(rxcui))
+        if not self.has_history[idx]:
+            return None
+        result = []
+        for attr_name in attributes:
+            if attr_name == 'NAME':
+                result.append(self.names[idx])
+            elif attr_name == 'TTY':
+                result.append(self.values['TTY'][self.tty[idx]])
+            elif attr_name == 'STATUS':
+                result.append(self.values['STATUS'][self.status[idx]])
+            elif attr_name == 'START':
+                result.append(self.values['DATE'][self.start[idx]])
+            elif attr_name == 'END':
+                result.append(self.values['DATE'][self.end[idx]])
+            elif attr_name == 'SCDRXCUI':
+                result.append(self.scd_rxcuis[idx] if self.scd_rxcuis[idx] else None)
+            elif attr_name == 'BOSSRXCUIS':
+                result.append(list(self.boss_rxcuis[self.boss_offsets[idx]:self.boss_offsets[idx + 1]]))
+            else:
+                raise ValueError('Inavlid attribute [%s] in get_attributes' % attr_name)
+        return tuple(result)
+    # end get_attributes
+
+    def get_rxcuis_with_tty(self, tty_list):
+        ''' set of the RxCUIs whose TTY is one of tty_list, no parsing -- a scan of the TTY codes '''
+        tty_codes = set(self.value_codes['TTY'][x] for x in tty_list if x in self.value_codes['TTY'])
+        return set(self.rxcuis[idx] for idx, tty_code in enumerate(self.tty) if tty_code in tty_codes)
+    # end get_rxcuis_with_tty
+
+# end class rxcui_attribute_table
@@ -0,0 +1,67 @@
+from __future__ import print_function
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Module: rxnav_async_fetch.py
+
+Purpose:
+    Define rxnav_async_fetch class, an asyncio engine which keeps many REST API requests
+    in flight at once on behalf of a single rxnav_rest_api_mp object.
+
+    Each request is still made by the blocking fetch function of rxnav_rest_api_mp
+    (requests library), run on a thread pool by the event loop.  The event loop bounds the
+    number of requests in flight with a semaphore and hands each result to the caller's
+    result function, in the event loop thread, as soon as it arrives.  Since the result
+    function always runs in one thread, it does not need any locking.
+
+    Throughput of a worker is then max_in_flight / latency instead of 1 / latency.
+'''
+
+class rxnav_async_fetch():
+
+    def __init__(self, fetch_fn, max_in_flight):
+        self.fetch_fn = fetch_fn # blocking fn(request_url) ==> JSON text, raises on failure
+        self.max_in_flight = max(1, max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self.loop = asyncio.new_event_loop()
+        self.failed_request_count = 0
+    # end constructor
+
+    def fetch_all(self, request_urls, result_fn, failure_fn=None):
+        '''
+        Fetch all the given URLs, calling result_fn(request_url, json_text) for each success.
+        Failed requests are counted and skipped (failure_fn(request_url, exception) is called for each,
+        if given), the caller decides what to do about them.
+        Returns the number of successful requests.
+        '''
+        return self.loop.run_until_complete(self.fetch_all_async(request_urls, result_fn, failure_fn))
+    # end fetch_all
+
+    async def fetch_all_async(self, request_urls, result_fn, failure_fn):
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        fetched = [0]
+
+        async def fetch_one(request_url):
+            async with semaphore:
+                try:
+                    json_text = await self.loop.run_in_executor(self.executor, self.fetch_fn, request_url)
+                except Exception as e:
+                    self.failed_request_count += 1
+                    if failure_fn is not None:
+                        failure_fn(request_url, e)
+                    return
+            result_fn(request_url, json_text)
+            fetched[0] += 1
+        # end fetch_one
+
+        await asyncio.gather(*[fetch_one(x) for x in request_urls])
+        return fetched[0]
+    # end fetch_all_async
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.loop.close()
+    # end close
+
+# end class rxnav_async_fetch
@@ -0,0 +1,237 @@
+from __future__ import print_function
+import io, os, struct, hashlib, bisect
+from array import array
+
+'''
+Module: rxnav_cache_index.py
+
+Purpose:
+    Define rxnav_cache_index class, the compact on-disk index of the 3-line cache file
+    written by the Cache Writer.  The index is a sidecar file, <cache filename>.idx,
+    which maps a 64-bit hash of each REST API url to the position, length and date of
+    its cache entry:
+
+        header:  8-byte magic, sorted record count, cache size covered by sorted records
+        records: (url hash, file position, entry length, data date as YYYYMMDD integer)
+
+    The first 'sorted record count' records are sorted by url hash, the records after those
+    were appended by the Cache Writer (in cache file order) since the index was last compacted.
+    The Cache Writer compacts (sorts) the index when it closes it.
+
+    Loading the index is one bulk read of the sidecar file -- the hashes of the sorted records
+    are kept in an array and searched with bisect, the appended records are kept in a small
+    dictionary.  No url strings are held in memory.
+
+    When the sidecar is missing, or does not cover the whole cache file (e.g. cache written by
+    an older version of this software, or a crash), the uncovered part of the cache file is
+    scanned to bring the index up to date.
+
+    A hash can in principle collide, so readers check the url on the first line of the cache
+    entry before using it (see rxnav_cache_store.file_cache_store.lookup).
+'''
+
+INDEX_MAGIC = b'RXCIDX01'
+INDEX_HEADER = struct.Struct('<8sQQ') # magic, sorted record count, cache size covered by sorted records
+INDEX_RECORD = struct.Struct('<QQII') # url hash, file position, entry length, data date (YYYYMMDD)
+
+def chomp(s): return s.rstrip('\n').rstrip('\r')
+
+def url_hash(request_url):
+    return struct.unpack('<Q', hashlib.md5(request_url.encode('utf-8')).digest()[:8])[0]
+
+class rxnav_cache_index():
+
+    def __init__(self, cache_filename, logfile, writable=False):
+        self.cache_filename = cache_filename
+        self.index_filename = cache_filename + '.idx'
+        self.logfile = logfile
+        self.writable = writable # only the Cache Writer (or the manager, before it starts) writes the index
+        self.sorted_hashes = array('Q') # hashes of the sorted records
+        self.sorted_records = b'' # raw sorted records, unpacked on lookup
+        self.sorted_covered_size = 0
+        self.appended = {} # url hash => (file position, entry length, data date), records after the sorted ones
+        self.appended_records = [] # raw appended records, in file order (written by compact)
+        self.appended_new_count = 0 # appended hashes not in the sorted records, counted once
+        self.index_file = None # open for append when writable
+        self.load()
+    # end constructor
+
+    def load(self):
+        cache_size = os.path.getsize(self.cache_filename) if os.path.exists(self.cache_filename) else 0
+        covered_size = 0
+        if os.path.exists(self.index_filename):
+            with io.open(self.index_filename, 'rb') as f:
+                data = f.read() # one bulk read
+            covered_size = self.load_index_data(data, cache_size)
+        if covered_size == 0 and (self.sorted_hashes or self.appended):
+            self.reset() # unusable index, start over
+        if self.writable:
+            if not os.path.exists(self.index_filename) or covered_size == 0:
+                self.write_index_file() # (re)create sidecar, header and any sorted records
+            self.index_file = io.open(self.index_filename, 'r+b')
+            self.index_file.truncate(INDEX_HEADER.size + (len(self.sorted_hashes)
+                                                          + len(self.appended_records)) * INDEX_RECORD.size)
+            self.index_file.seek(0, 2)
+        if covered_size < cache_size: # cache file has entries the index does not know about
+            self.scan_cache_file(covered_size)
+        print('[Cache index [%s] has %d entries]' % (self.index_filename, len(self)), file=self.logfile)
+        self.logfile.flush()
+    # end load
+
+    def load_index_data(self, data, cache_size):
+        '''
+        Set up the sorted and appended records from the contents of the index file.
+        Return the size of the cache file covered by the index, 0 if the index can't be used.
+        '''
+        if len(data) < INDEX_HEADER.size:
+            return 0
+        magic, sorted_count, sorted_covered_size = INDEX_HEADER.unpack_from(data, 0)
+        record_count = (len(data) - INDEX_HEADER.size) // INDEX_RECORD.size
+        if magic != INDEX_MAGIC or sorted_count > record_count or sorted_covered_size > cache_size:
+            print('[Cache index [%s] does not match the cache file, rebuilding it]' % self.index_filename,
+                  file=self.logfile)
+            return 0
+        sorted_end = INDEX_HEADER.size + sorted_count * INDEX_RECORD.size
+        self.sorted_records = data[INDEX_HEADER.size:sorted_end]
+        # every 3rd 8-byte word of the sorted records is the url hash
+        self.sorted_hashes = array('Q', memoryview(self.sorted_records).cast('Q')[0::3])
+        self.sorted_covered_size = sorted_covered_size
+        covered_size = sorted_covered_size
+        for idx in range(sorted_count, record_count):
+            record = data[INDEX_HEADER.size + idx * INDEX_RECORD.size:INDEX_HEADER.size + (idx+1) * INDEX_RECORD.size]
+            hash_value, file_position, entry_length, data_date = INDEX_RECORD.unpack(record)
+            if file_position + entry_length > cache_size:
+                break # record written, but its cache entry was not (crash) ==> drop it and what follows
+            self.append_record(hash_value, record, (file_position, entry_length, data_date))
+            covered_size = max(covered_size, file_position + entry_length)
+        if sorted_count == 0 and len(self.appended) == 0:
+            return 0 # empty index, same as no index
+        return covered_size
+    # end load_index_data
+
+    def reset(self):
+        self.sorted_hashes = array('Q')
+        self.sorted_records = b''
+        self.sorted_covered_size = 0
+        self.appended = {}
+        self.appended_records = []
+        self.appended_new_count = 0
+    # end reset
+
+    def scan_cache_file(self, start_position):
+        # Process the cache file entries starting at start_position.
+        # Each cache entry consists of 3 lines
+        #   1. URL (REST API url whose result is cached)
+        #   2. Date (date of information, YYYYMMDD)
+        #   3. JSON result
+        print('Reading existing cache from position %d' % start_position, file=self.logfile); self.logfile.flush()
+        cache_entries = 0
+        line_number = 0
+        with io.open(self.cache_filename, 'rb') as f:
+            f.seek(start_position)
+            while True:
+                file_position_of_cache_entry = f.tell()
+                # Read next cache entry (3 lines)
+                rawlines = [ x for x in [ f.readline() for idx_temp in range(3) ] if len(x) > 0 ]
+                if len(rawlines)==0: break # acceptable ending to cache file, multiple of 3 lines
+                if not self.writable and (len(rawlines)!=3 or not rawlines[2].endswith(b'\n')):
+                    break # Cache Writer is in the middle of writing this entry, it is not in the cache yet
+                if len(rawlines)!=3: raise ValueError('*** Cache file format error, not in groups of 3 lines ***')
+                line_number += 3
+                # Extract data ==> L1 is REST API url, L2 is data date (YYYYMMDD), L3 is JSON result
+                rest_api_url, data_date = [ chomp(rawlines[i].decode('utf-8')) for i in [0,1] ]
+                if len(data_date) != 8:
+                    raise ValueError('*** Cache file format, date not YYYYMMDD, line %d ***' % (line_number -1))
+                self.add(rest_api_url, file_position_of_cache_entry, f.tell() - file_position_of_cache_entry, data_date)
+                cache_entries += 1
+                if cache_entries % 10000 == 0:
+                    print('..Read %d entries from cache' % cache_entries, file=self.logfile)
+                    self.logfile.flush()
+        # done reading, at EOF
+        self.flush()
+        print('[Done reading cache, found %d entries not in the index]' % cache_entries, file=self.logfile)
+        self.logfile.flush()
+    # end scan_cache_file
+
+    def lookup(self, request_url):
+        ''' Return (file position, entry length, data date string) for the url, None if not in the cache '''
+        hash_value = url_hash(request_url)
+        if hash_value in self.appended: # appended records are later than the sorted ones, check them first
+            file_position, entry_length, data_date = self.appended[hash_value]
+            return file_position, entry_length, '%08d' % data_date
+        idx = bisect.bisect_left(self.sorted_hashes, hash_value)
+        if idx < len(self.sorted_hashes) and self.sorted_hashes[idx] == hash_value:
+            hash_value, file_position, entry_length, data_date = \
+                INDEX_RECORD.unpack_from(self.sorted_records, idx * INDEX_RECORD.size)
+            return file_position, entry_length, '%08d' % data_date
+        return None
+    # end lookup
+
+    def __contains__(self, request_url):
+        return self.lookup(request_url) is not None
+
+    def __len__(self): # unique urls, an appended record may replace a sorted one (entry written again)
+        return len(self.sorted_hashes) + self.appended_new_count
+
+    def in_sorted_records(self, hash_value):
+        idx = bisect.bisect_left(self.sorted_hashes, hash_value)
+        return idx < len(self.sorted_hashes) and self.sorted_hashes[idx] == hash_value
+
+    def append_record(self, hash_value, record, entry):
+        if hash_value not in self.appended and not self.in_sorted_records(hash_value):
+            self.appended_new_count += 1
+        self.appended[hash_value] = entry
+        self.appended_records.append(record)
+
+    def add(self, request_url, file_position, entry_length, data_date):
+        ''' Record a cache entry (written by the Cache Writer, or found by scan_cache_file) '''
+        hash_value = url_hash(request_url)
+        record = INDEX_RECORD.pack(hash_value, file_position, entry_length, int(data_date))
+        self.append_record(hash_value, record, (file_position, entry_length, int(data_date)))
+        if self.index_file is not None:
+            self.index_file.write(record)
+    # end add
+
+    def flush(self, fsync=False):
+        if self.index_file is not None:
+            self.index_file.flush()
+            if fsync:
+                os.fsync(self.index_file.fileno())
+
+    def write_index_file(self):
+        ''' Write the whole index file, all records sorted by url hash (later record wins for duplicates) '''
+        hashes = array('Q', self.sorted_hashes)
+        records = [self.sorted_records[idx * INDEX_RECORD.size:(idx+1) * INDEX_RECORD.size]
+                   for idx in range(len(self.sorted_hashes))]
+        covered_size = self.sorted_covered_size
+        for record in self.appended_records:
+            hash_value, file_position, entry_length, data_date = INDEX_RECORD.unpack(record)
+            hashes.append(hash_value)
+            records.append(record)
+            covered_size = max(covered_size, file_position + entry_length)
+        order = sorted(range(len(hashes)), key=hashes.__getitem__) # stable, duplicates stay in file order
+        keep = [idx for pos, idx in enumerate(order)
+                if pos + 1 == len(order) or hashes[order[pos + 1]] != hashes[idx]] # last of each duplicate run
+        self.sorted_records = b''.join(records[idx] for idx in keep)
+        self.sorted_hashes = array('Q', (hashes[idx] for idx in keep))
+        self.sorted_covered_size = covered_size
+        self.appended = {}
+        self.appended_records = []
+        self.appended_new_count = 0
+        temp_filename = self.index_filename + '.tmp'
+        with io.open(temp_filename, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(self.sorted_hashes), covered_size))
+            f.write(self.sorted_records)
+        os.replace(temp_filename, self.index_filename)
+    # end write_index_file
+
+    def close(self):
+        ''' Writable index ==> compact it, so the next load is a single bulk read with no dictionary to build '''
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+            if len(self.appended_records) > 0:
+                self.write_index_file()
+    # end close
+
+# end class rxnav_cache_index
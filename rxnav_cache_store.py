@@ -0,0 +1,193 @@
+from __future__ import print_function
+import io, os, datetime, sqlite3, pathlib
+from rxnav_cache_index import rxnav_cache_index
+
+'''
+Module: rxnav_cache_store.py
+
+Purpose:
+    Define the cache storage backends used by rxnav_rest_api_mp, selected by --cache_backend.
+
+    file_cache_store   -- (default) the append-only 3-line cache file (URL, date, JSON result)
+                          with its index sidecar file (rxnav_cache_index.py).  Only the Cache
+                          Writer writes it, workers see the contents present when they started.
+
+    sqlite_cache_store -- a SQLite database with one row per REST API url (url is the primary key),
+                          in WAL mode so that all workers can read it while the Cache Writer writes it.
+                          Writes are batched into transactions, so a crash never leaves a partial entry,
+                          and workers see each other's results as soon as a batch is committed.
+
+    Both backends provide the same methods:
+        lookup(request_url)            JSON text for the url, None if not in the cache
+        request_url in store           url is in the cache
+        len(store)                     number of cache entries
+        write(request_url, json_text)  add entry (Cache Writer only)
+        write_batch(cache_entries)     add (request_url, json_text) entries in one write (Cache Writer only),
+                                       returns the UTF-8 bytes written
+        flush(fsync=False), close()
+'''
+
+CACHE_BACKENDS = ['file', 'sqlite']
+
+def chomp(s): return s.rstrip('\n').rstrip('\r')
+
+def get_data_date():
+    return '{:%Y%m%d}'.format(datetime.datetime.now())
+
+def open_cache_store(cache_filename, logfile, cache_backend='file', writable=False):
+    if cache_backend == 'file':
+        return file_cache_store(cache_filename, logfile, writable)
+    elif cache_backend == 'sqlite':
+        return sqlite_cache_store(cache_filename, logfile, writable)
+    raise ValueError('Invalid cache backend [%s], valid values: %s' % (cache_backend, str(CACHE_BACKENDS)))
+# end open_cache_store
+
+def prepare_cache_store(cache_filename, logfile, cache_backend='file'):
+    '''
+    Create the cache if it does not exist and bring it up to date (e.g. the file backend index),
+    before any of the processes which read it are started.
+    '''
+    open_cache_store(cache_filename, logfile, cache_backend, writable=True).close()
+# end prepare_cache_store
+
+# ------------------- 3-line cache file, with index sidecar -------------------
+
+class file_cache_store():
+
+    def __init__(self, cache_filename, logfile, writable=False):
+        self.cache_filename = cache_filename
+        self.logfile = logfile
+        if writable and not os.path.exists(cache_filename):
+            io.open(cache_filename, 'ab').close() # create empty cache file
+        # worker only has read-access, all have tell(), seek()
+        self.cache_file = io.open(cache_filename, ('a+b' if writable else 'rb'))
+        self.cache_file_at_EOF = False
+        # index of REST API url => (file-position, entry length, data date) of the cache entries
+        self.index = rxnav_cache_index(cache_filename, logfile, writable=writable)
+    # end constructor
+
+    def lookup(self, request_url):
+        ''' Return the JSON text cached for the url, None if not in the cache '''
+        cache_entry = self.index.lookup(request_url) # (file_position, entry_length, data_date)
+        if cache_entry is None:
+            return None
+        file_position_of_cache_entry, entry_length, data_date = cache_entry
+        self.cache_file.seek(file_position_of_cache_entry)
+        self.cache_file_at_EOF = False # Track that position is moved
+        # read the whole 3 line cache entry -- URL, date, JSON result (r.text value from REST API call)
+        cached_url, cached_date, json_text = self.cache_file.read(entry_length).decode('utf-8').split('\n', 2)
+        if chomp(cached_url) != request_url: # index is keyed by a hash of the url, and hashes can collide
+            return None
+        return chomp(json_text)
+    # end lookup
+
+    def __contains__(self, request_url):
+        return request_url in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def write(self, request_url, json_text):
+        self.write_batch([(request_url, json_text)])
+
+    def write_batch(self, cache_entries):
+        # write 3 lines per entry to end of cache file -- URL, data_date, JSON result
+        if not self.cache_file_at_EOF:
+            self.cache_file.seek(0, 2)  # seek to EOF
+            self.cache_file_at_EOF = True
+        # JGP 2018-05-22 - write all 3 lines at once, the position of the first line is the cache position
+        file_position = self.cache_file.tell()
+        data_date = get_data_date()
+        encoded_entries = [(request_url+'\n'+data_date+'\n'+json_text+'\n').encode('utf-8')
+                           for request_url, json_text in cache_entries]
+        batch_bytes = b''.join(encoded_entries)
+        self.cache_file.write(batch_bytes) # whole batch in one write
+        for (request_url, json_text), cache_entry in zip(cache_entries, encoded_entries):
+            self.index.add(request_url, file_position, len(cache_entry), data_date) # track position in the index
+            file_position += len(cache_entry)
+        return len(batch_bytes)
+    # end write_batch
+
+    def flush(self, fsync=False):
+        ''' Flush the cache file, then the index which refers to it.  fsync ==> also force both to disk '''
+        self.cache_file.flush()
+        if fsync:
+            os.fsync(self.cache_file.fileno())
+        self.index.flush(fsync)
+
+    def close(self):
+        ''' flush the cache file, then write the (compacted) index which refers to it '''
+        if self.cache_file is not None:
+            self.cache_file.flush()
+            self.index.close()
+            self.cache_file.close()
+            self.cache_file = None
+    # end close
+
+# end class file_cache_store
+
+# ------------------- SQLite database -------------------
+
+class sqlite_cache_store():
+
+    def __init__(self, cache_filename, logfile, writable=False, batch_size=500):
+        self.cache_filename = cache_filename
+        self.logfile = logfile
+        self.writable = writable
+        self.batch_size = batch_size # inserts per transaction
+        self.pending_count = 0 # inserts in the open transaction
+        if writable:
+            self.connection = sqlite3.connect(cache_filename, timeout=60)
+            self.connection.execute('PRAGMA journal_mode=WAL') # readers are not blocked by the writer
+            self.connection.execute('PRAGMA synchronous=NORMAL') # WAL is still crash-safe, fsync at checkpoints
+            self.connection.execute('CREATE TABLE IF NOT EXISTS rxnav_cache '
+                                    + '(url TEXT PRIMARY KEY, data_date TEXT NOT NULL, json_text TEXT NOT NULL)')
+            self.connection.commit()
+        else:
+            cache_uri = pathlib.Path(os.path.abspath(cache_filename)).as_uri() # ?, # and % in the path are escaped
+            self.connection = sqlite3.connect(cache_uri + '?mode=ro', uri=True, timeout=60)
+        print('[SQLite cache [%s] has %d entries]' % (cache_filename, len(self)), file=self.logfile)
+        self.logfile.flush()
+    # end constructor
+
+    def lookup(self, request_url):
+        row = self.connection.execute('SELECT json_text FROM rxnav_cache WHERE url = ?', (request_url,)).fetchone()
+        return None if row is None else row[0]
+
+    def __contains__(self, request_url):
+        return self.connection.execute('SELECT 1 FROM rxnav_cache WHERE url = ?', (request_url,)).fetchone() \
+               is not None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM rxnav_cache').fetchone()[0]
+
+    def write(self, request_url, json_text):
+        self.write_batch([(request_url, json_text)])
+
+    def write_batch(self, cache_entries):
+        data_date = get_data_date()
+        self.connection.executemany('INSERT OR REPLACE INTO rxnav_cache (url, data_date, json_text) VALUES (?, ?, ?)',
+                                    [(request_url, data_date, json_text) for request_url, json_text in cache_entries])
+        self.pending_count += len(cache_entries)
+        if self.pending_count >= self.batch_size:
+            self.flush()
+        return sum(len(request_url.encode('utf-8')) + len(data_date) + len(json_text.encode('utf-8'))
+                   for request_url, json_text in cache_entries) # bytes, as the file backend counts them
+    # end write_batch
+
+    def flush(self, fsync=False):
+        ''' commit the open batch of inserts, readers see them from now on.  fsync ==> also checkpoint the WAL '''
+        if self.writable and self.pending_count > 0:
+            self.connection.commit()
+            self.pending_count = 0
+        if self.writable and fsync:
+            self.connection.execute('PRAGMA wal_checkpoint(PASSIVE)') # synchronous=NORMAL syncs at checkpoints
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+    # end close
+
+# end class sqlite_cache_store
@@ -0,0 +1,180 @@
+from __future__ import print_function
+import struct, pickle, queue
+import multiprocessing as mp
+
+'''
+Module: rxnav_cache_transport.py
+
+Purpose:
+    Define the transports which carry cache messages from the workers (and phase 0, phase 3)
+    to the Cache Writer, selected by --cache_transport.  Every transport is created by the manager
+    process before the other processes are started, is passed to them as a process argument, and
+    provides the same two methods as a queue:
+
+        put(message)   send message (any number of sending processes)
+        get(timeout)   wait for and return the next message (one receiving process, the Cache Writer),
+                       raises queue.Empty if none arrived within timeout seconds (None ==> wait for one)
+        close()        release the transport (manager process, after the Cache Writer has stopped)
+
+    manager -- multiprocessing.Manager().Queue(), a proxy to a queue in a separate server process.
+               Each message is pickled to the server, then again from the server to the Cache Writer.
+    queue   -- multiprocessing.Queue, a pipe with a feeder thread in each sending process.
+    pipe    -- one multiprocessing.Pipe, senders take turns through a lock, no feeder thread.
+    shm     -- a ring buffer in multiprocessing.shared_memory holding length-prefixed pickled messages,
+               senders copy the message into the buffer, the Cache Writer copies it out.
+
+    benchmark_cache_transport.py compares the transports.
+'''
+
+CACHE_TRANSPORTS = ['manager', 'queue', 'pipe', 'shm']
+
+def create_cache_transport(cache_transport='manager', shm_buffer_size=64 * 1024 * 1024):
+    if cache_transport == 'manager':
+        return manager_transport()
+    elif cache_transport == 'queue':
+        return queue_transport()
+    elif cache_transport == 'pipe':
+        return pipe_transport()
+    elif cache_transport == 'shm':
+        return shm_ring_buffer_transport(shm_buffer_size)
+    raise ValueError('Invalid cache transport [%s], valid values: %s' % (cache_transport, str(CACHE_TRANSPORTS)))
+# end create_cache_transport
+
+class manager_transport():
+
+    def __init__(self):
+        self.manager = mp.Manager()
+        self.queue = self.manager.Queue()
+
+    def __getstate__(self): # only the queue proxy goes to the other processes, not the manager
+        return {'manager': None, 'queue': self.queue}
+
+    def put(self, message):
+        self.queue.put(message)
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+
+# end class manager_transport
+
+class queue_transport():
+
+    def __init__(self):
+        self.queue = mp.Queue()
+
+    def put(self, message):
+        self.queue.put(message)
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        self.queue.close()
+
+# end class queue_transport
+
+class pipe_transport():
+
+    def __init__(self):
+        self.reader, self.writer = mp.Pipe(duplex=False)
+        self.send_lock = mp.Lock() # a message is written in pieces, one sender at a time
+
+    def put(self, message):
+        with self.send_lock:
+            self.writer.send(message)
+
+    def get(self, timeout=None):
+        if timeout is not None and not self.reader.poll(timeout):
+            raise queue.Empty
+        return self.reader.recv()
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+# end class pipe_transport
+
+class shm_ring_buffer_transport():
+    '''
+    Ring buffer of messages in shared memory.  The first 16 bytes hold the total bytes written and
+    the total bytes read (positions in the buffer are these modulo the buffer size), followed by
+    the buffer.  Each message is a 4-byte length followed by the pickled message, and may wrap
+    around the end of the buffer.  The condition (and its lock) guards the two counts: senders wait
+    on it for room in the buffer, the Cache Writer notifies it after each message it takes out.
+    '''
+
+    COUNTS = struct.Struct('<QQ') # total bytes written, total bytes read
+    LENGTH = struct.Struct('<I') # message length prefix
+
+    def __init__(self, buffer_size):
+        from multiprocessing import shared_memory # python 3.8 or later
+        self.buffer_size = buffer_size
+        self.shm = shared_memory.SharedMemory(create=True, size=self.COUNTS.size + buffer_size)
+        self.COUNTS.pack_into(self.shm.buf, 0, 0, 0)
+        self.condition = mp.Condition(mp.Lock())
+        self.messages_available = mp.Semaphore(0)
+        self.is_owner = True # created the shared memory ==> unlinks it on close
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['is_owner'] = False
+        return state
+
+    def copy_in(self, position, data):
+        start = self.COUNTS.size + position % self.buffer_size
+        first_part = min(len(data), self.COUNTS.size + self.buffer_size - start)
+        self.shm.buf[start:start + first_part] = data[:first_part]
+        if first_part < len(data): # wrap around to the start of the buffer
+            self.shm.buf[self.COUNTS.size:self.COUNTS.size + len(data) - first_part] = data[first_part:]
+
+    def copy_out(self, position, length):
+        start = self.COUNTS.size + position % self.buffer_size
+        first_part = min(length, self.COUNTS.size + self.buffer_size - start)
+        data = bytes(self.shm.buf[start:start + first_part])
+        if first_part < length: # wrapped around to the start of the buffer
+            data += bytes(self.shm.buf[self.COUNTS.size:self.COUNTS.size + length - first_part])
+        return data
+
+    def put(self, message):
+        data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        record = self.LENGTH.pack(len(data)) + data
+        if len(record) > self.buffer_size:
+            raise ValueError('Cache message of %d bytes does not fit in the %d byte shared memory buffer'
+                             % (len(record), self.buffer_size))
+        with self.condition:
+            while True:
+                written, read = self.COUNTS.unpack_from(self.shm.buf, 0)
+                if self.buffer_size - (written - read) >= len(record):
+                    break
+                self.condition.wait() # buffer full, wait for the Cache Writer
+            self.copy_in(written, record)
+            self.COUNTS.pack_into(self.shm.buf, 0, written + len(record), read)
+        self.messages_available.release()
+
+    def get(self, timeout=None):
+        if not self.messages_available.acquire(timeout=timeout):
+            raise queue.Empty
+        with self.condition:
+            written, read = self.COUNTS.unpack_from(self.shm.buf, 0)
+        # senders only write after 'written', so the message can be copied out without the lock
+        length = self.LENGTH.unpack(self.copy_out(read, self.LENGTH.size))[0]
+        data = self.copy_out(read + self.LENGTH.size, length)
+        with self.condition:
+            written, read = self.COUNTS.unpack_from(self.shm.buf, 0)
+            self.COUNTS.pack_into(self.shm.buf, 0, written, read + self.LENGTH.size + length)
+            self.condition.notify_all() # room for waiting senders
+        return pickle.loads(data)
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            if self.is_owner:
+                self.shm.unlink()
+            self.shm = None
+
+# end class shm_ring_buffer_transport
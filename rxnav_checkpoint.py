@@ -0,0 +1,77 @@
+from __future__ import print_function
+import io, os, json, time, hashlib
+
+'''
+Module: rxnav_checkpoint.py
+
+Purpose:
+    Define rxnav_checkpoint class, the checkpoint manifest of the cache building phases,
+    a JSON file next to the cache, <cache filename>.manifest.json:
+
+        {"cache_backend": "file",
+         "phases": {"phase1": {"completed": "2018-09-01 10:00:00",
+                               "input_hash": "<sha1 of the sorted RxCUI codes the phase processed>",
+                               "counts": {"rxcuis": 350000, "dispatched": 12, "cache_entries": 1400000}},
+                    ...}}
+
+    A phase is recorded as complete by the Cache Writer, when it receives the checkpoint message
+    the manager sends after the phase's workers have finished -- all of the phase's results were
+    sent before the checkpoint message, so they are in the cache when the manifest says so.
+
+    On a rerun, a phase which is complete for the same input hash is skipped.  When all phases are
+    complete and the cache still has the entry count recorded by the last phase, building the cache
+    is skipped altogether and the metadata is built from the cache.
+    Recording a phase removes the phases after it, since their inputs come from it.
+'''
+
+PHASES = ['phase0', 'phase1', 'phase2', 'phase3']
+
+def code_set_hash(codes):
+    ''' hash identifying a set of codes (or any values), independent of their order '''
+    return hashlib.sha1('\n'.join(sorted(str(x) for x in codes)).encode('utf-8')).hexdigest()
+
+class rxnav_checkpoint():
+
+    def __init__(self, cache_filename, cache_backend='file'):
+        self.manifest_filename = cache_filename + '.manifest.json'
+        self.cache_backend = cache_backend
+        self.phases = {}
+        if os.path.exists(self.manifest_filename):
+            with io.open(self.manifest_filename, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('cache_backend') == cache_backend: # manifest of another cache ==> start over
+                self.phases = manifest.get('phases', {})
+    # end constructor
+
+    def get_phase(self, phase):
+        ''' checkpoint of the phase, None if not complete '''
+        return self.phases.get(phase)
+
+    def is_phase_complete(self, phase, input_hash):
+        checkpoint = self.phases.get(phase)
+        return checkpoint is not None and checkpoint['input_hash'] == input_hash
+
+    def is_cache_complete(self, cache_entries):
+        ''' all phases complete, and cache unchanged since the last one completed (cache_entries: unique urls) '''
+        if any(phase not in self.phases for phase in PHASES):
+            return False
+        return self.phases[PHASES[-1]]['counts'].get('cache_entries') == cache_entries
+
+    def mark_phase_complete(self, phase, input_hash, counts):
+        self.phases[phase] = {'completed': time.strftime("%Y-%m-%d %H:%M:%S"),
+                              'input_hash': input_hash,
+                              'counts': counts}
+        for later_phase in PHASES[PHASES.index(phase) + 1:]:
+            self.phases.pop(later_phase, None) # based on the previous result of this phase
+        self.save()
+    # end mark_phase_complete
+
+    def save(self):
+        temp_filename = self.manifest_filename + '.tmp'
+        with io.open(temp_filename, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'cache_backend': self.cache_backend, 'phases': self.phases},
+                               indent=2, sort_keys=True))
+        os.replace(temp_filename, self.manifest_filename) # never a partial manifest
+    # end save
+
+# end class rxnav_checkpoint
@@ -0,0 +1,69 @@
+from __future__ import print_function
+import time
+
+'''
+Module: rxnav_incremental.py
+
+Purpose:
+    Determine which RxCUI codes an incremental cache build (--incremental of build_rxnorm_metadata.py)
+    requests from the REST API again, from the status lists of the previous run (those in the cache)
+    and the current status lists ('rxcuihistory/status.json?type=...', see get_historical_rxcuis):
+
+        new               -- not in the previous lists
+        status changed    -- e.g. ACTIVE in the previous lists, RETIRED now
+        active            -- ACTIVE in both, their relationships and NDCs still change
+        recently retired  -- RETIRED in both, but retired within the last retired_months months
+                             (or no end date in the cached 'rxcuihistory' result)
+
+    The cached results of all other codes (retired long ago, never active) are carried forward.
+    Codes which have no cached results at all are requested as in a full build.
+'''
+
+REFRESH_CATEGORIES = ['new', 'status changed', 'active', 'recently retired', 'carried forward']
+
+def months_ago(end_date, now_t):
+    ''' number of months from an 'rxcuihistory' endDate (MMYYYY) to now, None if no date '''
+    if not end_date or len(end_date) != 6 or not end_date.isdigit():
+        return None
+    now = time.localtime(now_t)
+    return (now.tm_year - int(end_date[2:])) * 12 + (now.tm_mon - int(end_date[:2]))
+# end months_ago
+
+def refresh_category(rxnav, rxcui, previous_status, current_status, retired_months, now_t):
+    if previous_status is None:
+        return 'new'
+    if previous_status != current_status:
+        return 'status changed'
+    if current_status == 'ACTIVE':
+        return 'active'
+    if current_status == 'RETIRED':
+        if rxnav.historical_rxcui_url(rxcui) not in rxnav.rxnav_cache:
+            return 'recently retired' # nothing cached to tell, requested in any case
+        attributes = rxnav.get_historical_rxcui_attributes(rxcui, ['END'])
+        months = months_ago(attributes[0], now_t) if attributes is not None else None
+        if months is None or months <= retired_months:
+            return 'recently retired'
+    return 'carried forward'
+# end refresh_category
+
+def determine_refresh_rxcuis(rxnav, previous_status_d, current_status_d, retired_months, logfile=None):
+    '''
+    RxCUI codes (of current_status_d) whose cached results are requested again, and the count of
+    codes in each of REFRESH_CATEGORIES.  rxnav reads the cache of the previous run.
+    '''
+    now_t = time.time()
+    refresh_rxcuis = set()
+    counts = {x: 0 for x in REFRESH_CATEGORIES}
+    for rxcui in sorted(current_status_d):
+        category = refresh_category(rxnav, rxcui, previous_status_d.get(rxcui), current_status_d[rxcui],
+                                    retired_months, now_t)
+        counts[category] += 1
+        if category != 'carried forward':
+            refresh_rxcuis.add(rxcui)
+    if logfile is not None:
+        print('[Incremental build] %d of %d RxCUIs refreshed -- %s'
+              % (len(refresh_rxcuis), len(current_status_d),
+                 ', '.join('%s: %d' % (x, counts[x]) for x in REFRESH_CATEGORIES)), file=logfile)
+        logfile.flush()
+    return refresh_rxcuis, counts
+# end determine_refresh_rxcuis
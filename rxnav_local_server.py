@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys, os, time, random, signal, threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from rxnav_cache_store import open_cache_store, CACHE_BACKENDS
+from rxnav_rest_api_mp import RXNAV_REST_API_BASE_URL
+
+'''
+Script: rxnav_local_server.py
+
+Purpose:
+    Local stand-in for NLM's RxNav REST API, so that the cache build (phases 0 to 3) can be measured
+    without the network.  It serves the endpoints the build requests (rxcuihistory/status.json,
+    rxcuihistory/concept.json, rxcui/<rxcui>/allrelated.json, rxcui/<rxcui>/allhistoricalndcs/json,
+    rxclass/classTree/json, rxclass/classMembers.json) from an existing cache, replaying the results
+    recorded in it: the request path is looked up as NLM's URL (https://rxnav.nlm.nih.gov/REST/...),
+    the cache key.  URLs not in the cache are answered HTTP 404.
+
+    The server can be made to behave like a loaded one:
+
+        --latency <s>, --jitter <s>   each response is delayed latency seconds, plus or minus up to jitter
+        --max_concurrent <count>      requests served at once, the others wait for their turn (0, no limit)
+        --rate_limit <count>          requests per second, those above it are answered HTTP 429 with
+                                      Retry-After: 1, as NLM's service does (0, no limit)
+        --error_rate <fraction>       fraction of the requests answered HTTP 503
+        --drop_rate <fraction>        fraction of the requests whose connection is closed without a response
+
+    The counts of the responses are printed every --stats_interval seconds, and at the end (Ctrl-C).
+    The build is pointed at the server with --rest_api_base_url, its cache keys stay NLM's URLs:
+
+        python rxnav_local_server.py --cache recorded.cache --latency 0.05 --jitter 0.03 --rate_limit 20 &
+        python build_rxnorm_metadata.py --cache new.cache --rest_api_base_url http://127.0.0.1:8765/REST ...
+
+Usage:
+    python rxnav_local_server.py --cache <cache> [--cache_backend file] [--host 127.0.0.1] [--port 8765]
+                                 [--latency 0] [--jitter 0] [--max_concurrent 0] [--rate_limit 0]
+                                 [--error_rate 0] [--drop_rate 0] [--seed 1] [--stats_interval 10] [--verbose]
+'''
+
+def cache_url_of_path(path):
+    ''' cache key (NLM's URL) of a request path, with or without the /REST prefix of the base URL '''
+    if path.startswith('/REST/'):
+        path = path[len('/REST'):]
+    return RXNAV_REST_API_BASE_URL + path
+# end cache_url_of_path
+
+class cache_reader():
+    ''' lookups from the server threads: the file store behind a lock, a SQLite connection per thread '''
+
+    def __init__(self, cache_filename, cache_backend):
+        self.cache_filename = cache_filename
+        self.cache_backend = cache_backend
+        self.null_logfile = open(os.devnull, 'w') # connections opened by the threads log nothing
+        self.store = open_cache_store(cache_filename, sys.stdout, cache_backend)
+        self.entry_count = len(self.store)
+        self.lock = threading.Lock()
+        self.thread_stores = threading.local()
+    # end constructor
+
+    def lookup(self, request_url):
+        if self.cache_backend == 'sqlite': # a SQLite connection is used by the thread which opened it only
+            if getattr(self.thread_stores, 'store', None) is None:
+                self.thread_stores.store = open_cache_store(self.cache_filename, self.null_logfile, 'sqlite')
+            return self.thread_stores.store.lookup(request_url)
+        with self.lock: # the file store seeks and reads one file
+            return self.store.lookup(request_url)
+    # end lookup
+
+# end class cache_reader
+
+class local_rxnav_server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True # a keep-alive connection does not keep the server from stopping
+    request_queue_size = 256
+
+    def __init__(self, server_address, cache, opts):
+        HTTPServer.__init__(self, server_address, local_rxnav_request_handler)
+        self.cache = cache
+        self.opts = opts
+        self.rng = random.Random(opts.seed)
+        self.lock = threading.Lock() # rng, token bucket, counts
+        self.service_slots = threading.BoundedSemaphore(opts.max_concurrent) if opts.max_concurrent > 0 else None
+        self.tokens = max(1.0, opts.rate_limit) # token bucket of --rate_limit, one second's worth of requests
+        self.refill_t = time.time()
+        self.counts = defaultdict(int)
+        self.in_service = 0
+        self.start_t = time.time()
+    # end constructor
+
+    def take_token(self): # caller holds lock
+        if self.opts.rate_limit <= 0:
+            return True
+        now = time.time()
+        self.tokens = min(max(1.0, self.opts.rate_limit), self.tokens + (now - self.refill_t) * self.opts.rate_limit)
+        self.refill_t = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+    # end take_token
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def respond(self, path):
+        ''' (HTTP status, body, headers) of the request, None ==> drop the connection '''
+        opts = self.opts
+        with self.lock:
+            self.counts['requests'] += 1
+            throttled = not self.take_token()
+            draw = self.rng.random()
+            delay = max(0.0, opts.latency + self.rng.uniform(-opts.jitter, opts.jitter))
+        if throttled: # answered at once, as NLM's service does
+            self.count('429')
+            return 429, 'Too Many Requests', [('Retry-After', '1')]
+        if self.service_slots is not None:
+            self.service_slots.acquire() # wait for a turn, the latency grows with the load
+        try:
+            with self.lock:
+                self.in_service += 1
+                self.counts['max_in_service'] = max(self.counts['max_in_service'], self.in_service)
+            time.sleep(delay)
+            if draw < opts.drop_rate:
+                self.count('dropped')
+                return None
+            if draw < opts.drop_rate + opts.error_rate:
+                self.count('503')
+                return 503, 'Service Unavailable', []
+            json_text = self.cache.lookup(cache_url_of_path(path))
+        finally:
+            with self.lock:
+                self.in_service -= 1
+            if self.service_slots is not None:
+                self.service_slots.release()
+        if json_text is None:
+            self.count('404')
+            return 404, 'Not in the cache: %s' % cache_url_of_path(path), []
+        self.count('200')
+        return 200, json_text, [('Content-Type', 'application/json')]
+    # end respond
+
+    def statistics_line(self):
+        with self.lock:
+            counts = dict(self.counts)
+        elapsed_t = time.time() - self.start_t
+        return ('[%s] requests: %d (%.1f/sec), 200: %d, 404: %d, 429: %d, 503: %d, dropped: %d, max in service: %d'
+                % (time.strftime("%Y-%m-%d %H:%M:%S"), counts.get('requests', 0),
+                   counts.get('requests', 0) / max(elapsed_t, 1e-6), counts.get('200', 0), counts.get('404', 0),
+                   counts.get('429', 0), counts.get('503', 0), counts.get('dropped', 0),
+                   counts.get('max_in_service', 0)))
+    # end statistics_line
+
+# end class local_rxnav_server
+
+class local_rxnav_request_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive connections, as NLM's service
+    disable_nagle_algorithm = True # headers and body are two writes, Nagle + delayed ACK would hold the body ~40 ms
+
+    def do_GET(self):
+        response = self.server.respond(self.path)
+        if response is None:
+            self.close_connection = True # client sees the connection closed without a response
+            return
+        status, body, headers = response
+        data = body.encode('utf-8')
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    # end do_GET
+
+    def log_message(self, format, *args):
+        if self.server.opts.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# end class local_rxnav_request_handler
+
+def main():
+    def parse_args():
+        from optparse import OptionParser
+        opt = OptionParser()
+        opt.add_option('--cache', action='store', default='rxcui.cache')
+        opt.add_option('--cache_backend', action='store', type='choice', choices=CACHE_BACKENDS, default='file')
+        opt.add_option('--host', action='store', default='127.0.0.1')
+        opt.add_option('--port', action='store', type=int, default=8765) # 0 ==> any free port
+        opt.add_option('--latency', action='store', type=float, default=0) # seconds per response
+        opt.add_option('--jitter', action='store', type=float, default=0) # seconds, +/- around --latency
+        opt.add_option('--max_concurrent', action='store', type=int, default=0) # requests served at once, 0 ==> any
+        opt.add_option('--rate_limit', action='store', type=float, default=0) # requests/sec, HTTP 429 above it
+        opt.add_option('--error_rate', action='store', type=float, default=0) # fraction answered HTTP 503
+        opt.add_option('--drop_rate', action='store', type=float, default=0) # fraction of connections dropped
+        opt.add_option('--seed', action='store', type=int, default=1)
+        opt.add_option('--stats_interval', action='store', type=float, default=10) # seconds, 0 ==> at the end only
+        opt.add_option('--verbose', action='store_true') # log every request
+        opts, args = opt.parse_args()
+        return opts, args
+    # end parse_args
+
+    opts, args = parse_args()
+    if not os.path.exists(opts.cache):
+        print('Cache [%s] does not exist' % opts.cache)
+        sys.exit(1)
+    cache = cache_reader(opts.cache, opts.cache_backend)
+    server = local_rxnav_server((opts.host, opts.port), cache, opts)
+    print('[Serving %d cached results of %s at http://%s:%d/REST]'
+          % (cache.entry_count, opts.cache, opts.host, server.server_address[1]))
+    sys.stdout.flush()
+
+    def print_statistics():
+        while True:
+            time.sleep(opts.stats_interval)
+            print(server.statistics_line())
+            sys.stdout.flush()
+    if opts.stats_interval > 0:
+        statistics_thread = threading.Thread(target=print_statistics)
+        statistics_thread.daemon = True
+        statistics_thread.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # stopped by a script, as by Ctrl-C
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    server.server_close()
+    print(server.statistics_line())
+# end main
+
+if __name__ == '__main__':
+    main()
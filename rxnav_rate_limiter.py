@@ -0,0 +1,125 @@
+from __future__ import print_function
+import time
+import multiprocessing as mp
+
+'''
+Module: rxnav_rate_limiter.py
+
+Purpose:
+    Define shared_rate_limiter class, which paces the REST API requests of all processes of a
+    cache build (workers, phase 0, phase 3, manager) together, instead of each on its own.
+
+    It is created by the manager before the other processes are started, and is passed to them
+    (in the rxnav options) as a process argument.  Its state is a small array in shared memory,
+    guarded by a lock:
+
+        token bucket   requests may start at up to rate per second (--rate_limit), with bursts of up to
+                       one second's worth of requests
+        window         requests in flight at once, over all processes -- adjusted AIMD-style
+                       (additive increase, multiplicative decrease) from what the requests observe:
+                         success         the window grows, by 1 per request until the first
+                                         congestion (slow start), then by 1 per window of requests
+                         congestion      HTTP 429 or 5xx, a connection error, or a smoothed latency
+                                         more than latency_factor times the lowest seen ==> the window
+                                         is halved, at most once per latency period
+
+    So the request rate settles at the highest one the server sustains, up to rate and to
+    max_window (--workers times --max_in_flight), rather than at the one --workers sets.
+
+    Each request attempt calls acquire() before it is sent, and release() with its outcome.
+'''
+
+# positions in the shared state array
+TOKENS, REFILL_T, IN_FLIGHT, WINDOW, SLOW_START, LATENCY_EWMA, LATENCY_FLOOR, LATENCY_SAMPLES, \
+    DECREASE_T, DECREASES, CONGESTION_SIGNALS, MAX_WINDOW_USED, WAIT_SECONDS, REQUESTS = range(14)
+STATE_SIZE = 14
+
+LATENCY_ALPHA = 0.1 # weight of a new latency sample in the smoothed latency
+LATENCY_MIN_SAMPLES = 20 # samples before the latency is compared with its floor
+LATENCY_FLOOR_DRIFT = 0.001 # the floor follows a lasting change of the server's latency, slowly
+
+class shared_rate_limiter():
+
+    def __init__(self, rate, max_window, initial_window=2, latency_factor=3.0):
+        self.rate = float(rate) # requests per second
+        self.burst = max(1.0, self.rate) # tokens the bucket holds
+        self.max_window = max(1, max_window)
+        self.latency_factor = latency_factor
+        self.lock = mp.Lock()
+        self.state = mp.RawArray('d', STATE_SIZE)
+        self.state[TOKENS] = self.burst
+        self.state[REFILL_T] = time.time()
+        self.state[WINDOW] = min(float(initial_window), self.max_window)
+        self.state[SLOW_START] = 1
+    # end constructor
+
+    def acquire(self):
+        ''' wait for a token and for room in the window, then count the request as in flight '''
+        start_t = None
+        while True:
+            with self.lock:
+                state, now = self.state, time.time()
+                state[TOKENS] = min(self.burst, state[TOKENS] + (now - state[REFILL_T]) * self.rate)
+                state[REFILL_T] = now
+                if state[TOKENS] >= 1 and state[IN_FLIGHT] < int(state[WINDOW]):
+                    state[TOKENS] -= 1
+                    state[IN_FLIGHT] += 1
+                    state[REQUESTS] += 1
+                    state[MAX_WINDOW_USED] = max(state[MAX_WINDOW_USED], state[IN_FLIGHT])
+                    if start_t is not None:
+                        state[WAIT_SECONDS] += now - start_t
+                    return
+                # no token ==> wait for the next one, window full ==> wait for a request to complete
+                wait_t = (1 - state[TOKENS]) / self.rate if state[TOKENS] < 1 else 0.01
+            if start_t is None:
+                start_t = time.time()
+            time.sleep(max(0.001, min(wait_t, 0.1)))
+    # end acquire
+
+    def release(self, latency, congested):
+        '''
+        The request is done: latency in seconds, congested ==> HTTP 429/5xx or connection error.
+        Adjusts the window.
+        '''
+        with self.lock:
+            state, now = self.state, time.time()
+            state[IN_FLIGHT] = max(0, state[IN_FLIGHT] - 1)
+            if not congested and latency is not None:
+                if state[LATENCY_SAMPLES] == 0:
+                    state[LATENCY_EWMA] = state[LATENCY_FLOOR] = latency
+                else: # one slow response (e.g. a large status list) moves the average only so far
+                    sample = min(latency, 2 * self.latency_factor * state[LATENCY_FLOOR])
+                    state[LATENCY_EWMA] += LATENCY_ALPHA * (sample - state[LATENCY_EWMA])
+                    if state[LATENCY_EWMA] < state[LATENCY_FLOOR]:
+                        state[LATENCY_FLOOR] = state[LATENCY_EWMA]
+                    else:
+                        state[LATENCY_FLOOR] += LATENCY_FLOOR_DRIFT * (state[LATENCY_EWMA] - state[LATENCY_FLOOR])
+                state[LATENCY_SAMPLES] += 1
+                congested = state[LATENCY_SAMPLES] >= LATENCY_MIN_SAMPLES \
+                            and state[LATENCY_EWMA] > self.latency_factor * state[LATENCY_FLOOR]
+            if congested:
+                state[CONGESTION_SIGNALS] += 1
+                # a burst of errors from the same overload halves the window once
+                if (now - state[DECREASE_T]) >= 2 * state[LATENCY_EWMA]:
+                    state[WINDOW] = max(1.0, state[WINDOW] / 2)
+                    state[SLOW_START] = 0
+                    state[DECREASE_T] = now
+                    state[DECREASES] += 1
+            elif state[SLOW_START]:
+                state[WINDOW] = min(float(self.max_window), state[WINDOW] + 1)
+            else:
+                state[WINDOW] = min(float(self.max_window), state[WINDOW] + 1 / state[WINDOW])
+    # end release
+
+    def get_statistics(self):
+        ''' dictionary of the limiter state, for the logs '''
+        with self.lock:
+            state = list(self.state)
+        return {'rate_limit': self.rate, 'window': round(state[WINDOW], 2), 'max_window': self.max_window,
+                'max_in_flight_used': int(state[MAX_WINDOW_USED]), 'in_flight': int(state[IN_FLIGHT]),
+                'requests': int(state[REQUESTS]), 'wait_seconds': round(state[WAIT_SECONDS], 1),
+                'latency_ewma': round(state[LATENCY_EWMA], 4), 'latency_floor': round(state[LATENCY_FLOOR], 4),
+                'congestion_signals': int(state[CONGESTION_SIGNALS]), 'window_decreases': int(state[DECREASES])}
+    # end get_statistics
+
+# end class shared_rate_limiter
@@ -1,8 +1,14 @@
 from __future__ import print_function
 import multiprocessing
-import sys, io, time, datetime, requests, json, signal
+import sys, io, os, time, datetime, itertools, random, requests, json, signal, threading
+from requests.adapters import HTTPAdapter
 from collections import defaultdict
 from collections import deque
+from collections import OrderedDict
+from array import array
+from rxnav_async_fetch import rxnav_async_fetch
+from rxnav_cache_store import open_cache_store
+from rxnav_telemetry import request_telemetry
 
 '''
 Module: rxnav_rest_api_mp.py
@@ -28,7 +34,13 @@ Purpose:
     
     The workers will read the initial contents of the cache file, so that they don't
     request information that was in the cache at start time.  This is to allow for
-    restart situations where the cache is not empty.
+    restart situations where the cache is not empty.  The contents are found from the
+    index file kept next to the cache file (rxnav_cache_index.py), rather than by reading
+    the whole cache file.
+
+    The cache storage is selected by cache_backend (rxnav_cache_store.py) -- the 3-line cache
+    file ('file', default) or a SQLite database ('sqlite').  With the SQLite backend, workers
+    also see results written by the Cache Writer after they started.
     
     This this library does not automatically write results to the cache file when a new result
     is returned from the REST API.  That result is returned to the caller who forwards it to the
@@ -36,10 +48,49 @@ Purpose:
     
     The get_nxnav_data routine's interface also sligbhtly differs, instead of writing to the
     cache file when a new result is determined ... it sends the result to the Cache Writer.
+
+    Workers may call prefetch_rxnav_data with the URLs of an upcoming batch of requests.
+    Those requests are issued concurrently (up to max_in_flight at a time) by the asyncio
+    engine in rxnav_async_fetch.py, results are forwarded to the Cache Writer as they arrive,
+    and the later get_rxnav_data calls for those URLs are answered from the prefetched results.
+
+    REST API requests go through one requests.Session per object, which keeps a pool of
+    keep-alive connections (http_pool_size) to rxnav.nlm.nih.gov rather than opening a new
+    TCP+TLS connection for every request.  A session left idle longer than http_idle_timeout
+    seconds is discarded and replaced, since the server will have closed its connections.
+    With rest_api_base_url, the requests go to another server than NLM's (e.g. rxnav_local_server.py);
+    the URLs, and so the cache keys, are NLM's all the same.
   
+    A failed request (connection error, HTTP 429 or 5xx) is attempted up to retry_limit times, waiting
+    between the attempts with exponential backoff and jitter (or as long as the server's Retry-After says),
+    then raises rest_api_request_error.  Other responses than HTTP 200 are not parsed as results.
+    The workers put failed URLs aside and request them again at the end of their work
+    (retry_deferred_requests), rather than stopping.
+
+    With a rate_limiter (rxnav_rate_limiter.py), each request attempt waits for the limiter, which
+    paces the requests of all processes together, and reports its outcome to it.
+
+    The REST API requests and cache lookups are counted per endpoint (rxnav_telemetry.py).  With
+    telemetry_interval > 0, a snapshot of the counts is sent to the Cache Writer every telemetry_interval
+    seconds (and by send_telemetry), which writes the sum over all processes to the telemetry files.
+
     The cache file can then be post-processed to create the RXCUI_RELATED table for the RxCUI tables.
 '''
 
+rxnav_object_numbers = itertools.count(1) # telemetry source names
+
+RXNAV_REST_API_BASE_URL = 'https://rxnav.nlm.nih.gov/REST' # base of the request URLs, the cache keys
+
+RETRY_BASE_BACKOFF = 1.0 # seconds before the first retry of a failed request, doubled for each further retry
+
+class rest_api_request_error(ConnectionError):
+    ''' REST API request failed, after its retries or with a response retrying does not change (e.g. 404) '''
+    def __init__(self, request_url, reason):
+        ConnectionError.__init__(self, '%s -- %s' % (reason, request_url))
+        self.request_url = request_url
+        self.reason = reason
+# end class rest_api_request_error
+
 def chomp(s): return s.rstrip('\n').rstrip('\r')
 
 def make_utf8(s):
@@ -76,45 +127,21 @@ class rxnav_rest_api_mp():
                  cache_writer_queue,
                  readonly_access_to_cache=False,
                  forward_result_to_cache_writer=False,
-                 fail_if_not_in_cache=False): # constructor
+                 fail_if_not_in_cache=False,
+                 max_in_flight=1,
+                 http_pool_size=None,
+                 http_idle_timeout=60,
+                 cache_backend='file',
+                 cache_batch_size=1,
+                 cache_batch_latency=0,
+                 allrelated_lru_size=0,
+                 telemetry_interval=0,
+                 rate_limiter=None,
+                 retry_limit=6,
+                 retry_max_backoff=60,
+                 rest_api_base_url=None): # constructor
         ''' Constructor '''
 
-        def load_existing_cache(logfile):
-            # Process all information already in the cache file ==> fill self.nxnav_cache
-            # Each cache entry consists of 3 lines
-            #   1. URL (REST API url whose result is cached)
-            #   2. Date (date of information, YYYYMMDD)
-            #   3. JSON result
-            print('Reading existing cache', file=logfile); logfile.flush()
-            cache_entries = 0
-            line_number = 0
-            f = self.rxnav_cache_file  # f refers to cache file in this method
-            f.seek(0)  # top-of-file
-            while True:
-                file_position_of_cache_entry = f.tell() # file pos of cache entry ==> (URL,file-pos) in dictionary
-                # Read next cache entry (3 lines)
-                rawlines = [ x for x in [ f.readline() for idx_temp in range(3) ] if len(x) > 0 ]
-                if len(rawlines)==0: break # acceptable ending to cache file, multiple of 3 lines
-                if len(rawlines)!=3: raise ValueError('*** Cache file format error, not in groups of 3 lines ***')
-                line_number += 3
-                # Extract data ==> L1 is REST API url, L2 is data date (YYYYMMDD), L3 is JSON result
-                rest_api_url, data_date = [ chomp(rawlines[i]) for i in [0,1] ]
-                if len(data_date) != 8:
-                    raise ValueError('*** Cache file format, date not YYYYMMDD, line %d ***' % (line_number -1))
-                # Cache this entry ==> NOT the JSON result, keep memory usage down (would be massive)
-                # ==> if cache hit later, read JSON result from the file, based on file position stored in cache
-                # ==> keyed access (fast)
-                # ==> That is why we dont bother to chomp(rawlines[2]), but need to read past it to prep for next entry.
-                self.rxnav_cache[rest_api_url] = (file_position_of_cache_entry, data_date)
-                cache_entries += 1
-                if cache_entries % 10000 == 0:
-                    print('..Read %d entries from cache' % cache_entries, file=logfile)
-                    logfile.flush()
-            # done reading, at EOF, we can write new entries here
-            print('[Done reading cache, found %d existing entries]' % cache_entries, file=logfile)
-            logfile.flush()
-        # end load_existing_cache
-
         self.readonly_access_to_cache = readonly_access_to_cache
         self.forward_result_to_cache_writer = forward_result_to_cache_writer
         self.fail_if_not_in_cache = fail_if_not_in_cache
@@ -122,20 +149,49 @@ class rxnav_rest_api_mp():
         self.local_functions = local_functions
         self.logfile = logfile
         self.cache_writer_queue = cache_writer_queue
+        self.cache_batch_size = max(1, cache_batch_size) # results per Cache Writer message
+        self.cache_batch_latency = cache_batch_latency # seconds a result may wait for the rest of its batch
+        self.cache_batch = [] # (url, JSON text) results not yet sent to the Cache Writer
+        self.cache_batch_start_t = 0 # time the first result of cache_batch was added
+        self.cache_batch_lock = threading.Lock() # results are added by the prefetch event loop thread too
         self.start_t = time.time()
         self.last_request_displayed_time = time.time() # used in first display, after 500 requests
         self.last_request_displayed_count = 0
         self.rest_api_timing = deque([], maxlen=500)
-        self.rxnav_cache = {} # cache of REST API url => (data date, file-position)
+        self.telemetry = request_telemetry() # per endpoint counts, see rxnav_telemetry
+        self.telemetry_interval = telemetry_interval # seconds between snapshots sent, 0 ==> none sent
+        self.telemetry_source = 'pid %d object %d started %.3f' % (os.getpid(), next(rxnav_object_numbers),
+                                                                    self.start_t) # unique over the processes
+        self.telemetry_sent_t = time.time()
+        self.rate_limiter = rate_limiter # shared_rate_limiter of all processes, None ==> requests are not paced
+        self.retry_limit = max(1, retry_limit) # attempts of a request before it fails
+        self.retry_max_backoff = retry_max_backoff # seconds, longest wait between attempts
+        self.rest_api_base_url = rest_api_base_url.rstrip('/') if rest_api_base_url else None # None ==> NLM's
+        self.prefetch_failures = {} # url => rest_api_request_error, prefetch_rxnav_data request failed
+        self.stats_lock = threading.Lock() # request bookkeeping is shared with prefetch threads
+        self.max_in_flight = max_in_flight # concurrent REST API requests allowed by prefetch_rxnav_data
+        self.async_fetch = None # created on first prefetch_rxnav_data call
+        self.prefetched_results = {} # url => JSON text, fetched by prefetch_rxnav_data, not yet requested
+        self.refresh_urls = set() # urls whose cached results are out of date, see refresh_from_rest_api
+        self.http_pool_size = http_pool_size if http_pool_size else max(1, max_in_flight) # keep-alive connections
+        self.http_idle_timeout = http_idle_timeout # seconds, discard session idle longer than this
+        self.http_session = None # created by get_http_session
+        self.http_session_lock = threading.Lock()
+        self.http_session_last_used = 0
+        self.http_requests_in_flight = 0
+        self.http_closed_session_counts = [0, 0] # (new connections, requests) of sessions already discarded
         if cache_filename is not None: # even if is_worker
-            self.rxnav_cache_file = io.open(cache_filename,
-                                            ('r' if self.readonly_access_to_cache else 'a+'),
-                                            encoding='utf-8') # worker only has read-access, all have tell(), seek()
-            load_existing_cache(self.logfile) # read any existing information from the cache file
+            # worker only has read-access
+            self.rxnav_cache = open_cache_store(cache_filename, self.logfile, cache_backend,
+                                                writable=(not self.readonly_access_to_cache))
         else:
-            self.rxnav_cache_file = None
-        self.rxnav_cache_file_at_EOF = True
+            self.rxnav_cache = {}
         self.rxnav_cache_hits = 0
+        self.allrelated_lru = OrderedDict() # rxcui => digested 'allrelated', least recently used first
+        self.allrelated_lru_size = allrelated_lru_size # 0 ==> digest every time, keep none
+        self.allrelated_lru_hits = 0
+        self.allrelated_lru_misses = 0
+        self.allrelated_lru_evictions = 0
         self.request_count = 0 # total requests, some/all can be resolved from cache
         self.rxnav_request_count = 0 # REST API requests
         self.rxnorm_to_name = {} # rxnorm to name mappings determined
@@ -153,97 +209,355 @@ class rxnav_rest_api_mp():
 
     def get_rxnav_data(self, request_url):
         self.request_count += 1 # total requests, not only those that go to REST API
+        if self.telemetry_interval > 0 and (time.time() - self.telemetry_sent_t) >= self.telemetry_interval:
+            self.send_telemetry()
 
         # try to get data from cache
-        if self.use_caching and (request_url in self.rxnav_cache):
-            self.rxnav_cache_hits += 1
-            file_position_of_cache_entry = self.rxnav_cache[request_url][0] # tuple in cache (file_position, data_date)
-            self.rxnav_cache_file.seek(file_position_of_cache_entry)
-            self.rxnav_cache_file_at_EOF = False # Track that position is moved
-            # At this point we are positioned to the 3 line cache entry -- the 3rd line is the JSON result
-            for idx in [1,2]: self.rxnav_cache_file.readline() # skip past 1st 2 lines in cache entry
-            json_text = chomp(self.rxnav_cache_file.readline()) # JSON text, r.text value from REST API call
-            return json.loads(json_text) # convert JSON text to python structure
+        if self.use_caching and request_url not in self.refresh_urls:
+            json_text = self.rxnav_cache.lookup(request_url)
+            if self.telemetry_interval > 0: # counted only when sent, metadata builds look up millions of URLs
+                self.telemetry.record_cache_lookup(request_url, json_text is not None)
+            if json_text is not None:
+                self.rxnav_cache_hits += 1
+                return json.loads(json_text) # convert JSON text to python structure
+
+        # try to get data fetched ahead of time by prefetch_rxnav_data (already sent to Cache Writer)
+        if request_url in self.prefetched_results:
+            self.refresh_urls.discard(request_url)
+            return json.loads(self.prefetched_results.pop(request_url))
+        if request_url in self.prefetch_failures: # its retries are used up already, see retry_deferred_requests
+            raise self.prefetch_failures.pop(request_url)
 
         # Data is NOT in cache, must request from NLM's REST API
         if self.fail_if_not_in_cache: # if dont want to access REST API ==> fail
             raise ValueError('RxNAV data NOT In cache for [%s]' % request_url)
 
-        # attempt up to 40 times, sleeping 15 seconds between retries (10 minutes max)
+        json_text = self.fetch_rest_api_text(request_url)
+        self.refresh_urls.discard(request_url)
+        result = json.loads(json_text) # convert JSON text into python structure
+        if self.forward_result_to_cache_writer: # Send result to Cache Writer
+            self.send_to_cache_writer(request_url, json_text)
+        # return result
+        return result # python structure generated from JSON result
+    # end get_rxnav_data
+
+    def refresh_from_rest_api(self, request_urls):
+        '''
+        The cached results of these URLs are out of date (incremental build): the next request of each,
+        by get_rxnav_data or prefetch_rxnav_data, goes to the REST API even though the URL is in the cache.
+        '''
+        self.refresh_urls.update(request_urls)
+    # end refresh_from_rest_api
+
+    def fetch_rest_api_text(self, request_url):
+        '''
+        Issue the REST API request (blocking), return the JSON text of the response.
+        Called by get_rxnav_data, and concurrently from the prefetch threads of rxnav_async_fetch.
+        '''
+        # attempt up to retry_limit times, with exponential backoff (and jitter) between the attempts
         rest_api_request_start_time = time.time()
-        retry_limit = 40
-        r = None
-        for idx in range(retry_limit):
+        rate_limiter_wait = 0 # seconds waiting for the rate limiter, not part of the request duration
+        r = None # response of the successful attempt
+        failure = None # why the last attempt failed
+        for idx in range(self.retry_limit):
+            retry_after = 0 # seconds the server asked to wait (HTTP 429/503 Retry-After)
             try:
-                r = requests.get(request_url) # JSON text
-                break # request completed ==> stop retrying
+                session = self.get_http_session()
+                wait_start_time = time.time()
+                attempt_start_time = self.acquire_request_slot()
+                rate_limiter_wait += attempt_start_time - wait_start_time
+                try:
+                    response = session.get(self.rest_api_request_url(request_url)) # JSON text
+                except requests.exceptions.RequestException:
+                    self.release_request_slot(attempt_start_time, None)
+                    raise
+                finally:
+                    self.release_http_session()
+                self.release_request_slot(attempt_start_time, response.status_code)
+                if response.status_code == 200:
+                    r = response
+                    break # request completed ==> stop retrying
+                failure = 'HTTP status %d' % response.status_code
+                if response.status_code != 429 and response.status_code < 500:
+                    break # e.g. 404, the same answer again if retried
+                retry_after = self.get_retry_after_seconds(response)
             except requests.exceptions.RequestException as e:
-                print('[Communications error with RxNav REST API ... attempt %d of 3%s]' \
-                      % (idx+1,', retrying in 30 seconds' if idx<retry_limit else ''),
-                      file=self.logfile)
-                print('Communication Error: [%s]' % str(e), file=self.logfile)
+                failure = 'Communication Error: [%s]' % str(e)
+            if idx + 1 >= self.retry_limit:
+                break
+            backoff = min(self.retry_max_backoff, RETRY_BASE_BACKOFF * 2 ** idx) # 1, 2, 4, ... seconds
+            delay = max(retry_after, backoff / 2 + random.uniform(0, backoff / 2)) # jitter, workers spread out
+            with self.stats_lock:
+                print('[Request to RxNav REST API failed ... attempt %d of %d, retrying in %.1f seconds]'
+                      % (idx + 1, self.retry_limit, delay), file=self.logfile)
+                print('%s: %s' % (failure, request_url), file=self.logfile)
                 print('NOTE: RxNav requests: %d, seconds since start: %s' %
                       (self.rxnav_request_count,str(time.time()-self.start_t)),
                       file=self.logfile)
                 self.logfile.flush()
-                time.sleep(15) # wait 15 seconds before retry
-                pass
-        # end comm retry loop
-        if r == None:
-            raise ConnectionError # no response after max retries
-        rest_api_request_duration = time.time() - rest_api_request_start_time
-        self.rest_api_timing.append(rest_api_request_duration)
-        # Request completed successfully, break from retry loop occurred
-        result = json.loads(r.text) # convert JSON text into python structure
-        self.rxnav_request_count += 1 # variable in procedure that we are nested in
-        #if self.rxnav_request_count % 39 == 0: time.sleep(1) # limit around 20 requests/second
-        if self.rxnav_request_count % 500 == 0:
-            batch_size = self.rxnav_request_count-self.last_request_displayed_count
-            if self.rxnav_request_count == 500: # DEBUG
-                print('[Timings of first 500 requests]', file=self.logfile)
-                timings = list(self.rest_api_timing)
-                for idx in range(0, len(timings), 20):
-                    print(str([round(x, 3) for x in timings[idx:idx + 20]]), file=self.logfile)
-                print('[End timings]', file=self.logfile)
+            self.flush_cache_writer_batch() # results of the batch are not held back for the whole backoff
+            time.sleep(delay)
+        # end retry loop
+        if r is None:
+            self.telemetry.record_failure(request_url, idx)
+            with self.stats_lock:
+                print('[Request to RxNav REST API failed after %d attempts] %s: %s'
+                      % (idx + 1, failure, request_url), file=self.logfile)
                 self.logfile.flush()
-            print('[%s] Sum of request timings of last batch of %d ==> %s seconds' \
-                  % (self.get_timestamp_string(), batch_size, str(sum(self.rest_api_timing))),
-                  file=self.logfile)
-            seconds_since_last_display = time.time()-self.last_request_displayed_time # floating point result
-            print('[%s] RxNav requests: %d, REST API calls: %d, seconds: %s, rate/sec: %s, cache (size: %d, hits: %d)' \
-                  % (self.get_timestamp_string(),
-                     self.request_count,
-                     self.rxnav_request_count,
-                     str(seconds_since_last_display),
-                     str(round(batch_size/seconds_since_last_display, 3)),
-                     len(self.rxnav_cache),
-                     self.rxnav_cache_hits),
-                  file=self.logfile)
+            raise rest_api_request_error(request_url, failure)
+        rest_api_request_duration = time.time() - rest_api_request_start_time - rate_limiter_wait
+        # Request completed successfully, break from retry loop occurred
+        self.telemetry.record_request(request_url, rest_api_request_duration, len(r.content), idx)
+        with self.stats_lock:
+            self.rest_api_timing.append(rest_api_request_duration)
+            self.rxnav_request_count += 1
+            if self.rxnav_request_count % 500 == 0:
+                self.log_request_statistics()
+        return r.text
+    # end fetch_rest_api_text
+
+    def rest_api_request_url(self, request_url):
+        ''' URL the request is sent to -- request_url (the cache key) on rest_api_base_url rather than NLM's '''
+        if self.rest_api_base_url is None or not request_url.startswith(RXNAV_REST_API_BASE_URL):
+            return request_url
+        return self.rest_api_base_url + request_url[len(RXNAV_REST_API_BASE_URL):]
+    # end rest_api_request_url
+
+    def get_retry_after_seconds(self, response):
+        ''' seconds of the Retry-After header (HTTP 429, 503), 0 if none or not in seconds '''
+        retry_after = response.headers.get('Retry-After', '') if response.headers is not None else ''
+        return min(float(retry_after), self.retry_max_backoff) if retry_after.strip().isdigit() else 0
+    # end get_retry_after_seconds
+
+    def retry_deferred_requests(self, request_urls):
+        '''
+        Request again the URLs whose requests failed earlier in the phase (put aside by the caller so the
+        rest of its work kept going), each with all its retries.  Results go to the Cache Writer as usual.
+        Returns [(url, reason)] of the requests which failed again.
+        '''
+        failed = []
+        for request_url in request_urls:
+            try:
+                self.get_rxnav_data(request_url)
+            except rest_api_request_error as e:
+                failed.append((request_url, e.reason))
+        self.flush_cache_writer_batch()
+        return failed
+    # end retry_deferred_requests
+
+    def acquire_request_slot(self):
+        ''' wait until the rate limiter lets the request go (if any), return the time it starts '''
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return time.time()
+    # end acquire_request_slot
+
+    def release_request_slot(self, attempt_start_time, status_code):
+        ''' tell the rate limiter how the request went, status_code None ==> connection error '''
+        if self.rate_limiter is not None:
+            self.rate_limiter.release(time.time() - attempt_start_time,
+                                      status_code is None or status_code == 429 or status_code >= 500)
+    # end release_request_slot
+
+    def log_request_statistics(self): # every 500 REST API requests, caller holds stats_lock
+        batch_size = self.rxnav_request_count-self.last_request_displayed_count
+        if self.rxnav_request_count == 500: # DEBUG
+            print('[Timings of first 500 requests]', file=self.logfile)
+            timings = list(self.rest_api_timing)
+            for idx in range(0, len(timings), 20):
+                print(str([round(x, 3) for x in timings[idx:idx + 20]]), file=self.logfile)
+            print('[End timings]', file=self.logfile)
             self.logfile.flush()
-            self.last_request_displayed_time = time.time()
-            self.last_request_displayed_count = self.rxnav_request_count
-        if self.forward_result_to_cache_writer: # Send result to Cache Writer
-            self.cache_writer_queue.put([request_url, r.text]) # send list with url and json result strings
-        # return result
-        return result # python structure generated from JSON result
-    # end get_rxnav_data
+        print('[%s] Sum of request timings of last batch of %d ==> %s seconds' \
+              % (self.get_timestamp_string(), batch_size, str(sum(self.rest_api_timing))),
+              file=self.logfile)
+        seconds_since_last_display = time.time()-self.last_request_displayed_time # floating point result
+        new_connections, reused_connections = self.get_http_connection_counts()
+        print(('[%s] RxNav requests: %d, REST API calls: %d, seconds: %s, rate/sec: %s, cache (size: %d, hits: %d), '
+               + 'connections (new: %d, reused: %d)') \
+              % (self.get_timestamp_string(),
+                 self.request_count,
+                 self.rxnav_request_count,
+                 str(seconds_since_last_display),
+                 str(round(batch_size/seconds_since_last_display, 3)),
+                 len(self.rxnav_cache),
+                 self.rxnav_cache_hits,
+                 new_connections,
+                 reused_connections),
+              file=self.logfile)
+        if self.rate_limiter is not None:
+            print('[%s] Rate limiter: %s' % (self.get_timestamp_string(), str(self.rate_limiter.get_statistics())),
+                  file=self.logfile)
+        self.logfile.flush()
+        self.last_request_displayed_time = time.time()
+        self.last_request_displayed_count = self.rxnav_request_count
+    # end log_request_statistics
+
+    def send_telemetry(self):
+        ''' Send the snapshot of the request counts to the Cache Writer (with telemetry_interval > 0) '''
+        if self.telemetry_interval > 0 and self.cache_writer_queue is not None:
+            self.cache_writer_queue.put(('telemetry', self.telemetry_source, self.telemetry.snapshot()))
+        self.telemetry_sent_t = time.time()
+    # end send_telemetry
+
+    def get_http_session(self):
+        ''' Return the pooled keep-alive session, replacing it if it has been idle too long '''
+        with self.http_session_lock:
+            now = time.time()
+            if self.http_session is not None and self.http_requests_in_flight == 0 \
+                    and (now - self.http_session_last_used) > self.http_idle_timeout:
+                self.close_http_session() # server has likely dropped the idle connections
+            if self.http_session is None:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.http_pool_size)
+                self.http_session = requests.Session()
+                self.http_session.mount('https://', adapter)
+                self.http_session.mount('http://', adapter)
+            self.http_session_last_used = now
+            self.http_requests_in_flight += 1
+            return self.http_session
+    # end get_http_session
+
+    def release_http_session(self):
+        with self.http_session_lock:
+            self.http_requests_in_flight -= 1
+            self.http_session_last_used = time.time()
+    # end release_http_session
+
+    def close_http_session(self): # caller holds http_session_lock
+        new_connections, requests_made = self.get_session_connection_counts(self.http_session)
+        self.http_closed_session_counts[0] += new_connections
+        self.http_closed_session_counts[1] += requests_made
+        self.http_session.close()
+        self.http_session = None
+    # end close_http_session
+
+    def get_session_connection_counts(self, session):
+        ''' (connections opened, requests made) by the connection pools of the session '''
+        new_connections, requests_made = 0, 0
+        for adapter in set(session.adapters.values()): # same adapter is mounted for http:// and https://
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                new_connections += pool.num_connections
+                requests_made += pool.num_requests
+        return new_connections, requests_made
+    # end get_session_connection_counts
+
+    def get_http_connection_counts(self):
+        ''' Return (new connections, reused connections) over all requests made by this object '''
+        with self.http_session_lock: # the session may be replaced (and its counts moved) meanwhile
+            new_connections, requests_made = self.http_closed_session_counts
+            if self.http_session is not None:
+                session_counts = self.get_session_connection_counts(self.http_session)
+                new_connections += session_counts[0]
+                requests_made += session_counts[1]
+        return new_connections, max(0, requests_made - new_connections)
+    # end get_http_connection_counts
+
+    def prefetch_rxnav_data(self, request_urls):
+        '''
+        Request the given URLs from the REST API concurrently, up to max_in_flight at a time.
+        URLs already in the cache (unless refreshed, see refresh_from_rest_api) or already prefetched
+        are skipped.  Results are forwarded to the Cache Writer as they arrive and held until
+        get_rxnav_data is called for the URL.
+        A URL whose request fails (after its retries) fails the later get_rxnav_data call right away.
+        Returns the number of URLs fetched.
+        '''
+        if self.fail_if_not_in_cache or self.max_in_flight <= 1:
+            return 0 # nothing to do ahead of time, get_rxnav_data requests one at a time
+        needed_urls = [x for x in request_urls
+                       if not ((self.use_caching and x in self.rxnav_cache and x not in self.refresh_urls)
+                               or x in self.prefetched_results)]
+        if len(needed_urls) == 0:
+            return 0
+
+        def store_result(request_url, json_text): # called in the event loop thread as each request completes
+            self.prefetched_results[request_url] = json_text
+            if self.forward_result_to_cache_writer: # Send result to Cache Writer
+                self.send_to_cache_writer(request_url, json_text)
+
+        if self.async_fetch is None:
+            self.async_fetch = rxnav_async_fetch(self.fetch_rest_api_text, self.max_in_flight)
+        def store_failure(request_url, e): # called in the event loop thread
+            if isinstance(e, rest_api_request_error):
+                self.prefetch_failures[request_url] = e
+
+        fetched_count = self.async_fetch.fetch_all(needed_urls, store_result, store_failure)
+        self.flush_cache_writer_batch() # the caller may take a while before the next result arrives
+        return fetched_count
+    # end prefetch_rxnav_data
+
+    def send_to_cache_writer(self, request_url, json_text):
+        '''
+        Add a result to the batch for the Cache Writer.  The batch is sent as one message when it
+        is full, or when its first result has waited cache_batch_latency seconds.  Whatever blocks for a
+        while (retry backoff, end of a prefetch or of the deferred retries) sends the pending results first,
+        see flush_cache_writer_batch, so a result waits at most about cache_batch_latency (or one request).
+        '''
+        with self.cache_batch_lock:
+            if len(self.cache_batch) == 0:
+                self.cache_batch_start_t = time.time()
+            self.cache_batch.append((request_url, json_text))
+            batch_is_due = len(self.cache_batch) >= self.cache_batch_size \
+                           or (time.time() - self.cache_batch_start_t) >= self.cache_batch_latency
+        if batch_is_due:
+            self.flush_cache_writer_batch()
+    # end send_to_cache_writer
+
+    def flush_cache_writer_batch(self):
+        ''' Send the pending results to the Cache Writer, call before the process is done or blocks '''
+        with self.cache_batch_lock:
+            cache_batch, self.cache_batch = self.cache_batch, []
+        if len(cache_batch) > 0:
+            self.cache_writer_queue.put(cache_batch) # send list of (url, json result string) tuples
+    # end flush_cache_writer_batch
+
+    def write_cache_entries(self, cache_entries):
+        # add to end of cache -- URL, data_date, JSON result for each entry, one write (Cache Writer only)
+        # returns the number of bytes written
+        return self.rxnav_cache.write_batch(cache_entries)
+    # end write_cache_entries
 
     def write_cache_entry(self, request_url, json_string):
-        # write 3 lines to end of cache file -- URL, data_date, JSON result
-        if not self.rxnav_cache_file_at_EOF:
-            self.rxnav_cache_file.seek(0, 2)  # seek to EOF
-            self.rxnav_cache_file_at_EOF = True
-        # NOTE: rxnav_cache_file_at_EOF is guaranteed to be True here, no need to reset
-        # JGP 2018-05-22 - write all 3 lines at once, the position of the first line is the cache position
-        file_position = self.rxnav_cache_file.tell()
-        data_date = '{:%Y%m%d}'.format(datetime.datetime.now())
-        print(make_utf8(request_url+'\n'+data_date+'\n'+json_string), file=self.rxnav_cache_file)
-        self.rxnav_cache[request_url] = (file_position, data_date) # track position of JSON in file in the cache
+        # add to end of cache -- URL, data_date, JSON result (Cache Writer only)
+        self.rxnav_cache.write(request_url, json_string)
     # end write_cache_entry
 
+    def flush_cache(self, fsync=False):
+        self.rxnav_cache.flush(fsync)
+    # end flush_cache
+
+    def close_cache(self):
+        ''' Cache Writer is done ==> flush and close the cache '''
+        if self.use_caching:
+            self.rxnav_cache.close()
+    # end close_cache
+
+    '''
+    REST API URLs for the per-RxCUI requests, these URLs are the keys of the cache
+    '''
+    def allrelated_url(self, rxcui):
+        return 'https://rxnav.nlm.nih.gov/REST/rxcui/%s/allrelated.json' % rxcui
+
+    def historical_rxcui_url(self, rxcui):
+        return 'https://rxnav.nlm.nih.gov/REST/rxcuihistory/concept.json?rxcui=%s' % rxcui
+
+    def allhistoricalndcs_url(self, drug_rxcui):
+        return 'https://rxnav.nlm.nih.gov/REST/rxcui/%d/allhistoricalndcs/json' % drug_rxcui
+
+    def historical_status_url(self, status_value):
+        return 'https://rxnav.nlm.nih.gov/REST/rxcuihistory/status.json?type=%s' % status_value
+
+    def class_tree_url(self, classId):
+        return 'https://rxnav.nlm.nih.gov/REST/rxclass/classTree/json?classId=%s' % classId
+
+    def va_class_members_url(self, va_classid):
+        return ('https://rxnav.nlm.nih.gov/REST/rxclass/classMembers.json?classId=%s'+\
+                '&relaSource=VA&rela=has_VAClass&ttys=SCD+GPCK') % va_classid
+
     def get_class_tree(self, classId):  # eg: VA root is VA000 as of Aug 6, 2018 (per Lee Peters) (was N0000010574)
         ''' Main use is determining VA drug class hierarchy (aka NDFRT). '''
-        d = self.get_rxnav_data('https://rxnav.nlm.nih.gov/REST/rxclass/classTree/json?classId=%s' % classId)
+        d = self.get_rxnav_data(self.class_tree_url(classId))
         return d
     # end get_class_tree
 
@@ -251,16 +565,14 @@ class rxnav_rest_api_mp():
         # relaSource changed to VA from NDFRT, per Lee Peters, after August 6, 2018
         # also -- https://rxnav.nlm.nih.gov/RxClassAPIREST.html#uLink=RxClass_REST_getClassMembers
         # NOTE: can't simply change this to get_allrelated -- special curation not contained in allrelated
-        query_url = ('https://rxnav.nlm.nih.gov/REST/rxclass/classMembers.json?classId=%s'+\
-                     '&relaSource=VA&rela=has_VAClass&ttys=SCD+GPCK') % va_classid
-        d = self.get_rxnav_data(query_url)
+        d = self.get_rxnav_data(self.va_class_members_url(va_classid))
         return ([] if not ('drugMemberGroup' in d and 'drugMember' in d['drugMemberGroup'])
                 else [int(x['minConcept']['rxcui'])
                       for x in d['drugMemberGroup']['drugMember']])
     # end get_generic_drugs_for_VA_class
 
     def get_ndcs_for_drug(self, drug_rxcui): # See "Part 4" above for JSON spec
-        d = self.get_rxnav_data('https://rxnav.nlm.nih.gov/REST/rxcui/%d/allhistoricalndcs/json' % drug_rxcui)
+        d = self.get_rxnav_data(self.allhistoricalndcs_url(drug_rxcui))
         # Comprehension below generates a list of list of NDC codes (due to JSON structure) ==> flatten to list
         return ([] if not ('historicalNdcConcept' in d
                            and d['historicalNdcConcept'] \
@@ -277,8 +589,7 @@ class rxnav_rest_api_mp():
         '''
         Return the 'allrelated' data structure from the NLM
         '''
-        query_url = '''https://rxnav.nlm.nih.gov/REST/rxcui/%s/allrelated.json''' % rxcui
-        d = self.get_rxnav_data(query_url)
+        d = self.get_rxnav_data(self.allrelated_url(rxcui))
         # Example JSON result returned from NLM, returned to the caller as a python structure
         '''
         {"allRelatedGroup":
@@ -307,8 +618,7 @@ class rxnav_rest_api_mp():
         '''
         Return historical information about the given RxCUI from the NLM, using their rxcuihistory API.
         '''
-        query_url = '''https://rxnav.nlm.nih.gov/REST/rxcuihistory/concept.json?rxcui=%s''' % rxcui
-        d = self.get_rxnav_data(query_url)
+        d = self.get_rxnav_data(self.historical_rxcui_url(rxcui))
         # Example JSON result returned from NLM, returned to the caller as a python structure
         '''
         {"rxcuiHistoryConcept":
@@ -408,7 +718,7 @@ class rxnav_rest_api_mp():
         rxcuis_status_d = {}
         prev_size = 0
         for status_value in target_status_values:
-            query_url = 'https://rxnav.nlm.nih.gov/REST/rxcuihistory/status.json?type=%s' % status_value
+            query_url = self.historical_status_url(status_value)
             d = self.get_rxnav_data(query_url) # {"rxcuiList": {"rxcuis": ["211", "292", ...] } }
             code_set = set([ int(x) for x in d['rxcuiList']['rxcuis'] ])
             rxcui_set.update(code_set)
@@ -448,32 +758,60 @@ class rxnav_rest_api_mp():
                     raise ValueError('*** Non-List in allrelated result [%s] ***' % str(level2))
     # end get_next_allrelated_tty_and_list
 
+    def get_allrelated_digest(self, rxcui):
+        '''
+        Return the 'allrelated' result digested to a tuple of (tty, array of integer RxCUIs), one per concept
+        group, in the order of the result.  The digests of the allrelated_lru_size most recently used RxCUIs
+        are kept, so repeated lookups of the same RxCUI do not read and parse the JSON again.
+        '''
+        digest = self.allrelated_lru.get(rxcui)
+        if digest is not None:
+            self.allrelated_lru.move_to_end(rxcui) # most recently used
+            self.allrelated_lru_hits += 1
+            self.request_count += 1
+            return digest
+        self.allrelated_lru_misses += 1
+        digest = tuple((tty, array('l', rxcui_list))
+                       for tty, rxcui_list in self.get_next_allrelated_tty_and_list(self.get_allrelated(rxcui)))
+        if self.allrelated_lru_size > 0:
+            self.allrelated_lru[rxcui] = digest
+            if len(self.allrelated_lru) > self.allrelated_lru_size:
+                self.allrelated_lru.popitem(last=False) # least recently used
+                self.allrelated_lru_evictions += 1
+        return digest
+    # end get_allrelated_digest
+
+    def get_allrelated_rxcuis_for_rxcui_and_tty_list(self, rxcui, tty_list):
+        ''' same result as get_allrelated_rxcuis_for_tty_list(get_allrelated(rxcui), tty_list) '''
+        result = []
+        for tty, rxcuis in self.get_allrelated_digest(rxcui):
+            if tty in tty_list:
+                result.extend(rxcuis)
+        return result
+    # end get_allrelated_rxcuis_for_rxcui_and_tty_list
+
     def get_related_ingredients_for_multi_ingredient(self, min_rxcui):
         # JGP - 2018-08-17, make this work with the 'allrelated' result instead of 'related'
         # ==> find the related 'IN' or 'PIN' codes associated with the specified 'MIN' code.
         # ==> we have 'allrelated' for all RxNORM RxCUI codes, it will be in the cache.
 
-        d = self.get_allrelated(min_rxcui) # get 'allrelated'
-        return self.get_allrelated_rxcuis_for_tty_list(d, ['IN', 'PIN'])
+        return self.get_allrelated_rxcuis_for_rxcui_and_tty_list(min_rxcui, ['IN', 'PIN'])
     # end get_related_ingredients_for_multi_ingredient
 
     def get_drug_rxcuis_for_ingredient(self, ingredient_rxcui):
-        d = self.get_allrelated(ingredient_rxcui)
-        return self.get_allrelated_rxcuis_for_tty_list(d, ['SBD', 'SCD', 'GPCK', 'BPCK'])
+        return self.get_allrelated_rxcuis_for_rxcui_and_tty_list(ingredient_rxcui, ['SBD', 'SCD', 'GPCK', 'BPCK'])
     # end get_drug_rxcuis_for_ingredient
 
     def get_ingredients_for_generic_drug(self, scd_rxcui):
-        d = self.get_allrelated(scd_rxcui)
-        return self.get_allrelated_rxcuis_for_tty_list(d, ['IN'])
+        return self.get_allrelated_rxcuis_for_rxcui_and_tty_list(scd_rxcui, ['IN'])
     # end get_ingredients_for_generic_drug
 
     def get_branded_drugs_for_generic_drug(self, scd_rxcui):
-        d = self.get_allrelated(scd_rxcui)
-        return self.get_allrelated_rxcuis_for_tty_list(d, ['SBD','BPCK'])
+        return self.get_allrelated_rxcuis_for_rxcui_and_tty_list(scd_rxcui, ['SBD','BPCK'])
     # end get_branded_drugs_for_generic_drug
 
     def get_ndc_codes_for_drug(self, drug_rxcui):
-        d = self.get_rxnav_data('https://rxnav.nlm.nih.gov/REST/rxcui/%d/allhistoricalndcs/json' % drug_rxcui)
+        d = self.get_rxnav_data(self.allhistoricalndcs_url(drug_rxcui))
         # Comprehension below generates a list of list of NDC codes (due to JSON structure) ==> flatten to list
         if not ('historicalNdcConcept' in d \
                 and d['historicalNdcConcept'] \
@@ -492,7 +830,10 @@ class rxnav_rest_api_mp():
     # end get_request_count
 
     def get_cache_usage(self):
-        return str(self.rxnav_cache_hits) #','.join(['%s:%d' % (nm,self.cache_hits[nm]) for nm in self.cache_hits])
+        return '%d, allrelated LRU (size %d of %d) hits: %d, misses: %d, evictions: %d' \
+               % (self.rxnav_cache_hits, len(self.allrelated_lru), self.allrelated_lru_size,
+                  self.allrelated_lru_hits, self.allrelated_lru_misses, self.allrelated_lru_evictions)
+        #','.join(['%s:%d' % (nm,self.cache_hits[nm]) for nm in self.cache_hits])
     # end get_cache_usage
 
 # end class
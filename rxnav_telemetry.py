@@ -0,0 +1,234 @@
+from __future__ import print_function
+import io, os, json, time, threading, tempfile
+
+'''
+Module: rxnav_telemetry.py
+
+Purpose:
+    Define request_telemetry class, the REST API request counters of one rxnav_rest_api_mp object,
+    kept per endpoint (ENDPOINTS, from the request URL):
+
+        requests        REST API requests completed
+        seconds         their total duration (including retries), and a latency histogram of
+                        LATENCY_BUCKETS (upper bounds, seconds) -- p50/p95/p99 are estimated from it
+        retries         failed attempts which were retried
+        failures        requests which failed after all retries
+        bytes           bytes of the responses
+        cache_lookups   requests looked up in the cache, and cache_hits, those found there
+
+    Each process sends a snapshot of its counters (cumulative) to the Cache Writer every
+    --telemetry_interval seconds, as a ('telemetry', source, snapshot) message.  The Cache Writer
+    keeps the latest snapshot of each source, and writes their sum every --telemetry_interval seconds:
+
+        <log_dir>telemetry.json    per-endpoint counts, rates, percentiles (and per source counts)
+        <log_dir>telemetry.prom    the same in the Prometheus text exposition format
+
+    The manager logs the final per-endpoint summary in manager.log.
+'''
+
+ENDPOINTS = ['allrelated', 'rxcuihistory/concept', 'allhistoricalndcs', 'classMembers', 'classTree', 'status',
+             'other']
+
+ENDPOINT_URL_PARTS = [('/allrelated.json', 'allrelated'),
+                      ('/rxcuihistory/concept.json', 'rxcuihistory/concept'),
+                      ('/allhistoricalndcs', 'allhistoricalndcs'),
+                      ('/rxclass/classMembers', 'classMembers'),
+                      ('/rxclass/classTree', 'classTree'),
+                      ('/rxcuihistory/status.json', 'status')]
+
+# 1 ms to 10 minutes, each bucket 25% wider than the one before, the last bucket has no upper bound
+LATENCY_BUCKETS = [round(0.001 * 1.25 ** idx, 6) for idx in range(60)] + [float('inf')]
+
+COUNTERS = ['requests', 'seconds', 'max_seconds', 'retries', 'failures', 'bytes', 'cache_lookups', 'cache_hits']
+
+TELEMETRY_JSON_SUFFIX = 'telemetry.json'
+TELEMETRY_PROMETHEUS_SUFFIX = 'telemetry.prom'
+
+def endpoint_of_url(request_url):
+    for url_part, endpoint in ENDPOINT_URL_PARTS:
+        if url_part in request_url:
+            return endpoint
+    return 'other'
+# end endpoint_of_url
+
+def new_endpoint_counts():
+    counts = {x: 0 for x in COUNTERS}
+    counts['latency_buckets'] = [0] * len(LATENCY_BUCKETS)
+    return counts
+
+class request_telemetry():
+
+    def __init__(self):
+        self.lock = threading.Lock() # counts are updated by the prefetch threads as well
+        self.endpoints = {}
+
+    def endpoint_counts(self, request_url): # caller holds lock
+        endpoint = endpoint_of_url(request_url)
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = new_endpoint_counts()
+        return self.endpoints[endpoint]
+
+    def record_request(self, request_url, seconds, response_bytes, retries):
+        with self.lock:
+            counts = self.endpoint_counts(request_url)
+            counts['requests'] += 1
+            counts['seconds'] += seconds
+            counts['max_seconds'] = max(counts['max_seconds'], seconds)
+            counts['retries'] += retries
+            counts['bytes'] += response_bytes
+            idx = 0
+            while seconds > LATENCY_BUCKETS[idx]:
+                idx += 1
+            counts['latency_buckets'][idx] += 1
+    # end record_request
+
+    def record_failure(self, request_url, retries):
+        with self.lock:
+            counts = self.endpoint_counts(request_url)
+            counts['failures'] += 1
+            counts['retries'] += retries
+
+    def record_cache_lookup(self, request_url, hit):
+        with self.lock:
+            counts = self.endpoint_counts(request_url)
+            counts['cache_lookups'] += 1
+            if hit:
+                counts['cache_hits'] += 1
+
+    def snapshot(self):
+        ''' copy of the counts, endpoint => counts '''
+        with self.lock:
+            return {endpoint: dict(counts, latency_buckets=list(counts['latency_buckets']))
+                    for endpoint, counts in self.endpoints.items()}
+
+# end class request_telemetry
+
+def merge_snapshots(snapshots):
+    ''' sum of the snapshots (of different sources), endpoint => counts '''
+    merged = {}
+    for snapshot in snapshots:
+        for endpoint, counts in snapshot.items():
+            total = merged.setdefault(endpoint, new_endpoint_counts())
+            for counter in COUNTERS:
+                total[counter] = max(total[counter], counts[counter]) if counter == 'max_seconds' \
+                                 else total[counter] + counts[counter]
+            total['latency_buckets'] = [x + y for x, y in zip(total['latency_buckets'], counts['latency_buckets'])]
+    return merged
+# end merge_snapshots
+
+def latency_percentile(counts, fraction):
+    ''' latency (seconds) below which the fraction of the requests completed, interpolated within its bucket '''
+    target = fraction * counts['requests']
+    if counts['requests'] == 0:
+        return None
+    cumulative = 0
+    for idx, bucket_count in enumerate(counts['latency_buckets']):
+        if bucket_count > 0 and cumulative + bucket_count >= target:
+            lower = LATENCY_BUCKETS[idx - 1] if idx > 0 else 0.0
+            upper = min(LATENCY_BUCKETS[idx], counts['max_seconds'])
+            return round(lower + (upper - lower) * max(0.0, target - cumulative) / bucket_count, 6)
+        cumulative += bucket_count
+    return counts['max_seconds']
+# end latency_percentile
+
+def telemetry_summary(merged, elapsed_seconds):
+    ''' endpoint => counts, rates and percentiles (no histogram), plus 'TOTAL' '''
+    summary = {}
+    total = merge_snapshots([{'TOTAL': x} for x in merged.values()]).get('TOTAL', new_endpoint_counts())
+    for endpoint in [x for x in ENDPOINTS if x in merged] + ['TOTAL']:
+        counts = merged[endpoint] if endpoint != 'TOTAL' else total
+        summary[endpoint] = {
+            'requests': counts['requests'],
+            'requests_per_second': round(counts['requests'] / max(elapsed_seconds, 1e-6), 3),
+            'mean_seconds': round(counts['seconds'] / counts['requests'], 6) if counts['requests'] else None,
+            'p50_seconds': latency_percentile(counts, 0.50),
+            'p95_seconds': latency_percentile(counts, 0.95),
+            'p99_seconds': latency_percentile(counts, 0.99),
+            'max_seconds': round(counts['max_seconds'], 6),
+            'request_seconds': round(counts['seconds'], 3),
+            'retries': counts['retries'],
+            'failures': counts['failures'],
+            'bytes': counts['bytes'],
+            'cache_lookups': counts['cache_lookups'],
+            'cache_hits': counts['cache_hits'],
+            'cache_hit_ratio': round(counts['cache_hits'] / float(counts['cache_lookups']), 4)
+                               if counts['cache_lookups'] else None}
+    return summary
+# end telemetry_summary
+
+def prometheus_text(merged, source_count):
+    ''' the merged counts in the Prometheus text exposition format '''
+    lines = ['# HELP rxnav_request_duration_seconds RxNav REST API request duration, including retries',
+             '# TYPE rxnav_request_duration_seconds histogram']
+    for endpoint in sorted(merged):
+        counts, cumulative = merged[endpoint], 0
+        for upper, bucket_count in zip(LATENCY_BUCKETS, counts['latency_buckets']):
+            cumulative += bucket_count
+            lines.append('rxnav_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d'
+                         % (endpoint, '+Inf' if upper == float('inf') else repr(upper), cumulative))
+        lines.append('rxnav_request_duration_seconds_sum{endpoint="%s"} %.6f' % (endpoint, counts['seconds']))
+        lines.append('rxnav_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, counts['requests']))
+    for counter, metric, help_text in [('retries', 'rxnav_request_retries_total', 'request attempts retried'),
+                                       ('failures', 'rxnav_request_failures_total', 'requests failed after retries'),
+                                       ('bytes', 'rxnav_response_bytes_total', 'bytes of the responses'),
+                                       ('cache_lookups', 'rxnav_cache_lookups_total', 'requests looked up in the cache'),
+                                       ('cache_hits', 'rxnav_cache_hits_total', 'requests found in the cache')]:
+        lines.append('# HELP %s RxNav %s' % (metric, help_text))
+        lines.append('# TYPE %s counter' % metric)
+        for endpoint in sorted(merged):
+            lines.append('%s{endpoint="%s"} %d' % (metric, endpoint, merged[endpoint][counter]))
+    lines.append('# HELP rxnav_telemetry_sources processes (rxnav objects) whose counts are included')
+    lines.append('# TYPE rxnav_telemetry_sources gauge')
+    lines.append('rxnav_telemetry_sources %d' % source_count)
+    return '\n'.join(lines) + '\n'
+# end prometheus_text
+
+def write_file_atomically(filename, text):
+    ''' readers of the file (e.g. a metrics collector) never see a partial file '''
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    with io.open(fd, 'w', encoding='utf-8') as fout:
+        fout.write(text)
+    os.chmod(tmp_fn, 0o644)
+    os.replace(tmp_fn, filename)
+# end write_file_atomically
+
+def write_telemetry_files(filename_prefix, source_snapshots, start_t):
+    ''' write the sum of the latest snapshot of each source, <prefix>telemetry.json and <prefix>telemetry.prom '''
+    merged = merge_snapshots(source_snapshots.values())
+    elapsed_seconds = time.time() - start_t
+    snapshot = {'written': time.strftime("%Y-%m-%d %H:%M:%S"),
+                'elapsed_seconds': round(elapsed_seconds, 3),
+                'sources': len(source_snapshots),
+                'endpoints': telemetry_summary(merged, elapsed_seconds),
+                'latency_buckets': [x for x in LATENCY_BUCKETS if x != float('inf')],
+                'latency_histograms': {x: merged[x]['latency_buckets'] for x in sorted(merged)},
+                'source_requests': {source: sum(x['requests'] for x in counts.values())
+                                    for source, counts in sorted(source_snapshots.items())}}
+    write_file_atomically(filename_prefix + TELEMETRY_JSON_SUFFIX, json.dumps(snapshot, indent=1, sort_keys=True))
+    write_file_atomically(filename_prefix + TELEMETRY_PROMETHEUS_SUFFIX,
+                          prometheus_text(merged, len(source_snapshots)))
+# end write_telemetry_files
+
+def log_telemetry_summary(filename_prefix, logfile):
+    ''' per-endpoint lines of the last telemetry.json, nothing if there is none '''
+    telemetry_fn = filename_prefix + TELEMETRY_JSON_SUFFIX
+    if not os.path.exists(telemetry_fn):
+        return
+    with io.open(telemetry_fn, 'r', encoding='utf-8') as f:
+        snapshot = json.load(f)
+    print('[Telemetry of %d sources over %.1f seconds, %s]'
+          % (snapshot['sources'], snapshot['elapsed_seconds'], telemetry_fn), file=logfile)
+    print('%-22s %9s %8s %8s %8s %8s %10s %8s %8s %10s %9s'
+          % ('endpoint', 'requests', 'req/sec', 'p50', 'p95', 'p99', 'req secs', 'retries', 'failures',
+             'MB', 'cache hit'), file=logfile)
+    fmt_seconds = lambda x: '-' if x is None else '%.3f' % x
+    for endpoint in [x for x in ENDPOINTS if x in snapshot['endpoints']] + ['TOTAL']:
+        s = snapshot['endpoints'][endpoint]
+        print('%-22s %9d %8.2f %8s %8s %8s %10.1f %8d %8d %10.1f %9s'
+              % (endpoint, s['requests'], s['requests_per_second'], fmt_seconds(s['p50_seconds']),
+                 fmt_seconds(s['p95_seconds']), fmt_seconds(s['p99_seconds']), s['request_seconds'], s['retries'],
+                 s['failures'], s['bytes'] / 1048576.0,
+                 '-' if s['cache_hit_ratio'] is None else '%.1f%%' % (100.0 * s['cache_hit_ratio'])),
+              file=logfile)
+    logfile.flush()
+# end log_telemetry_summary
@@ -1,5 +1,6 @@
 from __future__ import print_function
 from collections import defaultdict
+from rxnorm_compact_maps import csr_set_map, provenance_map, compact_rxcui_attr, compact_drug_history
 
 '''
 Author:
@@ -64,9 +65,13 @@ class rxnorm_code_maps:
     CONSTRUCTOR.  Interfaces (indirectly) with NLM's RxNorm REST API, by processing informatino
                   in sets and dictionaries created from rxnav_rest_api.
     '''
-    def __init__(self, rxnav, ingredient_rxcui_set, drug_rxcui_set, be_verbose=False):
+    def __init__(self, rxnav, ingredient_rxcui_set, drug_rxcui_set, be_verbose=False, attribute_table=None,
+                 compact=True):
         if be_verbose: print('--- rxnorm_code_maps constructor ---')
         self.rxnav = rxnav # data already in cache
+        # historical attributes, compiled (rxcui_attribute_table) or from the rxnav cache
+        get_attributes = self.rxnav.get_historical_rxcui_attributes if attribute_table is None \
+                         else attribute_table.get_attributes
         self.rxcui_attr = {} # track TTY,RAWNAME,NAME,STATUS,START,END,SCDRXCUI
         self.hist_drug_to_ingredient_attr = {}
         self.drug_to_ingredient_tups_d = {} # track PROVENANCE,SBDRXCUI,IN_RXCUI
@@ -98,8 +103,7 @@ class rxnorm_code_maps:
         print('--- Get Historical RxCUI attributes ---')
         for rxcui in hist_rxcuis: # all historical codes of interest
             # information already in the rxnav cache
-            tup = self.rxnav.get_historical_rxcui_attributes\
-                (rxcui,['NAME','TTY','STATUS','START','END','SCDRXCUI','BOSSRXCUIS'])
+            tup = get_attributes(rxcui,['NAME','TTY','STATUS','START','END','SCDRXCUI','BOSSRXCUIS'])
             name_str, tty_str, status_str, start_str, end_str, scdrxcui, bossrxcuis = tup
             rawname_str = name_str
             if status_str == 'Retired':
@@ -138,6 +142,8 @@ class rxnorm_code_maps:
         # determine the ingredient to drug mappings
         print('--- Determine ingredient to drug mappings ---')
         self.build_ingredients_to_drug_set_map()
+        if compact:
+            self.compact()
 
         # done
         print('--- rxnorm_code_maps constructor (END) ---')
@@ -340,6 +346,21 @@ class rxnorm_code_maps:
         # end for name
     # end parse_drug_name_and_map_to_ingredients
 
+    def compact(self):
+        '''
+        Replace the dictionaries of sets and tuples, needed while building, by their compact read-only forms
+        (CSR arrays, provenance bitflags, attribute columns -- see rxnorm_compact_maps.py).
+        The getters return the same information.
+        '''
+        self.rxcui_attr = compact_rxcui_attr(self.rxcui_attr)
+        self.hist_drug_to_ingredient_attr = compact_drug_history(self.hist_drug_to_ingredient_attr)
+        self.ingredient_to_drug_set = csr_set_map(self.ingredient_to_drug_set)
+        self.drug_to_ingredient_set = csr_set_map(self.drug_to_ingredient_set)
+        self.ingredient_to_min_set = csr_set_map(self.ingredient_to_min_set)
+        self.ingredient_to_drug_provenance = provenance_map(self.ingredient_to_drug_provenance)
+        self.drug_to_ingredient_provenance = provenance_map(self.drug_to_ingredient_provenance)
+    # end compact
+
     '''
     utility methods
     '''
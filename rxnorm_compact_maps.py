@@ -0,0 +1,149 @@
+from __future__ import print_function
+import sys, bisect
+from array import array
+
+'''
+Module: rxnorm_compact_maps.py
+
+Purpose:
+    Define the compact, read-only forms of the rxnorm_code_maps information model, which replace its
+    dictionaries of sets and tuples once the model is built (rxnorm_code_maps.compact):
+
+    csr_set_map         -- dictionary of RxCUI => set of RxCUIs, as CSR (compressed sparse row) arrays:
+                           sorted int32 keys, and the values of key i in values[offsets[i]:offsets[i+1]]
+    provenance_map      -- dictionary of RxCUI => set of provenance names, as one byte of bitflags per key
+    compact_rxcui_attr  -- dictionary of RxCUI => (PROVENANCE, STATUS, RAWNAME, NAME, TTY, START, END),
+                           as columns of small integer codes plus the list of (interned) raw names
+    compact_drug_history -- dictionary of drug RxCUI => ('HISTAPI', BOSSRXCUIS, SCDRXCUI, BOSSRXCUIS)
+
+    Each supports what rxnorm_code_maps and the metadata builders do with the dictionaries they
+    replace -- rxcui in map, map[rxcui], iteration over the keys, len(map) -- so the getters are unchanged.
+    Looking up a key is a binary search of the keys array.
+'''
+
+class compact_map():
+    ''' sorted int32 keys, subclasses define __getitem__ for the position of the key '''
+
+    def __init__(self, keys):
+        self.keys_array = array('i', sorted(keys))
+
+    def find(self, key):
+        idx = bisect.bisect_left(self.keys_array, key)
+        if idx < len(self.keys_array) and self.keys_array[idx] == key:
+            return idx
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        idx = bisect.bisect_left(self.keys_array, key)
+        return idx < len(self.keys_array) and self.keys_array[idx] == key
+
+    def __iter__(self):
+        return iter(self.keys_array)
+
+    def __len__(self):
+        return len(self.keys_array)
+
+    def keys(self):
+        return self.keys_array
+
+    def values(self):
+        return (self[key] for key in self.keys_array)
+
+    def items(self):
+        return ((key, self[key]) for key in self.keys_array)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+# end class compact_map
+
+class csr_set_map(compact_map):
+
+    def __init__(self, d, sort_values=True):
+        compact_map.__init__(self, d.keys())
+        self.offsets = array('l', [0])
+        self.values_array = array('i')
+        for key in self.keys_array:
+            self.values_array.extend(sorted(d[key]) if sort_values else d[key])
+            self.offsets.append(len(self.values_array))
+    # end constructor
+
+    def __getitem__(self, key):
+        ''' the values of the key, an array (sorted unless constructed with sort_values=False) '''
+        idx = self.find(key)
+        return self.values_array[self.offsets[idx]:self.offsets[idx + 1]]
+
+# end class csr_set_map
+
+class provenance_map(compact_map):
+
+    PROVENANCE_FLAGS = {'HISTAPI': 1, 'API': 2, 'NAMEPARSING': 4, 'UNDETERMINED_INGREDIENT': 8}
+
+    def __init__(self, d):
+        compact_map.__init__(self, d.keys())
+        self.flags = array('B', (sum(self.PROVENANCE_FLAGS[x] for x in d[key]) for key in self.keys_array))
+
+    def __getitem__(self, key):
+        ''' the set of provenance names of the key '''
+        flags = self.flags[self.find(key)]
+        return set(name for name, flag in self.PROVENANCE_FLAGS.items() if flags & flag)
+
+# end class provenance_map
+
+class value_codes():
+    ''' small integer codes for a column's distinct values '''
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        if value not in self.codes:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+        return self.codes[value]
+
+# end class value_codes
+
+class compact_rxcui_attr(compact_map):
+
+    def __init__(self, d):
+        compact_map.__init__(self, d.keys())
+        self.value_codes = {x: value_codes() for x in ['PROVENANCE', 'STATUS', 'TTY', 'DATE', 'NAME_PREFIX']}
+        self.columns = {x: array('H') for x in ['PROVENANCE', 'STATUS', 'TTY', 'START', 'END', 'NAME_PREFIX']}
+        self.rawnames = []
+        for key in self.keys_array:
+            provenance, status, rawname, name, tty, start, end = d[key]
+            # NAME is RAWNAME with a prefix, e.g. '(retired 2013-02) '
+            if not name.endswith(rawname):
+                raise ValueError('RxCUI %d NAME [%s] does not end with RAWNAME [%s]' % (key, name, rawname))
+            for column, kind, value in [('PROVENANCE', 'PROVENANCE', provenance), ('STATUS', 'STATUS', status),
+                                        ('TTY', 'TTY', tty), ('START', 'DATE', start), ('END', 'DATE', end),
+                                        ('NAME_PREFIX', 'NAME_PREFIX', name[:len(name) - len(rawname)])]:
+                self.columns[column].append(self.value_codes[kind].code(value))
+            self.rawnames.append(sys.intern(rawname))
+    # end constructor
+
+    def __getitem__(self, key):
+        idx = self.find(key)
+        value = lambda column, kind: self.value_codes[kind].values[self.columns[column][idx]]
+        rawname = self.rawnames[idx]
+        return (value('PROVENANCE', 'PROVENANCE'), value('STATUS', 'STATUS'), rawname,
+                value('NAME_PREFIX', 'NAME_PREFIX') + rawname, value('TTY', 'TTY'),
+                value('START', 'DATE'), value('END', 'DATE'))
+
+# end class compact_rxcui_attr
+
+class compact_drug_history(compact_map):
+
+    def __init__(self, d):
+        compact_map.__init__(self, d.keys())
+        self.scd_rxcuis = array('i', ((d[key][2] or 0) for key in self.keys_array))
+        self.boss_rxcuis = csr_set_map({key: d[key][1] for key in self.keys_array}, sort_values=False)
+
+    def __getitem__(self, key):
+        idx = self.find(key)
+        bossrxcuis = list(self.boss_rxcuis[key])
+        return ('HISTAPI', bossrxcuis, self.scd_rxcuis[idx] if self.scd_rxcuis[idx] else None, bossrxcuis)
+
+# end class compact_drug_history
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys, io, os, shutil, tempfile, filecmp, unittest, contextlib
+
+from utility_functions import utility_functions
+from rxnav_rest_api_mp import rxnav_rest_api_mp
+from rxcui_attribute_table import rxcui_attribute_table
+from rxnorm_code_maps import rxnorm_code_maps
+from va_metadata_builder import va_metadata_builder
+from ingredient_metadata_builder import ingredient_metadata_builder
+from metadata_writer import metadata_writer
+from ndc_api import NDC_ZIP_FILENAME
+from build_rxnorm_metadata import ingredient_rxcui_set_from_attributes, drug_rxcui_set_from_attributes
+from generate_synthetic_cache import synthetic_rxnorm, write_cache, write_ndc_zip
+
+'''
+Script: test_metadata_writer.py
+
+Purpose:
+    Check that the metadata file written with format_workers > 1 (--parallel_format) is the same as
+    the one written in one process, when the rows come from the builders reading a SQLite cache:
+    the builders' row generators look up the cache as the rows are written, and a SQLite connection
+    can only be used by the thread which opened it.
+
+Usage:
+    python test_metadata_writer.py   (or python -m pytest test_metadata_writer.py)
+'''
+
+class parallel_format_test(unittest.TestCase):
+
+    def setUp(self):
+        self.start_dir = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir) # ndc_names_from_fda.zip is read from the current directory
+        model = synthetic_rxnorm(0.01, 1)
+        self.logfile = io.open('test.log', 'w', encoding='utf-8')
+        write_cache(model, 'rxcui.cache', 'sqlite', self.logfile)
+        write_ndc_zip(model, NDC_ZIP_FILENAME)
+
+    def tearDown(self):
+        self.logfile.close()
+        os.chdir(self.start_dir)
+        shutil.rmtree(self.work_dir)
+
+    def write_metadata(self, output_fn, format_workers):
+        rxnav = rxnav_rest_api_mp('rxcui.cache', utility_functions(), self.logfile, None,
+                                  readonly_access_to_cache=True,
+                                  forward_result_to_cache_writer=False,
+                                  fail_if_not_in_cache=True,
+                                  cache_backend='sqlite')
+        rxcui_set, rxcuis_status_d = \
+            rxnav.get_historical_rxcuis(target_status_values=["ACTIVE", "RETIRED", "NEVER%20ACTIVE"])
+        attribute_table = rxcui_attribute_table(rxnav, rxcui_set, self.logfile)
+        rxnorm_coding = rxnorm_code_maps(rxnav, ingredient_rxcui_set_from_attributes(attribute_table),
+                                         drug_rxcui_set_from_attributes(attribute_table),
+                                         attribute_table=attribute_table)
+        va_builder = va_metadata_builder(rxnav, rxnorm_coding)
+        va_builder.build('i2b2_RXNORM_NDC', 2)
+        ingred_builder = ingredient_metadata_builder(rxnorm_coding, rxnav)
+        ingred_builder.build('i2b2_RXNORM_NDC', 1)
+        writer = metadata_writer(output_fn, include_dates=True, strftime_format='%Y%m%d',
+                                 format_workers=format_workers)
+        writer.write_sorted_metadata_rows(va_builder.get_metadata_rows()) # NDC rows read from the cache
+        writer.write_sorted_metadata_rows(ingred_builder.get_metadata_rows())
+        writer.close()
+
+    def test_parallel_format_with_sqlite_cache(self):
+        with contextlib.redirect_stdout(self.logfile): # the builders' progress output
+            self.write_metadata('serial.txt', 0)
+            self.write_metadata('parallel.txt', 3)
+        self.assertGreater(os.path.getsize('serial.txt'), 0)
+        self.assertTrue(filecmp.cmp('serial.txt', 'parallel.txt', shallow=False))
+
+# end class parallel_format_test
+
+if __name__ == '__main__':
+    unittest.main()